@@ -0,0 +1,3 @@
+"""
+Benchmarks of the ingest and of the API, on synthetic StockEtablissement files.
+"""
@@ -0,0 +1,409 @@
+"""
+Benchmark of the API: latency percentiles (p50, p95, p99) and throughput of each route of api_bp under concurrent
+load. By default, a generated file is loaded into a new database served by a threaded server in this process;
+with --base-url, an already running server (gunicorn, ASGI mode) is benchmarked instead, the identifiers of its
+requests being sampled from --database-url.
+
+Usage, from the root of the project (the tables of the database are dropped unless --base-url is given):
+    python -m benchmarks.bench_api --rows 1M --requests 2000 --concurrency 32
+    python -m benchmarks.bench_api --base-url http://localhost:5000 --database-url postgresql://... \\
+        --routes api.get_etablissements,api.lookup_etablissements
+"""
+
+import argparse
+import contextlib
+import http.client
+import io
+import itertools
+import json
+import logging
+import random
+import threading
+import time
+import urllib.parse
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+
+from flask import Flask
+from sqlalchemy import create_engine, select
+from werkzeug.serving import make_server
+
+from benchmarks.common import environment, make_app, percentile, write_results
+from benchmarks.generate import DEFAULT_SEED, dataset_path, parse_size
+from flask_app.api.routes import api_bp
+from flask_app.db.init_db import run_ingest
+from flask_app.db.models import Etablissement
+
+ADMIN_TOKEN = 'benchmark'
+
+# Number of rows sampled from the database to build the requests
+SAMPLE_SIZE = 2000
+
+# A request: method, path with its query string, and JSON body
+Request = tuple[str, str, object]
+
+
+class RequestFactory:
+    """
+    Builds the requests of each route from a sample of the loaded data. The requests are built before the load
+    starts, in a fixed order, so that two runs with the same seed send the same requests.
+    """
+
+    def __init__(self, sample: dict, seed: int):
+        """
+        :param sample: the sampled sirets, sirens, postal codes, NAF codes and communes.
+        :param seed: the seed of the random generator.
+        """
+        self.sample = sample
+        self.rng = random.Random(seed)
+        self.created_sirets: list[str] = []
+        self._created = itertools.count()
+
+    def pick(self, key: str) -> str:
+        """
+        Draws a sampled value.
+        :param key: the sampled column.
+        :return: the value.
+        """
+        return self.rng.choice(self.sample[key])
+
+    def hello(self) -> Request:
+        return 'GET', '/api/hello', None
+
+    def db_check(self) -> Request:
+        return 'GET', f"/api/db_check?count={self.rng.choice(('exact', 'estimate'))}", None
+
+    def ready(self) -> Request:
+        return 'GET', '/api/ready', None
+
+    def ingest_status(self) -> Request:
+        return 'GET', '/api/ingest/status', None
+
+    def list_etablissements(self) -> Request:
+        """
+        Draws a list request among the common shapes: filters, prefix, sort, projection and keyset pagination.
+        """
+        shapes = [
+            f"page={self.rng.randint(1, 50)}&per_page=20",
+            f"code_postal={self.pick('code_postal')}&per_page=50",
+            f"activite_principale={self.pick('activite_principale')}&sort=-date_creation&per_page=20",
+            f"code_postal__prefix={self.pick('code_postal')[:2]}&fields=siret,code_postal&cursor=&per_page=100",
+            "date_creation__gte=2015-01-01&sort=date_creation&count=estimate&per_page=20",
+        ]
+        return 'GET', '/api/etablissements?' + self.rng.choice(shapes), None
+
+    def export(self) -> Request:
+        return 'GET', f"/api/etablissements/export?code_postal={self.pick('code_postal')}&format=" \
+                      f"{self.rng.choice(('ndjson', 'csv'))}", None
+
+    def lookup(self) -> Request:
+        return 'POST', '/api/etablissements/lookup', {
+            'sirets': [self.pick('siret') for _ in range(40)], 'sirens': [self.pick('siren') for _ in range(10)]}
+
+    def bulk(self) -> Request:
+        records = [{'siret': self.pick('siret'), 'enseigne1': f"BENCH {self.rng.randint(0, 999)}"}
+                   for _ in range(100)]
+        # A siret appears once per batch
+        records = list({record['siret']: record for record in records}.values())
+        return 'POST', '/api/etablissements/bulk?mode=update', records
+
+    def audit(self) -> Request:
+        return 'GET', f"/api/audit?siret={self.pick('siret')}&per_page=20", None
+
+    def search(self) -> Request:
+        return 'GET', f"/api/etablissements/search?q={urllib.parse.quote(self.pick('libelle_commune'))}&limit=20", \
+            None
+
+    def get_etablissement(self) -> Request:
+        return 'GET', f"/api/etablissements/{self.pick('siret')}", None
+
+    def cache_stats(self) -> Request:
+        return 'GET', '/api/cache/stats', None
+
+    def query_shapes(self) -> Request:
+        return 'GET', '/api/admin/query-shapes?limit=20', None
+
+    def clear_query_shapes(self) -> Request:
+        return 'DELETE', '/api/admin/query-shapes', None
+
+    def explain(self) -> Request:
+        return 'GET', '/api/admin/query-shapes/explain?limit=1', None
+
+    def index_suggestions(self) -> Request:
+        return 'GET', f"/api/admin/index-suggestions?format={self.rng.choice(('json', 'sql'))}", None
+
+    def replicas(self) -> Request:
+        return 'GET', '/api/admin/replicas', None
+
+    def create(self) -> Request:
+        """
+        Builds the creation of a new Etablissement, deleted later by the delete requests.
+        """
+        number = next(self._created)
+        siren = f"99{number:07d}"
+        siret = f"{siren}{number % 100000:05d}"
+        self.created_sirets.append(siret)
+        record = {'siret': siret, 'siren': siren, 'nic': siret[9:], 'code_postal': self.pick('code_postal')}
+        return 'POST', '/api/etablissements', record
+
+    def update(self) -> Request:
+        return 'PUT', f"/api/etablissements/{self.pick('siret')}", {'enseigne1': f"BENCH {self.rng.randint(0, 999)}"}
+
+    def delete(self) -> Request:
+        siret = self.created_sirets.pop(0) if self.created_sirets else self.pick('siret')
+        return 'DELETE', f"/api/etablissements/{siret}", None
+
+
+# Request builder of each route, in the order of the runs: the reads, then the writes, the created Etablissements
+# being deleted by the delete route, then the admin routes once the query shapes of the list route are recorded
+SCENARIOS: dict[str, Callable[[RequestFactory], Request]] = {
+    'api.hello_world': RequestFactory.hello,
+    'api.count_establishments': RequestFactory.db_check,
+    'api.ready': RequestFactory.ready,
+    'api.get_ingest_status': RequestFactory.ingest_status,
+    'api.get_etablissements': RequestFactory.list_etablissements,
+    'api.get_etablissement': RequestFactory.get_etablissement,
+    'api.lookup_etablissements': RequestFactory.lookup,
+    'api.search_etablissements': RequestFactory.search,
+    'api.export_etablissements': RequestFactory.export,
+    'api.get_cache_stats': RequestFactory.cache_stats,
+    'api.create_etablissement': RequestFactory.create,
+    'api.update_etablissement': RequestFactory.update,
+    'api.delete_etablissement': RequestFactory.delete,
+    'api.bulk_write_etablissements': RequestFactory.bulk,
+    'api.get_audit_log': RequestFactory.audit,
+    'api.get_query_shapes': RequestFactory.query_shapes,
+    'api.explain_query_shapes': RequestFactory.explain,
+    'api.get_index_suggestions': RequestFactory.index_suggestions,
+    'api.get_replicas': RequestFactory.replicas,
+    'api.clear_query_shapes': RequestFactory.clear_query_shapes,
+}
+
+
+def api_endpoints() -> list[str]:
+    """
+    Lists the endpoints of api_bp.
+    :return: the endpoint names, like 'api.get_etablissements'.
+    """
+    app = Flask('flask_app')
+    app.register_blueprint(api_bp, url_prefix="/api")
+    return sorted({rule.endpoint for rule in app.url_map.iter_rules() if rule.endpoint.startswith('api.')})
+
+
+def sample_data(database_url: str, seed: int) -> dict:
+    """
+    Samples the identifiers and the filter values of the requests from the loaded data.
+    :param database_url: the URL of the database.
+    :param seed: the seed of the sample.
+    :return: the sampled values, by column.
+    """
+    engine = create_engine(database_url)
+    columns = ('siret', 'siren', 'code_postal', 'activite_principale', 'libelle_commune')
+    with engine.connect() as connection:
+        rows = connection.execute(
+            select(*[getattr(Etablissement, column) for column in columns]).order_by(Etablissement.siret)
+        ).all()
+    engine.dispose()
+    if not rows:
+        raise SystemExit("The database is empty, load it first")
+    rows = random.Random(seed).sample(rows, min(SAMPLE_SIZE, len(rows)))
+    return {column: [row[index] for row in rows if row[index]] or [''] for index, column in enumerate(columns)}
+
+
+def send(connection: http.client.HTTPConnection, request: Request) -> tuple[int, float]:
+    """
+    Sends a request and reads its whole response.
+    :param connection: the connection to the server, reopened when the server closed it.
+    :param request: the request.
+    :return: the status code and the latency in milliseconds.
+    """
+    method, path, body = request
+    headers = {'X-Admin-Token': ADMIN_TOKEN}
+    payload = None
+    if body is not None:
+        payload = json.dumps(body).encode('utf-8')
+        headers['Content-Type'] = 'application/json'
+    start = time.perf_counter()
+    connection.request(method, path, body=payload, headers=headers)
+    response = connection.getresponse()
+    response.read()
+    latency = (time.perf_counter() - start) * 1000
+    if response.getheader('Connection', '').lower() == 'close' or response.version == 10:
+        connection.close()
+    return response.status, latency
+
+
+def run_route(base_url: str, endpoint: str, requests: list[Request], concurrency: int) -> dict:
+    """
+    Sends the requests of a route from concurrent clients, each with its own connection.
+    :param base_url: the URL of the server.
+    :param endpoint: the endpoint of the route.
+    :param requests: the requests.
+    :param concurrency: the number of concurrent clients.
+    :return: the number of requests, the status codes, the errors, the throughput and the latency percentiles.
+    """
+    url = urllib.parse.urlsplit(base_url)
+    latencies = []
+    statuses = {}
+    errors = []
+    lock = threading.Lock()
+
+    def client(share: list[Request]) -> None:
+        """
+        Sends a share of the requests one after the other.
+        :param share: the requests of the client.
+        :return: None
+        """
+        connection = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=120)
+        for request in share:
+            try:
+                status, latency = send(connection, request)
+            except (OSError, http.client.HTTPException) as e:
+                connection.close()
+                with lock:
+                    errors.append(f"{e.__class__.__name__}: {e}")
+                continue
+            with lock:
+                latencies.append(latency)
+                statuses[str(status)] = statuses.get(str(status), 0) + 1
+        connection.close()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(client, [requests[index::concurrency] for index in range(concurrency)]))
+    seconds = time.perf_counter() - start
+
+    latencies.sort()
+    failed = sum(count for status, count in statuses.items() if int(status) >= 400) + len(errors)
+    return {
+        'endpoint': endpoint,
+        'method': requests[0][0] if requests else None,
+        'requests': len(requests),
+        'statuses': statuses,
+        'failed': failed,
+        'errors': sorted(set(errors))[:10],
+        'seconds': round(seconds, 3),
+        'throughput_rps': round(len(latencies) / seconds, 1) if seconds else None,
+        'latency_ms': {
+            'p50': _round(percentile(latencies, 0.50)),
+            'p95': _round(percentile(latencies, 0.95)),
+            'p99': _round(percentile(latencies, 0.99)),
+            'mean': _round(sum(latencies) / len(latencies)) if latencies else None,
+            'max': _round(latencies[-1]) if latencies else None,
+        },
+    }
+
+
+def _round(value: float | None) -> float | None:
+    """
+    Rounds a latency to the microsecond.
+    :param value: the latency in milliseconds.
+    :return: the rounded latency.
+    """
+    return round(value, 3) if value is not None else None
+
+
+@contextlib.contextmanager
+def local_server(rows: int, seed: int, database_url: str | None):
+    """
+    Loads a generated file into a new database and serves the API from a threaded server in this process.
+    :param rows: the number of rows of the file.
+    :param seed: the seed of the file.
+    :param database_url: the URL of the database, a new SQLite file by default.
+    :return: an iterator yielding the URL of the server and the URL of the database.
+    """
+    csv_path = dataset_path(rows, seed)
+    app = make_app(database_url, INGEST_CSV_PATH=csv_path, ADMIN_TOKEN=ADMIN_TOKEN, QUERY_SHAPES_SIZE=1000)
+    with app.app_context(), contextlib.redirect_stdout(io.StringIO()):
+        run_ingest()
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"http://127.0.0.1:{server.server_port}", app.config["SQLALCHEMY_DATABASE_URI"]
+    finally:
+        server.shutdown()
+        thread.join()
+
+
+def run_benchmark(base_url: str, database_url: str, endpoints: list[str], requests: int, concurrency: int,
+                  warmup: int, seed: int) -> list[dict]:
+    """
+    Benchmarks the routes one after the other.
+    :param base_url: the URL of the server.
+    :param database_url: the URL of the database the identifiers are sampled from.
+    :param endpoints: the endpoints of the benchmarked routes.
+    :param requests: the number of measured requests per route.
+    :param concurrency: the number of concurrent clients.
+    :param warmup: the number of requests sent to each route before the measure.
+    :param seed: the seed of the requests.
+    :return: the results of each route.
+    """
+    factory = RequestFactory(sample_data(database_url, seed), seed)
+    results = []
+    for endpoint in endpoints:
+        build = SCENARIOS[endpoint]
+        warmup_requests = [build(factory) for _ in range(warmup)]
+        measured_requests = [build(factory) for _ in range(requests)]
+        run_route(base_url, endpoint, warmup_requests, concurrency)
+        result = run_route(base_url, endpoint, measured_requests, concurrency)
+        latency = result['latency_ms']
+        print(f"{endpoint:35} {result['throughput_rps']:>9} req/s  p50 {latency['p50']} ms  p95 {latency['p95']} ms  "
+              f"p99 {latency['p99']} ms  failed {result['failed']}")
+        results.append(result)
+    return results
+
+
+def main() -> None:
+    """
+    Command line entry point.
+    :return: None
+    """
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', default='10k', help="number of rows: 10k, 1M, 10M or an integer")
+    parser.add_argument('--seed', type=int, default=DEFAULT_SEED)
+    parser.add_argument('--database-url', help="database of the app, a temporary SQLite file by default")
+    parser.add_argument('--base-url', help="URL of a running server to benchmark, with its data already loaded")
+    parser.add_argument('--routes', help="comma-separated endpoints to benchmark, all the routes of api_bp by default")
+    parser.add_argument('--requests', type=int, default=500, help="measured requests per route")
+    parser.add_argument('--concurrency', type=int, default=16, help="concurrent clients")
+    parser.add_argument('--warmup', type=int, default=20, help="requests per route before the measure")
+    parser.add_argument('--output', help="JSON file of the results, in benchmarks/results by default")
+    args = parser.parse_args()
+
+    endpoints = api_endpoints()
+    missing = [endpoint for endpoint in endpoints if endpoint not in SCENARIOS]
+    if missing:
+        print(f"No benchmark scenario for: {', '.join(missing)}")
+    selected = args.routes.split(',') if args.routes else list(SCENARIOS)
+    unknown = [endpoint for endpoint in selected if endpoint not in SCENARIOS]
+    if unknown:
+        parser.error(f"Unknown routes: {', '.join(unknown)}. Use some of: {', '.join(SCENARIOS)}")
+    selected = [endpoint for endpoint in SCENARIOS if endpoint in selected]
+
+    rows = parse_size(args.rows)
+    if args.base_url:
+        if not args.database_url:
+            parser.error("--database-url is required with --base-url, to sample the identifiers of the requests")
+        server = contextlib.nullcontext((args.base_url, args.database_url))
+    else:
+        server = local_server(rows, args.seed, args.database_url)
+
+    with server as (base_url, database_url):
+        results = run_benchmark(base_url, database_url, selected, args.requests, args.concurrency, args.warmup,
+                                args.seed)
+
+    write_results({
+        'benchmark': 'api',
+        'environment': environment(database_url),
+        'parameters': {'rows': None if args.base_url else rows, 'seed': args.seed, 'base_url': args.base_url,
+                       'requests': args.requests, 'concurrency': args.concurrency, 'warmup': args.warmup},
+        'routes': results,
+        'not_benchmarked': missing,
+    }, args.output, 'api')
+
+
+if __name__ == '__main__':
+    main()
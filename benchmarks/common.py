@@ -0,0 +1,106 @@
+"""
+Helpers shared by the benchmarks: the Flask app under test, the description of the environment and the results.
+"""
+
+import datetime
+import json
+import math
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+
+from flask import Flask
+
+from flask_app.api.routes import api_bp
+from flask_app.db import db
+from flask_app.db.routing import engine_options
+
+# Directory of the result files, one JSON file per run
+DEFAULT_RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+
+def make_app(database_url: str | None = None, **config) -> Flask:
+    """
+    Creates a Flask app serving the API on a database, without the initialization of the production app.
+    The tables of the database are dropped and created again: use a database dedicated to the benchmarks.
+    :param database_url: the URL of the database, a new SQLite file in a temporary directory by default.
+    :param config: additional configuration of the app.
+    :return: the app, its database having the empty tables of the models.
+    """
+    if database_url is None:
+        database_url = "sqlite:///" + os.path.join(tempfile.mkdtemp(prefix='flask_app_bench_'), 'bench.db')
+    app = Flask('flask_app')
+    app.config["SQLALCHEMY_DATABASE_URI"] = database_url
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(database_url, 20, 10, 30, 1800, False)
+    app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config.update(config)
+    db.init_app(app)
+    app.register_blueprint(api_bp, url_prefix="/api")
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+    return app
+
+
+def git_revision() -> str | None:
+    """
+    Gets the commit of the benchmarked code.
+    :return: the commit hash, with a '+dirty' suffix for uncommitted changes, or None outside of a git checkout.
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    try:
+        revision = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=root, capture_output=True, text=True,
+                                  check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=root,
+                               capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return revision + ('+dirty' if dirty else '')
+
+
+def environment(database_url: str) -> dict:
+    """
+    Describes the environment of a run, to compare runs made in the same conditions.
+    :param database_url: the URL of the benchmarked database.
+    :return: the revision, Python version, platform, CPU count and database dialect.
+    """
+    return {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'database': database_url.split(':', 1)[0],
+    }
+
+
+def percentile(sorted_values: list[float], fraction: float) -> float | None:
+    """
+    Computes a percentile with the nearest-rank method.
+    :param sorted_values: the values, in increasing order.
+    :param fraction: the percentile, between 0 and 1.
+    :return: the percentile, or None without values.
+    """
+    if not sorted_values:
+        return None
+    return sorted_values[max(math.ceil(fraction * len(sorted_values)) - 1, 0)]
+
+
+def write_results(results: dict, output: str | None, name: str) -> str:
+    """
+    Writes the results of a run as JSON.
+    :param results: the results.
+    :param output: the path of the file, a timestamped file of benchmarks/results by default.
+    :param name: the name of the benchmark, prefixing the default file name.
+    :return: the path of the file.
+    """
+    if output is None:
+        timestamp = datetime.datetime.now(datetime.timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+        output = os.path.join(DEFAULT_RESULTS_DIR, f"{name}_{timestamp}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as file:
+        json.dump(results, file, indent=2, sort_keys=True)
+        file.write('\n')
+    print(f"Results written to {output}", file=sys.stderr)
+    return output
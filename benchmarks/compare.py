@@ -0,0 +1,89 @@
+"""
+Comparison of two result files of the same benchmark, a baseline and a candidate.
+
+Usage, from the root of the project:
+    python -m benchmarks.compare benchmarks/results/api_<before>.json benchmarks/results/api_<after>.json
+"""
+
+import argparse
+import json
+
+
+def load(path: str) -> dict:
+    """
+    Reads a result file.
+    :param path: the path of the file.
+    :return: the results.
+    """
+    with open(path, encoding='utf-8') as file:
+        return json.load(file)
+
+
+def change(baseline: float | None, candidate: float | None) -> str:
+    """
+    Formats the relative change between two measures.
+    :param baseline: the measure of the baseline.
+    :param candidate: the measure of the candidate.
+    :return: the change, like '+12.5%', or '-' when a measure is missing.
+    """
+    if not baseline or candidate is None:
+        return '-'
+    return f"{(candidate - baseline) / baseline * 100:+.1f}%"
+
+
+def compare_api(baseline: dict, candidate: dict) -> list[str]:
+    """
+    Compares the throughput and the latency percentiles of the routes of two API runs.
+    :param baseline: the results of the baseline.
+    :param candidate: the results of the candidate.
+    :return: the lines of the comparison.
+    """
+    routes = {result['endpoint']: result for result in baseline['routes']}
+    lines = [f"{'endpoint':35} {'req/s':>9} {'p50':>8} {'p95':>8} {'p99':>8}"]
+    for result in candidate['routes']:
+        before = routes.get(result['endpoint'])
+        if before is None:
+            continue
+        lines.append(f"{result['endpoint']:35} {change(before['throughput_rps'], result['throughput_rps']):>9} " +
+                     ' '.join(f"{change(before['latency_ms'][key], result['latency_ms'][key]):>8}"
+                              for key in ('p50', 'p95', 'p99')))
+    return lines
+
+
+def compare_ingest(baseline: dict, candidate: dict) -> list[str]:
+    """
+    Compares the load rates of two ingest runs.
+    :param baseline: the results of the baseline.
+    :param candidate: the results of the candidate.
+    :return: the lines of the comparison.
+    """
+    return [f"{key}: {baseline['summary'][key]} -> {candidate['summary'][key]} rows/s "
+            f"({change(baseline['summary'][key], candidate['summary'][key])})"
+            for key in ('rows_per_second_median', 'rows_per_second_best')]
+
+
+def main() -> None:
+    """
+    Command line entry point.
+    :return: None
+    """
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('baseline')
+    parser.add_argument('candidate')
+    args = parser.parse_args()
+
+    baseline, candidate = load(args.baseline), load(args.candidate)
+    if baseline['benchmark'] != candidate['benchmark']:
+        parser.error(f"Cannot compare a {baseline['benchmark']} run with a {candidate['benchmark']} run")
+    for key in ('database', 'cpu_count'):
+        if baseline['environment'][key] != candidate['environment'][key]:
+            print(f"Warning: different {key}: {baseline['environment'][key]} and {candidate['environment'][key]}")
+    if baseline['parameters'] != candidate['parameters']:
+        print("Warning: the runs have different parameters")
+    print(f"{baseline['environment']['revision']} -> {candidate['environment']['revision']}")
+    lines = compare_api(baseline, candidate) if baseline['benchmark'] == 'api' else compare_ingest(baseline, candidate)
+    print('\n'.join(lines))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,283 @@
+"""
+Deterministic generator of StockEtablissement-shaped CSV files, with the distributions of the real stock:
+postal codes concentrated on the large départements, a long tail of NAF codes, mostly empty optional columns,
+several establishments for some units, and valid SIREN and SIRET check digits.
+
+Usage, from the root of the project:
+    python -m benchmarks.generate --rows 1M --output benchmarks/data/StockEtablissement_1M.csv
+"""
+
+import argparse
+import csv
+import datetime
+import itertools
+import os
+import random
+import time
+
+from typing import Iterator
+
+from flask_app.db.parsers import CSV_COLUMNS
+
+CSV_HEADER = [csv_name for _, csv_name, _ in CSV_COLUMNS]
+
+# Sizes of the generated files, by label
+SIZES = {'10k': 10_000, '1M': 1_000_000, '10M': 10_000_000}
+
+DEFAULT_SEED = 20240301
+
+DEFAULT_DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+# Départements weighted by their approximate share of the establishments, the others sharing the rest evenly
+DEPARTEMENT_SHARES = {
+    '75': 9.0, '13': 3.6, '69': 3.4, '92': 3.2, '06': 2.6, '33': 2.5, '59': 2.5, '31': 2.2, '34': 2.0, '93': 2.0,
+    '94': 1.9, '78': 1.7, '44': 1.7, '77': 1.6, '91': 1.5, '95': 1.4, '83': 1.6, '67': 1.4, '38': 1.5, '35': 1.3,
+}
+DEPARTEMENTS = list(DEPARTEMENT_SHARES)
+DEPARTEMENT_WEIGHTS = list(itertools.accumulate(DEPARTEMENT_SHARES.values()))
+OTHER_DEPARTEMENTS = [f"{number:02d}" for number in range(1, 96) if number != 20 and f"{number:02d}" not in
+                      DEPARTEMENT_SHARES] + ['2A', '2B', '971', '972', '973', '974', '976']
+
+COMMUNES = {
+    '75': 'PARIS', '13': 'MARSEILLE', '69': 'LYON', '92': 'NANTERRE', '06': 'NICE', '33': 'BORDEAUX', '59': 'LILLE',
+    '31': 'TOULOUSE', '34': 'MONTPELLIER', '93': 'SAINT-DENIS', '94': 'CRETEIL', '78': 'VERSAILLES', '44': 'NANTES',
+    '77': 'MELUN', '91': 'EVRY-COURCOURONNES', '95': 'CERGY', '83': 'TOULON', '67': 'STRASBOURG', '38': 'GRENOBLE',
+    '35': 'RENNES',
+}
+
+# Most frequent NAF codes of the stock, most frequent first, their weights decreasing like a Zipf law.
+# The weights are cumulative, as random.choices takes them without summing them at each draw
+NAF_CODES = [
+    '68.20B', '70.22Z', '68.20A', '86.90E', '47.91B', '56.10A', '43.22A', '62.01Z', '96.02A', '85.59A', '94.99Z',
+    '43.21A', '70.10Z', '86.21Z', '41.20A', '74.90B', '69.20Z', '56.10C', '45.20A', '81.21Z', '49.32Z', '93.19Z',
+    '73.11Z', '90.01Z', '47.71Z', '10.71C', '55.10Z', '64.20Z', '82.99Z', '66.22Z', '01.11Z', '47.11F', '86.23Z',
+    '43.31Z', '43.99C', '71.12B', '46.90Z', '88.10A', '52.29A', '96.09Z',
+]
+NAF_WEIGHTS = list(itertools.accumulate(1 / (rank + 1) ** 0.8 for rank in range(len(NAF_CODES))))
+
+# Codes of the employee brackets, 'NN' (no employee) being the most frequent
+TRANCHES = ['NN', '00', '01', '02', '03', '11', '12', '21', '22', '31', '32', '41', '42', '51', '52', '53']
+TRANCHE_WEIGHTS = list(itertools.accumulate([70, 8, 7, 4, 3, 2.5, 1.5, 1, 0.8, 0.5, 0.4, 0.2, 0.1, 0.05, 0.03, 0.02]))
+
+TYPES_VOIE = ['RUE', 'AV', 'BD', 'CHE', 'PL', 'IMP', 'ALL', 'RTE', 'QUAI', 'CRS', '']
+TYPE_VOIE_WEIGHTS = list(itertools.accumulate([50, 12, 7, 6, 4, 3, 3, 3, 1, 1, 10]))
+LIBELLES_VOIE = ['DE LA REPUBLIQUE', 'VICTOR HUGO', 'JEAN JAURES', 'DU GENERAL DE GAULLE', 'PASTEUR', 'DE LA GARE',
+                 'DE PARIS', 'DU MOULIN', 'DES ECOLES', 'DE L EGLISE', 'NATIONALE', 'GAMBETTA', 'FOCH', 'DE LA PAIX',
+                 'DES LILAS', 'DU CHATEAU', 'SAINT MARTIN', 'CARNOT', 'DES PRES', 'MARECHAL LECLERC']
+ENSEIGNES = ['BOULANGERIE', 'PHARMACIE', 'GARAGE', 'CAFE', 'RESTAURANT', 'COIFFURE', 'TABAC', 'EPICERIE',
+             'BOUCHERIE', 'FLEURS', 'OPTIQUE', 'LIBRAIRIE']
+
+_FIRST_DAY = datetime.date(1950, 1, 1).toordinal()
+_LAST_DAY = datetime.date(2024, 12, 31).toordinal()
+
+
+def parse_size(size: str) -> int:
+    """
+    Reads a number of rows, given as a label (10k, 1M, 10M) or as an integer.
+    :param size: the number of rows.
+    :return: the number of rows.
+    :raise ValueError: if the size is neither a label nor an integer.
+    """
+    if size in SIZES:
+        return SIZES[size]
+    return int(size)
+
+
+def luhn_digit(digits: str) -> str:
+    """
+    Computes the digit completing a number so that it passes the Luhn check, like the SIREN and SIRET numbers.
+    :param digits: the number without its check digit.
+    :return: the check digit.
+    """
+    total = 0
+    for position, digit in enumerate(reversed(digits)):
+        value = int(digit) * (2 if position % 2 == 0 else 1)
+        total += value - 9 if value > 9 else value
+    return str((10 - total % 10) % 10)
+
+
+def siren_number(unit: int) -> str:
+    """
+    Builds the unique SIREN of a legal unit, spread over the whole range like the real numbers.
+    :param unit: the index of the unit, below 10^8.
+    :return: the 9-digit SIREN.
+    """
+    digits = f"{(unit * 7919 + 30_000_000) % 100_000_000:08d}"
+    return digits + luhn_digit(digits)
+
+
+def postal_code(rng: random.Random) -> tuple[str, str]:
+    """
+    Draws the postal code and the commune of an establishment.
+    :param rng: the random generator.
+    :return: the postal code and the commune name.
+    """
+    if rng.random() < 0.6:
+        departement = rng.choices(DEPARTEMENTS, cum_weights=DEPARTEMENT_WEIGHTS)[0]
+    else:
+        departement = rng.choice(OTHER_DEPARTEMENTS)
+
+    if departement == '75':
+        code = f"750{rng.randint(1, 20):02d}"
+    elif len(departement) == 3:
+        code = f"{departement}{rng.randint(0, 9)}0"
+    elif departement in ('2A', '2B'):
+        code = f"20{rng.choice((0, 1, 2, 6))}{rng.randint(0, 9)}0"
+    else:
+        code = f"{departement}{rng.randint(0, 9)}{rng.randint(0, 9)}0"
+    return code, COMMUNES.get(departement, f"COMMUNE {code}")
+
+
+def _date(rng: random.Random, first: int = _FIRST_DAY) -> datetime.date:
+    """
+    Draws a date, recent dates being more frequent like the creations of establishments.
+    :param rng: the random generator.
+    :param first: the first possible day, as an ordinal.
+    :return: the date.
+    """
+    return datetime.date.fromordinal(_LAST_DAY - int((_LAST_DAY - first) * rng.random() ** 2))
+
+
+def _maybe(rng: random.Random, probability: float, value: str) -> str:
+    """
+    Keeps a value with a probability, the column being empty otherwise.
+    :param rng: the random generator.
+    :param probability: the probability to keep the value.
+    :param value: the value.
+    :return: the value, or an empty string.
+    """
+    return value if rng.random() < probability else ''
+
+
+def make_record(rng: random.Random, siren: str, period: int) -> dict:
+    """
+    Draws the CSV record of an establishment.
+    :param rng: the random generator.
+    :param siren: the SIREN of the unit of the establishment.
+    :param period: the rank of the establishment in its unit, from 1.
+    :return: the raw CSV values, by CSV column name.
+    """
+    nic_digits = siren + f"{period:04d}"
+    nic = f"{period:04d}" + luhn_digit(nic_digits)
+    code, commune = postal_code(rng)
+    created = _date(rng)
+    tranche = rng.choices(TRANCHES, cum_weights=TRANCHE_WEIGHTS)[0]
+    open_establishment = rng.random() < 0.55
+    naf = rng.choices(NAF_CODES, cum_weights=NAF_WEIGHTS)[0]
+
+    record = dict.fromkeys(CSV_HEADER, '')
+    record.update({
+        'siren': siren,
+        'nic': nic,
+        'siret': siren + nic,
+        'statutDiffusionEtablissement': 'O' if rng.random() < 0.97 else 'P',
+        'dateCreationEtablissement': created.isoformat() if rng.random() < 0.98 else '',
+        'trancheEffectifsEtablissement': tranche,
+        'anneeEffectifsEtablissement': '' if tranche == 'NN' else str(rng.randint(2019, 2022)),
+        'activitePrincipaleRegistreMetiersEtablissement': _maybe(rng, 0.1, f"{rng.randint(1000, 9699)}Z"),
+        'dateDernierTraitementEtablissement':
+            f"{_date(rng, datetime.date(2010, 1, 1).toordinal()).isoformat()}T{rng.randint(0, 23):02d}:"
+            f"{rng.randint(0, 59):02d}:{rng.randint(0, 59):02d}",
+        'etablissementSiege': 'true' if period == 1 and rng.random() < 0.9 else 'false',
+        'nombrePeriodesEtablissement': str(min(1 + int(rng.expovariate(1.2)), 9)),
+        'complementAdresseEtablissement': _maybe(rng, 0.15, f"BATIMENT {rng.choice('ABCDE')}"),
+        'numeroVoieEtablissement': _maybe(rng, 0.8, str(rng.randint(1, 250))),
+        'indiceRepetitionEtablissement': _maybe(rng, 0.05, rng.choice('BTQ')),
+        'typeVoieEtablissement': rng.choices(TYPES_VOIE, cum_weights=TYPE_VOIE_WEIGHTS)[0],
+        'libelleVoieEtablissement': rng.choice(LIBELLES_VOIE),
+        'codePostalEtablissement': code,
+        'libelleCommuneEtablissement': commune,
+        'codeCommuneEtablissement': code[:2] + f"{rng.randint(1, 999):03d}" if code[:2] != '20' else code,
+        'codeCedexEtablissement': _maybe(rng, 0.02, code),
+        'dateDebut': (created + datetime.timedelta(days=rng.randint(0, 3000))).isoformat(),
+        'etatAdministratifEtablissement': 'A' if open_establishment else 'F',
+        'enseigne1Etablissement': _maybe(rng, 0.15, f"{rng.choice(ENSEIGNES)} {commune}"),
+        'denominationUsuelleEtablissement': _maybe(rng, 0.1, f"{rng.choice(ENSEIGNES)} {rng.choice(LIBELLES_VOIE)}"),
+        'activitePrincipaleEtablissement': naf,
+        'nomenclatureActivitePrincipaleEtablissement': 'NAFRev2',
+        'caractereEmployeurEtablissement': 'N' if tranche in ('NN', '00') else 'O',
+    })
+    if rng.random() < 0.01:
+        record.update({
+            'complementAdresse2Etablissement': 'ZONE INDUSTRIELLE',
+            'numeroVoie2Etablissement': str(rng.randint(1, 99)),
+            'libelleVoie2Etablissement': rng.choice(LIBELLES_VOIE),
+            'codePostal2Etablissement': code,
+            'libelleCommune2Etablissement': commune,
+        })
+    return record
+
+
+def generate_records(rows: int, seed: int = DEFAULT_SEED) -> Iterator[dict]:
+    """
+    Generates the records of a file. The same rows and seed always give the same records.
+    Most legal units have a single establishment, some have several, like in the real stock.
+    :param rows: the number of records.
+    :param seed: the seed of the random generator.
+    :return: an iterator of the raw CSV records.
+    """
+    rng = random.Random(seed)
+    produced = 0
+    unit = 0
+    while produced < rows:
+        siren = siren_number(unit)
+        establishments = 1 if rng.random() < 0.8 else min(2 + int(rng.expovariate(0.5)), 50)
+        for period in range(1, min(establishments, rows - produced) + 1):
+            yield make_record(rng, siren, period)
+            produced += 1
+        unit += 1
+
+
+def generate_csv(path: str, rows: int, seed: int = DEFAULT_SEED) -> dict:
+    """
+    Writes a StockEtablissement-shaped CSV file.
+    :param path: the path of the file, its directory being created if needed.
+    :param rows: the number of records.
+    :param seed: the seed of the random generator.
+    :return: the statistics of the generation (path, rows, bytes, seconds).
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    start = time.perf_counter()
+    with open(path, 'w', encoding='utf-8', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=CSV_HEADER)
+        writer.writeheader()
+        writer.writerows(generate_records(rows, seed))
+    return {'path': path, 'rows': rows, 'bytes': os.path.getsize(path),
+            'seconds': round(time.perf_counter() - start, 3)}
+
+
+def dataset_path(rows: int, seed: int = DEFAULT_SEED, data_dir: str = DEFAULT_DATA_DIR) -> str:
+    """
+    Gets the path of a generated file, generating it on first use.
+    :param rows: the number of records.
+    :param seed: the seed of the random generator.
+    :param data_dir: the directory of the generated files.
+    :return: the path of the file.
+    """
+    path = os.path.join(data_dir, f"StockEtablissement_{rows}_{seed}.csv")
+    if not os.path.exists(path):
+        print(f"Generating {rows} rows into {path}.")
+        generate_csv(path + '.tmp', rows, seed)
+        os.replace(path + '.tmp', path)
+    return path
+
+
+def main() -> None:
+    """
+    Command line entry point.
+    :return: None
+    """
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', default='10k', help="number of rows: 10k, 1M, 10M or an integer")
+    parser.add_argument('--seed', type=int, default=DEFAULT_SEED)
+    parser.add_argument('--output', help="path of the CSV file, in benchmarks/data by default")
+    args = parser.parse_args()
+
+    rows = parse_size(args.rows)
+    path = args.output or os.path.join(DEFAULT_DATA_DIR, f"StockEtablissement_{rows}_{args.seed}.csv")
+    stats = generate_csv(path, rows, args.seed)
+    print(f"Generated {stats['rows']} rows ({stats['bytes']} bytes) into {stats['path']} in {stats['seconds']}s.")
+
+
+if __name__ == '__main__':
+    main()
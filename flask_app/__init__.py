@@ -5,3 +5,85 @@ Initialization file for the main Flask application.
 import os
 
 db_url = os.getenv("DATABASE_URL")
+
+# Comma-separated URLs of the read-only replicas serving the reads of the GET requests, with the maximum replication
+# lag in seconds beyond which a replica is left out, and the interval in seconds between two checks of the lags
+db_replica_urls = [url.strip() for url in os.getenv("DATABASE_REPLICA_URLS", "").split(",") if url.strip()]
+replica_max_lag = float(os.getenv("REPLICA_MAX_LAG", "5"))
+replica_check_interval = float(os.getenv("REPLICA_CHECK_INTERVAL", "5"))
+
+# Connection pool of each database: connections kept open, extra connections under load, time waited for
+# a connection in seconds, age in seconds after which a connection is replaced, and check of the connections on checkout
+db_pool_size = int(os.getenv("DB_POOL_SIZE", "5"))
+db_max_overflow = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+db_pool_timeout = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+db_pool_recycle = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+db_pool_pre_ping = os.getenv("DB_POOL_PRE_PING", "true").lower() in ("1", "true", "yes")
+
+# Maximum number of requests served at once by each process of the ASGI serving mode (SERVER_MODE=asgi),
+# the others being rejected with a 503 status
+async_max_concurrency = int(os.getenv("ASYNC_MAX_CONCURRENCY", "2000"))
+
+# Number of worker processes used to load the CSV file (1 loads it in the main process)
+ingest_workers = int(os.getenv("INGEST_WORKERS", "1"))
+
+# Approximate size in bytes of the byte ranges of the CSV file loaded by each worker
+ingest_chunk_size = int(os.getenv("INGEST_CHUNK_SIZE", str(64 * 1024 * 1024)))
+
+# Time to live in seconds of the cached exact counts of Etablissements
+count_cache_ttl = float(os.getenv("COUNT_CACHE_TTL", "60"))
+
+# Format of the dates of the JSON responses: 'http' (RFC 822, like Flask's jsonify) or 'iso' (ISO 8601)
+json_date_format = os.getenv("JSON_DATE_FORMAT", "http")
+
+# Maximum number of SIRETs and SIRENs of a lookup request
+lookup_max_items = int(os.getenv("LOOKUP_MAX_ITEMS", "1000"))
+
+# Maximum number of Etablissements of a bulk write request, and number of them written per transaction
+bulk_max_items = int(os.getenv("BULK_MAX_ITEMS", "100000"))
+bulk_chunk_size = int(os.getenv("BULK_CHUNK_SIZE", "1000"))
+
+# Audit of the CSV ingest and synchronization: 'batch' (one summary entry per batch), 'row' (one entry per row) or 'off'
+audit_ingest_mode = os.getenv("AUDIT_INGEST_MODE", "batch")
+
+# Number of months of audit history kept, whole months being dropped (0 keeps everything)
+audit_retention_months = int(os.getenv("AUDIT_RETENTION_MONTHS", "12"))
+
+# Read-through cache of the single Etablissement lookups: maximum number of entries (0 disables it), time to live
+# in seconds (300, or 5 for an in-process cache of several workers), and optional Redis URL of a cache shared by all
+# the processes (redis://host:6379/0), which the deployments with several processes should set
+detail_cache_size = int(os.getenv("DETAIL_CACHE_SIZE", "10000"))
+detail_cache_ttl = float(os.getenv("DETAIL_CACHE_TTL")) if os.getenv("DETAIL_CACHE_TTL") else None
+detail_cache_url = os.getenv("DETAIL_CACHE_URL")
+
+# Number of worker processes serving the app, set by gunicorn.conf.py
+web_concurrency = int(os.getenv("WEB_CONCURRENCY", "1"))
+
+# Cache of the list responses: maximum number of responses (0 disables it) and time to live in seconds
+list_cache_size = int(os.getenv("LIST_CACHE_SIZE", "1024"))
+list_cache_ttl = float(os.getenv("LIST_CACHE_TTL", "60"))
+
+# Maximum number of distinct list query shapes recorded by each process for the index advisor, 0 disables the recorder
+query_shapes_size = int(os.getenv("QUERY_SHAPES_SIZE", "0"))
+
+# Token of the admin routes (X-Admin-Token header), which are disabled when it is not set
+admin_token = os.getenv("ADMIN_TOKEN")
+
+# Share of the requests instrumented for /metrics (SQL time and queries, serialization time, response size),
+# between 0 (disabled) and 1 (all of them)
+metrics_sample_rate = float(os.getenv("METRICS_SAMPLE_RATE", "0"))
+
+# Number of executions of the same SQL statement in one request from which it is flagged as N+1 queries
+n_plus_one_threshold = int(os.getenv("N_PLUS_ONE_THRESHOLD", "10"))
+
+# Lock file electing the process that initializes a database other than PostgreSQL (which uses an advisory lock)
+init_lock_file = os.getenv("INIT_LOCK_FILE")
+
+# Load of the CSV file at startup: 'background' (separate process, the app serves during the load), 'sync' (before
+# serving) or 'off' (run `flask ingest load`), the path of the file and the lock file of the load on other databases
+ingest_on_startup = os.getenv("INGEST_ON_STARTUP", "background")
+ingest_csv_path = os.getenv("INGEST_CSV_PATH")
+ingest_lock_file = os.getenv("INGEST_LOCK_FILE")
+
+# Columnar snapshot (written with `flask ingest snapshot`) loaded instead of the CSV file when present
+ingest_snapshot_path = os.getenv("INGEST_SNAPSHOT_PATH")
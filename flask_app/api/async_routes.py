@@ -0,0 +1,389 @@
+"""
+Asynchronous API routes of the Etablissements, served by the ASGI app with SQLAlchemy's asyncio extension.
+They keep the parameters, responses and errors of the routes of the Flask app.
+"""
+
+import math
+
+from quart import abort, Blueprint, current_app, jsonify, request, Response
+from sqlalchemy import func, select
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncSession
+from werkzeug.datastructures import MultiDict
+from werkzeug.exceptions import UnsupportedMediaType
+
+from flask_app.api.counting import COUNT_MODES, planner_estimate
+from flask_app.api.filters import filter_conditions, in_values, parse_filters, parse_sort
+from flask_app.api.ingest_status import ingest_progress, is_ready
+from flask_app.api.list_cache import make_etag
+from flask_app.api.pagination import decode_cursor, encode_cursor, keyset_keys, keyset_segments
+from flask_app.api.routes import DEFAULT_LOOKUP_BATCH_SIZE, DEFAULT_LOOKUP_MAX_ITEMS, etablissement_to_dict, \
+    read_identifiers, sort_clauses, validate_fields
+from flask_app.api.serializers import DEFAULT_DATE_FORMAT, ETABLISSEMENT_FIELDS, dumps, row_serializer
+from flask_app.api.validation import validate_etablissement_changes, validate_new_etablissement
+from flask_app.db.init_db import CSV_FILE_PATH
+from flask_app.db.models import Etablissement
+
+async_api_bp = Blueprint('async_api', __name__)
+
+# Page size used by the page pagination when the requested one is invalid, like Flask-SQLAlchemy
+DEFAULT_PER_PAGE = 20
+
+
+def sessions() -> AsyncSession:
+    """
+    Opens a session on the asyncio engine of the current app.
+    :return: the session, to use as an async context manager.
+    """
+    return current_app.extensions['async_sessionmaker']()
+
+
+def dialect_name() -> str:
+    """
+    Gets the name of the database dialect of the current app.
+    :return: the dialect name, like 'postgresql'.
+    """
+    return current_app.extensions['async_engine'].dialect.name
+
+
+def json_response(payload, status: int = 200) -> Response:
+    """
+    Builds a JSON response with the fast encoder.
+    :param payload: the payload of the response.
+    :param status: the HTTP status code of the response.
+    :return: the response.
+    """
+    return current_app.response_class(dumps(payload) + b'\n', status=status, mimetype='application/json')
+
+
+def serialize_rows(rows, fields: list[str]) -> list[dict]:
+    """
+    Converts rows of values of the given columns into JSON-ready dictionaries, in the date format of the app.
+    :param rows: the rows of a select of the columns.
+    :param fields: the columns of the rows, in order.
+    :return: the list of dictionaries.
+    """
+    serialize = row_serializer(tuple(fields), current_app.config.get('JSON_DATE_FORMAT', DEFAULT_DATE_FORMAT))
+    return [serialize(row) for row in rows]
+
+
+async def read_json():
+    """
+    Reads the JSON body of the request, rejecting other content types like Flask does.
+    :return: the decoded body.
+    """
+    if not request.is_json:
+        raise UnsupportedMediaType("Did not attempt to load JSON data because the request Content-Type was not"
+                                   " 'application/json'.")
+    return await request.get_json()
+
+
+def parse_filters_and_sort(args: MultiDict) -> tuple[dict, list[tuple[str, bool]]]:
+    """
+    Reads the filters and the sort of a list of Etablissements from the query parameters.
+    :param args: the query parameters.
+    :return: the filters by query parameter, and the (field, descending) sort keys.
+    """
+    try:
+        return parse_filters(args), parse_sort(args.get('sort'))
+    except ValueError as e:
+        abort(400, description=str(e))
+
+
+def parse_fields(args: MultiDict) -> list[str] | None:
+    """
+    Reads the columns requested with the 'fields' query parameter (comma-separated), if any.
+    :param args: the query parameters.
+    :return: the requested columns in the requested order, or None to get all of them.
+    """
+    fields = args.get('fields')
+    if not fields:
+        return None
+    return validate_fields(fields.split(','))
+
+
+async def count_etablissements(session: AsyncSession, conditions: list, filter_args: dict, mode: str) -> tuple[int, bool]:
+    """
+    Counts the Etablissements matching the filters, exactly or from the planner estimate on PostgreSQL.
+    :param session: the session of the request.
+    :param conditions: the SQL conditions of the filters.
+    :param filter_args: the filters, by query parameter.
+    :param mode: 'exact' or 'estimate'.
+    :return: the count and whether it is exact.
+    """
+    if mode == 'estimate' and dialect_name() == 'postgresql':
+        statement = select(Etablissement).where(*conditions)
+        estimate = await session.run_sync(
+            lambda sync_session: planner_estimate(sync_session.connection(), statement, filter_args)
+        )
+        if estimate is not None:
+            return estimate, False
+    count = await session.scalar(select(func.count()).select_from(Etablissement).where(*conditions))
+    return count, True
+
+
+@async_api_bp.route("/ready", methods=["GET"])
+async def ready() -> Response:
+    """
+    Tell whether the API can serve the data: the database answers and the snapshot or the CSV file is loaded.
+    :return: a json containing the readiness and the progress of the ingest, with a 503 status until ready.
+    """
+    csv_path = current_app.config.get("INGEST_CSV_PATH") or CSV_FILE_PATH
+    snapshot_path = current_app.config.get("INGEST_SNAPSHOT_PATH")
+    try:
+        async with sessions() as session:
+            status = await session.run_sync(
+                lambda sync_session: ingest_progress(sync_session.connection(), csv_path, snapshot_path))
+    except SQLAlchemyError as e:
+        return json_response({'ready': False, 'error': f"Database unavailable: {e.__class__.__name__}"}, 503)
+    serving = is_ready(status)
+    return json_response({'ready': serving, 'ingest': status}, 200 if serving else 503)
+
+
+@async_api_bp.route("/etablissements", methods=["GET"])
+async def get_etablissements() -> Response:
+    """
+    Get a list of Etablissements with optional filters, sorting, pagination and projection on some fields.
+    The responses carry an ETag, a request with a matching If-None-Match header gets a 304 response.
+    :return: a list of etablissements.
+    """
+    args = request.args
+    page = args.get('page', 1, type=int)
+    per_page = args.get('per_page', 10, type=int)
+
+    filter_args, sort_keys = parse_filters_and_sort(args)
+    fields = parse_fields(args)
+    conditions = filter_conditions(Etablissement.__table__.c, filter_args, dialect_name()) if filter_args else []
+
+    count = args.get('count')
+    if count is not None and count not in COUNT_MODES:
+        abort(400, description=f"Invalid count mode: {count}")
+
+    output_fields = fields or ETABLISSEMENT_FIELDS
+    async with sessions() as session:
+        if 'cursor' in args:
+            result = await get_etablissements_after_cursor(session, conditions, filter_args, sort_keys,
+                                                           args['cursor'], per_page, count, output_fields)
+        else:
+            # Invalid pages and page sizes are replaced like Flask-SQLAlchemy's paginate does
+            offset_page = page if page >= 1 else 1
+            limit = per_page if per_page >= 1 else DEFAULT_PER_PAGE
+            statement = select(*[getattr(Etablissement, field) for field in output_fields]).where(*conditions)
+            if sort_keys:
+                statement = statement.order_by(*sort_clauses(sort_keys))
+            rows = (await session.execute(statement.limit(limit).offset((offset_page - 1) * limit))).all()
+            total, exact = await count_etablissements(session, conditions, filter_args, count or 'exact')
+            result = {
+                'total': total,
+                'total_type': 'exact' if exact else 'estimate',
+                'pages': math.ceil(total / limit) if total else 0,
+                'page': page,
+                'per_page': per_page,
+                'items': serialize_rows(rows, output_fields)
+            }
+
+    response = json_response(result)
+    etag = make_etag(await response.get_data())
+    if request.if_none_match.contains(etag):
+        response = current_app.response_class(status=304)
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    return response
+
+
+async def get_etablissements_after_cursor(session: AsyncSession, conditions: list, filter_args: dict,
+                                          sort_keys: list[tuple[str, bool]], cursor: str, per_page: int,
+                                          count: str | None, output_fields: list[str]) -> dict:
+    """
+    Get a page of Etablissements with keyset pagination: the page starts after the row encoded in the cursor.
+    :param session: the session of the request.
+    :param conditions: the SQL conditions of the filters.
+    :param filter_args: the filters, by query parameter.
+    :param sort_keys: the requested (field, descending) sort keys.
+    :param cursor: the cursor returned with the previous page, or an empty string for the first page.
+    :param per_page: the number of items per page.
+    :param count: 'exact' or 'estimate' to count the total number of matching Etablissements.
+    :param output_fields: the columns to return.
+    :return: the page, with the cursor of the next page (None on the last page).
+    """
+    if per_page < 1:
+        abort(400, description="Invalid per_page: must be at least 1")
+
+    keys = keyset_keys(sort_keys)
+    values = None
+    if cursor:
+        try:
+            values = decode_cursor(Etablissement, keys, cursor)
+        except ValueError as e:
+            abort(400, description=f"Invalid cursor: {e}")
+
+    # The sort keys are selected after the returned columns, to build the cursor
+    selected_fields = output_fields + [field for field, _ in keys if field not in output_fields]
+    statement = select(*[getattr(Etablissement, field) for field in selected_fields]).where(*conditions)
+
+    # Fetch one more row to know whether there is a next page, from the next segments when a segment runs out
+    rows = []
+    for segment_conditions, order_by in keyset_segments(Etablissement, keys, values):
+        rows += (await session.execute(
+            statement.where(*segment_conditions).order_by(*order_by).limit(per_page + 1 - len(rows))
+        )).all()
+        if len(rows) > per_page:
+            break
+    next_cursor = encode_cursor(keys, rows[per_page - 1]._mapping) if len(rows) > per_page else None
+
+    result = {
+        'per_page': per_page,
+        'next_cursor': next_cursor,
+        'items': serialize_rows(rows[:per_page], output_fields)
+    }
+    if count is not None:
+        result['total'], exact = await count_etablissements(session, conditions, filter_args, count)
+        result['total_type'] = 'exact' if exact else 'estimate'
+    return result
+
+
+@async_api_bp.route("/etablissements/lookup", methods=["POST"])
+async def lookup_etablissements() -> Response:
+    """
+    Get many Etablissements at once by SIRET and/or SIREN, with one query per batch of identifiers.
+    The body is a json object with the lists 'sirets' and 'sirens', and optionally the list of 'fields' to return.
+    :return: a json containing the found etablissements and the identifiers that matched nothing.
+    """
+    data = await request.get_json(silent=True)
+    if not isinstance(data, dict):
+        abort(400, description="No input data provided")
+
+    sirets = read_identifiers(data, 'sirets')
+    sirens = read_identifiers(data, 'sirens')
+    max_items = current_app.config.get('LOOKUP_MAX_ITEMS', DEFAULT_LOOKUP_MAX_ITEMS)
+    if not sirets and not sirens:
+        abort(400, description="No sirets or sirens provided")
+    if len(sirets) + len(sirens) > max_items:
+        abort(400, description=f"Too many identifiers: at most {max_items} per request")
+
+    fields = data.get('fields') or parse_fields(request.args)
+    if fields is not None and not isinstance(fields, list):
+        abort(400, description="'fields' must be a list of field names")
+    output_fields = validate_fields(fields) if fields else ETABLISSEMENT_FIELDS
+    # The identifiers are selected after the returned columns, to find the misses
+    selected_fields = output_fields + [field for field in ('siret', 'siren') if field not in output_fields]
+    columns = [getattr(Etablissement, field) for field in selected_fields]
+    siret_index = selected_fields.index('siret')
+    siren_index = selected_fields.index('siren')
+
+    batch_size = current_app.config.get('LOOKUP_BATCH_SIZE', DEFAULT_LOOKUP_BATCH_SIZE)
+    rows_by_siret = {}
+    async with sessions() as session:
+        for column, values in ((Etablissement.siret, sirets), (Etablissement.siren, sirens)):
+            for start in range(0, len(values), batch_size):
+                statement = select(*columns).where(in_values(column, values[start:start + batch_size], dialect_name()))
+                if column is Etablissement.siren:
+                    statement = statement.order_by(Etablissement.siret)
+                for row in await session.execute(statement):
+                    rows_by_siret.setdefault(row[siret_index], row)
+
+    found_sirens = {row[siren_index] for row in rows_by_siret.values()}
+    return json_response({
+        'items': serialize_rows(list(rows_by_siret.values()), output_fields),
+        'missing': {
+            'sirets': [siret for siret in sirets if siret not in rows_by_siret],
+            'sirens': [siren for siren in sirens if siren not in found_sirens],
+        }
+    })
+
+
+@async_api_bp.route("/etablissements/<string:siret>", methods=["GET"])
+async def get_etablissement(siret: str) -> Response:
+    """
+    Get an Etablissement by SIRET.
+    Only the columns listed in the 'fields' query parameter are returned, if given.
+    :param siret: the siret number of the etablissement to retrieve.
+    :return: a json containing the wanted etablissement.
+    """
+    fields = parse_fields(request.args) or ETABLISSEMENT_FIELDS
+    async with sessions() as session:
+        row = (await session.execute(
+            select(*[getattr(Etablissement, field) for field in fields]).where(Etablissement.siret == siret)
+        )).first()
+    if row is None:
+        abort(404, description="Etablissement not found")
+    return json_response(serialize_rows([row], fields)[0])
+
+
+@async_api_bp.route("/etablissements", methods=["POST"])
+async def create_etablissement() -> (Response, int):
+    """
+    Create a new Etablissement. The fields 'siret', 'siren' and 'nic' are required.
+    :return: a json containing the created etablissement or an error message.
+    """
+    try:
+        data = validate_new_etablissement(await read_json())
+    except ValueError as e:
+        abort(400, description=str(e))
+
+    async with sessions() as session:
+        # Check if Etablissement with the same SIRET already exists
+        if await session.get(Etablissement, data['siret']) is not None:
+            abort(400, description="Etablissement with this SIRET already exists")
+
+        etablissement = Etablissement(**data)
+        try:
+            session.add(etablissement)
+            await session.commit()
+        except Exception as e:
+            await session.rollback()
+            abort(400, description=f"Error creating Etablissement: {e}")
+
+    return jsonify(etablissement_to_dict(etablissement)), 201
+
+
+@async_api_bp.route("/etablissements/<string:siret>", methods=["PUT"])
+async def update_etablissement(siret: str) -> Response:
+    """
+    Update an existing Etablissement.
+    - Allows modification of fields except for 'siret', 'siren', and 'nic'.
+    :param siret: the siret number of the etablissment to update.
+    :return: a json containing the updated etablissement or an error message.
+    """
+    async with sessions() as session:
+        etablissement = await session.get(Etablissement, siret)
+        if etablissement is None:
+            abort(404, description="Etablissement not found")
+
+        try:
+            data = validate_etablissement_changes(await read_json())
+        except ValueError as e:
+            abort(400, description=str(e))
+
+        for key, value in data.items():
+            setattr(etablissement, key, value)
+
+        try:
+            await session.commit()
+        except Exception as e:
+            await session.rollback()
+            abort(400, description=f"Error updating Etablissement: {e}")
+
+    return jsonify(etablissement_to_dict(etablissement))
+
+
+@async_api_bp.route("/etablissements/<string:siret>", methods=["DELETE"])
+async def delete_etablissement(siret: str) -> Response:
+    """
+    Delete an Etablissement by giving the siret number of the Etablissement to delete.
+    :param siret: the siret number of the etablissment to delete.
+    :return: a message confirming the deletion or an error message.
+    """
+    async with sessions() as session:
+        etablissement = await session.get(Etablissement, siret)
+        if etablissement is None:
+            abort(404, description="Etablissement not found")
+
+        try:
+            await session.delete(etablissement)
+            await session.commit()
+        except Exception as e:
+            await session.rollback()
+            abort(400, description=f"Error deleting Etablissement: {e}")
+
+    return jsonify({"message": "Etablissement deleted"})
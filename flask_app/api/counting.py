@@ -0,0 +1,140 @@
+"""
+Exact and estimated counts of Etablissements.
+"""
+
+import json
+
+from flask import current_app, has_app_context
+from sqlalchemy import text
+from sqlalchemy.engine import Connection
+
+from flask_app.api.list_cache import table_version
+from flask_app.cache import MISSING, TTLCache
+from flask_app.db import db
+from flask_app.db.events import etablissements_changed
+from flask_app.db.models import Etablissement
+
+# Default time to live of the cached exact counts, in seconds
+DEFAULT_COUNT_CACHE_TTL = 60.0
+
+# Maximum number of filter sets whose exact count is cached
+COUNT_CACHE_SIZE = 1024
+
+COUNT_MODES = ('exact', 'estimate')
+
+
+def get_count_cache() -> TTLCache:
+    """
+    Gets the cache of exact counts of the current Flask app, creating it on first use.
+    :return: the cache of exact counts.
+    """
+    extensions = current_app.extensions
+    if 'count_cache' not in extensions:
+        extensions.setdefault(
+            'count_cache',
+            TTLCache(max_size=COUNT_CACHE_SIZE,
+                     ttl=current_app.config.get('COUNT_CACHE_TTL', DEFAULT_COUNT_CACHE_TTL))
+        )
+        extensions.setdefault('count_cache_generation', 0)
+    return extensions['count_cache']
+
+
+@etablissements_changed.connect
+def invalidate_counts(sender, **kwargs) -> None:
+    """
+    Drops the cached counts when Etablissements are inserted, updated or deleted by this process, the counts
+    of the older versions of the table being useless.
+    :param sender: the name of the writer.
+    :return: None
+    """
+    if has_app_context():
+        cache = get_count_cache()
+        # Counts computed before this invalidation must not be cached after it
+        current_app.extensions['count_cache_generation'] += 1
+        cache.clear()
+
+
+def filters_key(filters: dict) -> tuple:
+    """
+    Normalizes a set of filters into a cache key, whatever the order of the query parameters.
+    :param filters: the filters of the query, by query parameter.
+    :return: the cache key.
+    """
+    return tuple(sorted((field, str(value)) for field, value in filters.items()))
+
+
+def exact_count(query, filters: dict) -> int:
+    """
+    Counts the Etablissements matching a query, caching the result per filter set and version of the table,
+    so that the writes of the other processes (workers, ingest, synchronization) are counted at once.
+    :param query: the filtered query of the Etablissements.
+    :param filters: the filters of the query, by query parameter.
+    :return: the exact count.
+    """
+    cache = get_count_cache()
+    key = (table_version(), filters_key(filters))
+    count = cache.get(key)
+    if count is MISSING:
+        generation = current_app.extensions['count_cache_generation']
+        count = query.order_by(None).count()
+        if current_app.extensions['count_cache_generation'] == generation:
+            cache.set(key, count)
+    return count
+
+
+def estimate_count(query, filters: dict) -> int | None:
+    """
+    Estimates the number of Etablissements matching a query from the PostgreSQL planner statistics:
+    pg_class.reltuples without filters, the row estimate of EXPLAIN otherwise.
+    :param query: the filtered query of the Etablissements.
+    :param filters: the filters of the query, by query parameter.
+    :return: the estimated count, or None if the database cannot estimate it.
+    """
+    if db.engine.dialect.name != 'postgresql':
+        return None
+    return planner_estimate(db.session.connection(), query.order_by(None).statement, filters)
+
+
+def planner_estimate(connection: Connection, statement, filters: dict) -> int | None:
+    """
+    Estimates the number of rows of a statement on the Etablissements from the PostgreSQL planner statistics.
+    :param connection: an open connection to the database.
+    :param statement: the filtered select of the Etablissements, without ordering.
+    :param filters: the filters of the statement, by query parameter.
+    :return: the estimated count, or None if the database cannot estimate it.
+    """
+    if connection.dialect.name != 'postgresql':
+        return None
+
+    if not filters:
+        reltuples = connection.execute(
+            text("SELECT reltuples FROM pg_class WHERE oid = CAST(:table AS regclass)"),
+            {'table': Etablissement.__tablename__}
+        ).scalar()
+        # reltuples is negative until the table is vacuumed or analyzed for the first time
+        return int(reltuples) if reltuples is not None and reltuples >= 0 else None
+
+    compiled = statement.compile(dialect=connection.dialect)
+    # Drivers with positional placeholders (asyncpg) take the parameters in order
+    params = tuple(compiled.params[name] for name in compiled.positiontup) if compiled.positional else compiled.params
+    plan = connection.exec_driver_sql(f"EXPLAIN (FORMAT JSON) {compiled}", params).scalar()
+    # psycopg2 decodes the json column, asyncpg returns its text
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+def count_etablissements(query, filters: dict, mode: str = 'exact') -> tuple[int, bool]:
+    """
+    Counts the Etablissements matching a query, exactly or from an estimate.
+    Falls back to the exact count when the database cannot estimate it.
+    :param query: the filtered query of the Etablissements.
+    :param filters: the filters of the query, by query parameter.
+    :param mode: 'exact' or 'estimate'.
+    :return: the count and whether it is exact.
+    """
+    if mode == 'estimate':
+        estimate = estimate_count(query, filters)
+        if estimate is not None:
+            return estimate, False
+    return exact_count(query, filters), True
@@ -0,0 +1,111 @@
+"""
+Read-through cache of the single Etablissement lookups.
+"""
+
+from typing import Callable
+
+from flask import current_app, has_app_context
+
+from flask_app.api.serializers import DATE_FORMATS, get_date_format
+from flask_app.cache import MISSING, RedisCache, TTLCache
+from flask_app.db.events import etablissements_changed
+
+# Default maximum number of Etablissements kept in the in-process cache, 0 disables it
+DEFAULT_DETAIL_CACHE_SIZE = 10000
+
+# Default time to live of the cached Etablissements, in seconds
+DEFAULT_DETAIL_CACHE_TTL = 300.0
+
+# Default time to live of the in-process cache when several workers serve the app, in seconds. A process only drops
+# the entries written through it, so it bounds the staleness of the entries written by the other workers. A cache
+# shared in Redis (DETAIL_CACHE_URL) is dropped by the writes of every process, the CLI commands included.
+DEFAULT_MULTI_PROCESS_DETAIL_CACHE_TTL = 5.0
+
+
+def get_detail_cache() -> TTLCache | RedisCache | None:
+    """
+    Gets the cache of Etablissements of the current Flask app, creating it on first use: shared in Redis
+    when DETAIL_CACHE_URL is set, in-process otherwise, with a short time to live by default when several
+    workers serve the app.
+    :return: the cache, or None if it is disabled.
+    """
+    extensions = current_app.extensions
+    if 'detail_cache' not in extensions:
+        size = current_app.config.get('DETAIL_CACHE_SIZE', DEFAULT_DETAIL_CACHE_SIZE)
+        url = current_app.config.get('DETAIL_CACHE_URL')
+        ttl = current_app.config.get('DETAIL_CACHE_TTL')
+        if ttl is None:
+            shared = url or current_app.config.get('WEB_CONCURRENCY', 1) <= 1
+            ttl = DEFAULT_DETAIL_CACHE_TTL if shared else DEFAULT_MULTI_PROCESS_DETAIL_CACHE_TTL
+        if url:
+            cache = RedisCache(url, prefix='etablissement', ttl=ttl)
+        else:
+            cache = TTLCache(max_size=size, ttl=ttl) if size > 0 else None
+        extensions.setdefault('detail_cache', cache)
+        extensions.setdefault('detail_cache_generation', 0)
+    return extensions['detail_cache']
+
+
+def _cache_key(siret: str, date_format: str) -> str:
+    """
+    Builds the cache key of an Etablissement, the cached values depending on the date format.
+    :param siret: the SIRET of the Etablissement.
+    :param date_format: the date format of the cached value.
+    :return: the cache key.
+    """
+    return f"{date_format}:{siret}"
+
+
+@etablissements_changed.connect
+def invalidate_etablissements(sender, sirets: set[str] | None = None, **kwargs) -> None:
+    """
+    Drops the cached Etablissements that were inserted, updated or deleted, or all of them when the
+    changed SIRETs are unknown.
+    :param sender: the name of the writer.
+    :param sirets: the SIRETs of the changed rows, or None if they are unknown.
+    :return: None
+    """
+    if not has_app_context():
+        return
+    cache = get_detail_cache()
+    if cache is None:
+        return
+
+    # Values read before this invalidation must not be cached after it
+    current_app.extensions['detail_cache_generation'] += 1
+    if sirets is None:
+        cache.clear()
+        return
+    for siret in sirets:
+        for date_format in DATE_FORMATS:
+            cache.delete(_cache_key(siret, date_format))
+
+
+def cached_etablissement(siret: str, load: Callable[[list[str] | None], dict | None],
+                         fields: list[str] | None = None) -> dict | None:
+    """
+    Gets a serialized Etablissement from the cache, loading and caching it on a miss.
+    Missing Etablissements are not cached. A projection on some fields is taken from a cached Etablissement,
+    and otherwise loaded alone from the database, without caching the partial Etablissement.
+    :param siret: the SIRET of the Etablissement.
+    :param load: the function reading the given columns (all of them with None) of the serialized Etablissement
+    from the database, None if it does not exist.
+    :param fields: the columns to return, or None to get all of them.
+    :return: the serialized Etablissement, or None if it does not exist.
+    """
+    cache = get_detail_cache()
+    if cache is None:
+        return load(fields)
+
+    key = _cache_key(siret, get_date_format())
+    item = cache.get(key)
+    if item is not MISSING:
+        return {field: item[field] for field in fields} if fields else item
+    if fields:
+        return load(fields)
+
+    generation = current_app.extensions['detail_cache_generation']
+    item = load(None)
+    if item is not None and current_app.extensions['detail_cache_generation'] == generation:
+        cache.set(key, item)
+    return item
@@ -0,0 +1,186 @@
+"""
+Filters and sort of the lists of Etablissements. Filters are equality, ranges, prefixes, sets of values
+and NULL checks, written as query parameters like 'date_creation__gte=2020-01-01' or 'code_postal__prefix=75'.
+"""
+
+from datetime import date, datetime
+
+from sqlalchemy import and_, any_, bindparam
+from sqlalchemy.dialects import postgresql
+
+from flask_app.api.serializers import ETABLISSEMENT_COLUMN_TYPES, ETABLISSEMENT_FIELD_SET
+
+# Separator between the field and the operator of a filter
+OPERATOR_SEPARATOR = '__'
+
+FILTER_OPERATORS = ('eq', 'gt', 'gte', 'lt', 'lte', 'prefix', 'in', 'is_null')
+
+_TRUE_VALUES = ('true', '1', 'yes')
+_FALSE_VALUES = ('false', '0', 'no')
+
+_LIKE_ESCAPE = '\\'
+
+
+def split_filter(name: str) -> tuple[str, str] | None:
+    """
+    Splits the name of a query parameter into the filtered field and the operator.
+    :param name: the name of the query parameter, like 'code_postal' or 'code_postal__prefix'.
+    :return: the field and the operator, or None if the parameter does not filter a field.
+    :raise ValueError: if the operator of a field is unknown.
+    """
+    field, separator, operator = name.partition(OPERATOR_SEPARATOR)
+    if field not in ETABLISSEMENT_FIELD_SET:
+        return None
+    if not separator:
+        return field, 'eq'
+    if operator not in FILTER_OPERATORS:
+        raise ValueError(f"Invalid filter operator: {name}")
+    return field, operator
+
+
+def parse_bool(name: str, value: str) -> bool:
+    """
+    Parses a boolean query parameter.
+    :param name: the name of the query parameter.
+    :param value: the value of the query parameter.
+    :return: the boolean.
+    :raise ValueError: if the value is not a boolean.
+    """
+    if value.lower() in _TRUE_VALUES:
+        return True
+    if value.lower() in _FALSE_VALUES:
+        return False
+    raise ValueError(f"Invalid boolean for '{name}': {value}")
+
+
+def parse_value(name: str, field: str, value: str):
+    """
+    Converts the value of a filter to the type of the filtered column.
+    :param name: the name of the query parameter.
+    :param field: the filtered field.
+    :param value: the value of the query parameter.
+    :return: the converted value.
+    :raise ValueError: if the value does not match the type of the column.
+    """
+    column_type = ETABLISSEMENT_COLUMN_TYPES[field]
+    try:
+        if column_type is date:
+            return datetime.strptime(value, '%Y-%m-%d').date()
+        if column_type is datetime:
+            return datetime.fromisoformat(value)
+        if column_type is int:
+            return int(value)
+    except ValueError as e:
+        raise ValueError(f"Invalid value for '{name}': {e}") from e
+    if column_type is bool:
+        return parse_bool(name, value)
+    return value
+
+
+def parse_filters(args) -> dict:
+    """
+    Reads the filters of a list of Etablissements from query parameters. Parameters that do not name a field
+    are ignored, as well as filters without value.
+    :param args: the query parameters.
+    :return: the converted values by query parameter name, a list of values for the 'in' operator
+    and a boolean for 'is_null'.
+    :raise ValueError: if an operator is unknown or a value does not match its column.
+    """
+    filters = {}
+    for name, value in args.items():
+        parsed = split_filter(name)
+        if parsed is None or not value:
+            continue
+        field, operator = parsed
+        if operator == 'prefix' and ETABLISSEMENT_COLUMN_TYPES[field] is not str:
+            raise ValueError(f"Invalid filter operator: {name}, prefixes only filter text fields")
+
+        if operator == 'is_null':
+            filters[name] = parse_bool(name, value)
+        elif operator == 'in':
+            filters[name] = [parse_value(name, field, item.strip()) for item in value.split(',') if item.strip()]
+        else:
+            filters[name] = parse_value(name, field, value)
+    return filters
+
+
+def in_values(column, values: list, dialect_name: str):
+    """
+    Builds the condition of a column matching one of several values, as a single array parameter on PostgreSQL
+    (column = ANY(:values)), so that the statement is the same whatever the number of values.
+    :param column: the compared column.
+    :param values: the accepted values.
+    :param dialect_name: the name of the database dialect.
+    :return: the SQL condition.
+    """
+    if dialect_name == 'postgresql':
+        return column == any_(bindparam(None, values, type_=postgresql.ARRAY(column.type)))
+    return column.in_(values)
+
+
+def prefix_condition(column, prefix: str, dialect_name: str):
+    """
+    Builds the condition of a text column starting with a prefix, in a form an index can serve.
+    On PostgreSQL, a LIKE 'prefix%' served by the varchar_pattern_ops indexes, the ordinary indexes
+    following the collation of the database. Elsewhere, the range prefix <= column < next prefix,
+    served by the ordinary indexes that compare strings code point by code point.
+    :param column: the filtered column.
+    :param prefix: the prefix.
+    :param dialect_name: the name of the database dialect.
+    :return: the SQL condition.
+    """
+    if dialect_name == 'postgresql' or ord(prefix[-1]) == 0x10FFFF:
+        escaped = prefix.replace(_LIKE_ESCAPE, _LIKE_ESCAPE * 2).replace('%', r'\%').replace('_', r'\_')
+        return column.like(f"{escaped}%", escape=_LIKE_ESCAPE)
+    return and_(column >= prefix, column < prefix[:-1] + chr(ord(prefix[-1]) + 1))
+
+
+def filter_conditions(columns, filters: dict, dialect_name: str) -> list:
+    """
+    Builds the WHERE conditions of filters.
+    :param columns: the columns of the Etablissement table.
+    :param filters: the filters read by parse_filters.
+    :param dialect_name: the name of the database dialect.
+    :return: the list of SQL conditions.
+    """
+    conditions = []
+    for name, value in filters.items():
+        field, operator = split_filter(name)
+        column = columns[field]
+        if operator == 'eq':
+            conditions.append(column == value)
+        elif operator == 'gt':
+            conditions.append(column > value)
+        elif operator == 'gte':
+            conditions.append(column >= value)
+        elif operator == 'lt':
+            conditions.append(column < value)
+        elif operator == 'lte':
+            conditions.append(column <= value)
+        elif operator == 'prefix':
+            conditions.append(prefix_condition(column, value, dialect_name))
+        elif operator == 'in':
+            conditions.append(in_values(column, value, dialect_name))
+        elif operator == 'is_null':
+            conditions.append(column.is_(None) if value else column.is_not(None))
+    return conditions
+
+
+def parse_sort(sort: str | None) -> list[tuple[str, bool]]:
+    """
+    Reads the sort of a list of Etablissements: comma-separated fields, descending when prefixed with '-'.
+    :param sort: the value of the 'sort' query parameter, if any.
+    :return: the (field, descending) sort keys.
+    :raise ValueError: if a field is unknown.
+    """
+    sort_keys = []
+    if sort:
+        for field in sort.split(','):
+            desc = False
+            if field.startswith('-'):
+                desc = True
+                field = field[1:]
+            if field not in ETABLISSEMENT_FIELD_SET:
+                raise ValueError(f"Invalid sort field: {field}")
+            sort_keys.append((field, desc))
+    return sort_keys
@@ -0,0 +1,117 @@
+"""
+Progress of the ingest of the CSV file or of the snapshot, read from its checkpoints, and readiness of the API.
+"""
+
+import os
+import time
+
+from flask import current_app
+from sqlalchemy import select
+from sqlalchemy.engine import Connection
+
+from flask_app.db.checkpoints import file_identity, has_incomplete_checkpoints, load_checkpoints
+from flask_app.db.models import Etablissement
+from flask_app.db.snapshot import MANIFEST_FILE, pyarrow, read_manifest, snapshot_files
+
+
+def table_loaded(connection: Connection) -> bool:
+    """
+    Tells whether the Etablissement table holds data loaded by a finished ingest: it has rows and no load of any file
+    is left unfinished, since the rows of an interrupted or running load are not the whole file.
+    :param connection: an open connection to the database.
+    :return: True if the table was loaded.
+    """
+    if connection.execute(select(Etablissement.siret).limit(1)).first() is None:
+        return False
+    return not has_incomplete_checkpoints(connection)
+
+
+def is_ready(status: dict) -> bool:
+    """
+    Tells whether the data can be served.
+    :param status: the progress of the ingest, as returned by ingest_progress.
+    :return: True if the load of the file is completed, or without file if the table was loaded before.
+    """
+    return status['state'] == 'completed' or (status['state'] == 'no_source' and status['table_loaded'])
+
+
+def loads_snapshot(snapshot_path: str | None) -> bool:
+    """
+    Tells whether the ingest loads a snapshot instead of the CSV file, like load_data_from_snapshot does.
+    :param snapshot_path: the INGEST_SNAPSHOT_PATH of the app, if any.
+    :return: True if the directory holds the manifest of a snapshot and pyarrow can read it.
+    """
+    return bool(snapshot_path) and pyarrow is not None and os.path.exists(os.path.join(snapshot_path, MANIFEST_FILE))
+
+
+def ingest_progress(connection: Connection, csv_path: str, snapshot_path: str | None = None) -> dict:
+    """
+    Reads the progress of the load of the snapshot, or else of the CSV file, from its checkpoints.
+    :param connection: an open connection to the database.
+    :param csv_path: the path of the CSV file.
+    :param snapshot_path: the directory of the snapshot loaded instead of the CSV file when it holds a manifest.
+    :return: the state of the ingest ('no_source' without file, 'pending' before the load, 'loading' or 'completed'),
+    with the rows loaded, the offsets loaded ('bytes_loaded' and 'bytes_total', counting the bytes of the CSV file
+    or the rows of the snapshot files, as told by 'unit') and the number of ranges loaded by the checkpoints,
+    one per snapshot file. Without file, 'table_loaded' tells whether the table was loaded by a finished ingest.
+    """
+    if loads_snapshot(snapshot_path):
+        status = {'state': 'pending', 'source': snapshot_path, 'unit': 'rows', 'rows_loaded': 0, 'bytes_loaded': 0,
+                  'bytes_total': read_manifest(snapshot_path)['rows'], 'ranges': 0, 'ranges_completed': 0,
+                  'updated_at': None}
+        checkpoints = [checkpoint for file_path in snapshot_files(snapshot_path)
+                       for checkpoint in load_checkpoints(connection, file_identity(file_path))]
+    else:
+        status = {'state': 'no_source', 'source': csv_path, 'unit': 'bytes', 'rows_loaded': 0, 'bytes_loaded': 0,
+                  'bytes_total': None, 'ranges': 0, 'ranges_completed': 0, 'updated_at': None}
+        if not os.path.exists(csv_path):
+            status['table_loaded'] = table_loaded(connection)
+            return status
+        identity = file_identity(csv_path)
+        status['bytes_total'] = identity['source_size']
+        checkpoints = load_checkpoints(connection, identity)
+
+    if not checkpoints:
+        # A table filled without checkpoints of these files is not loaded from them, nor loaded again
+        status['state'] = 'completed' if table_loaded(connection) else 'pending'
+        return status
+
+    status.update(
+        state='completed' if all(checkpoint['completed'] for checkpoint in checkpoints) else 'loading',
+        rows_loaded=sum(checkpoint['rows_loaded'] for checkpoint in checkpoints),
+        bytes_loaded=sum(checkpoint['byte_offset'] - checkpoint['range_start'] for checkpoint in checkpoints),
+        bytes_total=sum(checkpoint['range_end'] - checkpoint['range_start'] for checkpoint in checkpoints),
+        ranges=len(checkpoints),
+        ranges_completed=sum(1 for checkpoint in checkpoints if checkpoint['completed']),
+        updated_at=max(checkpoint['updated_at'] for checkpoint in checkpoints).isoformat(),
+    )
+    return status
+
+
+def add_rate(status: dict) -> dict:
+    """
+    Adds the load rate and the estimated time left to the progress of a load. The rate is measured since
+    the first status read by this process during the load, the checkpoints not recording when it started.
+    :param status: the progress of the load.
+    :return: the progress, with the rows loaded per second and the seconds left (None until measured).
+    """
+    status['rows_per_second'] = None
+    status['eta_seconds'] = None
+    if status['state'] != 'loading':
+        current_app.extensions.pop('ingest_first_sample', None)
+        return status
+
+    now = time.monotonic()
+    first = current_app.extensions.get('ingest_first_sample')
+    if first is None or first['source'] != status['source'] or first['bytes'] > status['bytes_loaded']:
+        current_app.extensions['ingest_first_sample'] = {'source': status['source'], 'time': now,
+                                                         'rows': status['rows_loaded'],
+                                                         'bytes': status['bytes_loaded']}
+        return status
+
+    elapsed = now - first['time']
+    if elapsed > 0 and status['bytes_loaded'] > first['bytes']:
+        status['rows_per_second'] = round((status['rows_loaded'] - first['rows']) / elapsed, 1)
+        bytes_per_second = (status['bytes_loaded'] - first['bytes']) / elapsed
+        status['eta_seconds'] = round((status['bytes_total'] - status['bytes_loaded']) / bytes_per_second, 1)
+    return status
@@ -0,0 +1,104 @@
+"""
+Cache of the list responses, with strong ETags, validated by the version of the Etablissement table.
+"""
+
+import hashlib
+
+from typing import Callable
+
+from flask import current_app, g, has_app_context, request, Response
+
+from flask_app.cache import MISSING, TTLCache
+from flask_app.db import db
+from flask_app.db.events import etablissements_changed, etablissements_version
+
+# Default maximum number of list responses cached, 0 disables the cache
+DEFAULT_LIST_CACHE_SIZE = 1024
+
+# Default time to live of the cached list responses, in seconds
+DEFAULT_LIST_CACHE_TTL = 60.0
+
+
+def get_list_cache() -> TTLCache | None:
+    """
+    Gets the cache of list responses of the current Flask app, creating it on first use.
+    :return: the cache, or None if it is disabled.
+    """
+    extensions = current_app.extensions
+    if 'list_cache' not in extensions:
+        size = current_app.config.get('LIST_CACHE_SIZE', DEFAULT_LIST_CACHE_SIZE)
+        ttl = current_app.config.get('LIST_CACHE_TTL', DEFAULT_LIST_CACHE_TTL)
+        extensions.setdefault('list_cache', TTLCache(max_size=size, ttl=ttl) if size > 0 else None)
+    return extensions['list_cache']
+
+
+def table_version() -> int:
+    """
+    Gets the version of the Etablissement table, bumped by every transaction writing it, whatever its process:
+    the API workers, the ingest and the synchronization. It is read once per request, for the list response
+    and its count.
+    :return: the version.
+    """
+    if 'etablissements_version' not in g:
+        g.etablissements_version = etablissements_version(db.session)
+    return g.etablissements_version
+
+
+@etablissements_changed.connect
+def forget_table_version(sender, **kwargs) -> None:
+    """
+    Drops the version read by the current request or app context when it writes Etablissements.
+    :param sender: the name of the writer.
+    :return: None
+    """
+    if has_app_context():
+        g.pop('etablissements_version', None)
+
+
+def canonical_key() -> tuple:
+    """
+    Builds the cache key of the current request from its path and its query parameters,
+    whatever the order of the parameters.
+    :return: the cache key.
+    """
+    return request.path, tuple(sorted(request.args.items(multi=True)))
+
+
+def make_etag(body: bytes) -> str:
+    """
+    Computes the strong entity tag of a response body.
+    :param body: the body of the response.
+    :return: the entity tag, without quotes.
+    """
+    return hashlib.blake2b(body, digest_size=16).hexdigest()
+
+
+def cached_list_response(build: Callable[[], Response]) -> Response:
+    """
+    Serves a list response from the cache while the table version is unchanged, building it otherwise.
+    The response carries a strong ETag and becomes a 304 when it matches the If-None-Match header,
+    so a client polling unchanged data does not get the body again, and a cached one does not hit the database.
+    :param build: the function building the JSON response of the request.
+    :return: the response.
+    """
+    cache = get_list_cache()
+    key = canonical_key()
+    version = table_version()
+
+    entry = cache.get(key) if cache is not None else MISSING
+    if entry is not MISSING and entry[0] == version:
+        _, etag, body = entry
+    else:
+        response = build()
+        if response.status_code != 200:
+            return response
+        body = response.get_data()
+        etag = make_etag(body)
+        if cache is not None:
+            cache.set(key, (version, etag, body))
+
+    response = current_app.response_class(body, mimetype='application/json')
+    response.set_etag(etag)
+    # Clients may keep the response, but must check with the ETag that it is still current
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
@@ -0,0 +1,200 @@
+"""
+Keyset (cursor) pagination helpers.
+"""
+
+import base64
+import binascii
+import datetime
+import json
+
+from sqlalchemy import literal, tuple_
+from sqlalchemy.orm import InstrumentedAttribute
+
+# Column used to break ties between rows with the same sort values
+TIE_BREAKER = 'siret'
+
+
+def keyset_keys(sort_keys: list[tuple[str, bool]]) -> list[tuple[str, bool]]:
+    """
+    Completes the requested sort with the tie-breaker, so that the order of the rows is total. The tie-breaker
+    follows the direction of the last requested key, so that a sort in a single direction reads an index
+    ending with the tie-breaker forwards or backwards.
+    :param sort_keys: the requested (field, descending) sort keys.
+    :return: the sort keys of the pagination, ending with the tie-breaker.
+    """
+    keys = []
+    for field, desc in sort_keys:
+        keys.append((field, desc))
+        if field == TIE_BREAKER:
+            return keys
+    return keys + [(TIE_BREAKER, keys[-1][1] if keys else False)]
+
+
+def _nullable(model, field: str) -> bool:
+    """
+    Tells whether a sort key can be NULL.
+    :param model: the model class of the paginated rows.
+    :param field: the name of the column.
+    :return: True if the column is nullable.
+    """
+    return model.__table__.c[field].nullable
+
+
+def keyset_order_by(model, keys: list[tuple[str, bool]], not_null: tuple[str, ...] = ()) -> list:
+    """
+    Builds the ORDER BY clauses of the pagination. NULL values of the nullable columns are placed last
+    in both directions, on every database, so that the cursor segments match the order. The columns which
+    cannot be NULL are ordered without NULLS LAST, which would keep a descending order from reading an index.
+    :param model: the model class of the paginated rows.
+    :param keys: the sort keys of the pagination.
+    :param not_null: the nullable columns excluded by the conditions of the query.
+    :return: the list of ordering clauses.
+    """
+    clauses = []
+    for field, desc in keys:
+        clause = getattr(model, field).desc() if desc else getattr(model, field).asc()
+        clauses.append(clause.nulls_last() if _nullable(model, field) and field not in not_null else clause)
+    return clauses
+
+
+def _after(column: InstrumentedAttribute, desc: bool, value):
+    """
+    Builds the condition of a non-NULL column value coming strictly after a non-NULL cursor value.
+    :param column: the sorted column.
+    :param desc: whether the column is sorted in descending order.
+    :param value: the value of the column in the cursor.
+    :return: the SQL condition.
+    """
+    return column < value if desc else column > value
+
+
+def _equal(column: InstrumentedAttribute, value):
+    """
+    Builds the condition of a column value being equal to the cursor value, NULL included.
+    :param column: the sorted column.
+    :param value: the value of the column in the cursor.
+    :return: the SQL condition.
+    """
+    return column.is_(None) if value is None else column == value
+
+
+def _key_segments(model, keys: list[tuple[str, bool]], index: int, conditions: list, after) -> list[tuple[list, list]]:
+    """
+    Builds the segments of the rows whose previous keys are equal to the cursor: those whose key at the index comes
+    after the cursor, then those whose key is NULL, sorted last, when its column is nullable.
+    :param model: the model class of the paginated rows.
+    :param keys: the sort keys of the pagination.
+    :param index: the index of the key.
+    :param conditions: the conditions of the previous keys being equal to the cursor.
+    :param after: the condition of the non-NULL values of the key coming after the cursor.
+    :return: the (conditions, ORDER BY clauses) of the segments, in order.
+    """
+    field = keys[index][0]
+    segments = [(conditions + [after], keyset_order_by(model, keys[index:], (field,)))]
+    if _nullable(model, field):
+        segments.append((conditions + [getattr(model, field).is_(None)], keyset_order_by(model, keys[index + 1:])))
+    return segments
+
+
+def keyset_segments(model, keys: list[tuple[str, bool]], values: list | None = None) -> list[tuple[list, list]]:
+    """
+    Splits the rows coming after the cursor into segments, each read by a seek without OR nor IS NULL
+    alternatives, the segments following each other in the order of the pagination. A page reads the first
+    segment and only goes on with the next ones when the previous ones run out of rows.
+    The trailing keys which cannot be NULL and are sorted in the same direction, led by at most one nullable key,
+    are compared as a row value: (k1, siret) > (:v1, :s), served by an index on (k1, siret).
+    The NULL values of a nullable key, sorted last, are read in their own segment: k1 IS NULL AND ...
+    :param model: the model class of the paginated rows.
+    :param keys: the sort keys of the pagination.
+    :param values: the values of the sort keys of the last row of the previous page, None for the first page.
+    :return: the (conditions, ORDER BY clauses) of the segments, in order.
+    """
+    columns = [getattr(model, field) for field, _ in keys]
+    nullable = [_nullable(model, field) for field, _ in keys]
+    if values is None:
+        if not nullable[0]:
+            return [([], keyset_order_by(model, keys))]
+        return _key_segments(model, keys, 0, [], columns[0].is_not(None))
+
+    def prefix(length: int) -> list:
+        return [_equal(column, value) for column, value in zip(columns[:length], values[:length])]
+
+    # The row value starts at the first of the trailing keys sorted like the tie-breaker
+    desc = keys[-1][1]
+    start = len(keys) - 1
+    while start > 0 and not nullable[start - 1] and keys[start - 1][1] == desc:
+        start -= 1
+    if start > 0 and nullable[start - 1] and values[start - 1] is not None and keys[start - 1][1] == desc:
+        start -= 1
+    if start == len(keys) - 1:
+        seek = _after(columns[start], desc, values[start])
+    else:
+        row = tuple_(*columns[start:])
+        cursor = tuple_(*[literal(value, column.type) for column, value in zip(columns[start:], values[start:])])
+        seek = row < cursor if desc else row > cursor
+    segments = _key_segments(model, keys, start, prefix(start), seek)
+
+    # Then the rows after the cursor on the previous keys, from the last one to the first one
+    for index in range(start - 1, -1, -1):
+        if values[index] is None:
+            # NULL values come last, nothing comes after them for this key
+            continue
+        segments += _key_segments(model, keys, index, prefix(index), _after(columns[index], keys[index][1], values[index]))
+    return segments
+
+
+def _sort_signature(keys: list[tuple[str, bool]]) -> str:
+    """
+    Describes the sort of a pagination, so that a cursor cannot be used with another sort.
+    :param keys: the sort keys of the pagination.
+    :return: the sort as a string, like in the 'sort' query parameter.
+    """
+    return ','.join(('-' if desc else '') + field for field, desc in keys)
+
+
+def encode_cursor(keys: list[tuple[str, bool]], item: dict) -> str:
+    """
+    Builds the opaque cursor pointing after an item.
+    :param keys: the sort keys of the pagination.
+    :param item: the last item of the page, as a dictionary of column values.
+    :return: the URL-safe cursor.
+    """
+    values = []
+    for field, _ in keys:
+        value = item[field]
+        if isinstance(value, (datetime.date, datetime.datetime)):
+            value = value.isoformat()
+        values.append(value)
+    payload = json.dumps({'s': _sort_signature(keys), 'v': values}, separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(model, keys: list[tuple[str, bool]], cursor: str) -> list:
+    """
+    Reads the values of the sort keys from a cursor.
+    :param model: the model class of the paginated rows.
+    :param keys: the sort keys of the pagination.
+    :param cursor: the cursor given by the client.
+    :return: the values of the sort keys, converted to the types of the columns.
+    :raise ValueError: if the cursor is malformed or was built for another sort.
+    """
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+        signature, values = payload['s'], payload['v']
+    except (binascii.Error, UnicodeError, ValueError, TypeError, KeyError) as e:
+        raise ValueError(f"Malformed cursor: {e}") from e
+
+    if signature != _sort_signature(keys) or not isinstance(values, list) or len(values) != len(keys):
+        raise ValueError("Cursor does not match the requested sort")
+
+    converted = []
+    for (field, _), value in zip(keys, values):
+        python_type = getattr(model, field).type.python_type
+        if value is not None and python_type in (datetime.date, datetime.datetime):
+            try:
+                value = python_type.fromisoformat(value)
+            except (TypeError, ValueError) as e:
+                raise ValueError(f"Malformed cursor value for '{field}': {e}") from e
+        converted.append(value)
+    return converted
@@ -0,0 +1,366 @@
+"""
+Recorder of the shapes of the list queries (filtered fields and operators, sort, pagination), with their
+latency and row counts, and index advisor explaining the top shapes and suggesting the missing indexes.
+"""
+
+import re
+import threading
+import time
+import uuid
+
+from typing import Callable
+
+from flask import current_app, g, request, Response
+from sqlalchemy import inspect, select
+from sqlalchemy.engine import Connection
+
+from flask_app.api.filters import filter_conditions, parse_filters, parse_sort, split_filter
+from flask_app.api.pagination import keyset_keys, keyset_segments
+from flask_app.db.models import Etablissement
+
+# Default maximum number of distinct shapes recorded, 0 disables the recorder
+DEFAULT_QUERY_SHAPES_SIZE = 0
+
+# Maximum number of columns of a suggested index
+MAX_INDEX_COLUMNS = 3
+
+# Maximum length of an index name on PostgreSQL
+MAX_INDEX_NAME_LENGTH = 63
+
+EQUALITY_OPERATORS = ('eq', 'in')
+RANGE_OPERATORS = ('gt', 'gte', 'lt', 'lte', 'prefix')
+
+etablissement_table = Etablissement.__table__
+
+_SQLITE_INDEX = re.compile(r"USING (?:COVERING )?INDEX (\w+)")
+
+
+class QueryShapeRecorder:
+    """
+    Thread-safe aggregation of the statistics of the list queries by shape.
+    New shapes are dropped once the maximum number of shapes is reached.
+    """
+
+    def __init__(self, max_shapes: int):
+        """
+        :param max_shapes: the maximum number of distinct shapes recorded.
+        """
+        self.max_shapes = max_shapes
+        self.dropped = 0
+        self._shapes: dict[str, dict] = {}
+        self._lock = threading.Lock()
+
+    def record(self, shape: dict, example: dict, seconds: float, rows: int) -> None:
+        """
+        Adds a query to the statistics of its shape.
+        :param shape: the shape of the query, as built by query_shape.
+        :param example: the query parameters of the query, replayed to explain the shape.
+        :param seconds: the time taken to answer the query.
+        :param rows: the number of rows returned.
+        :return: None
+        """
+        key = shape['key']
+        with self._lock:
+            stats = self._shapes.get(key)
+            if stats is None:
+                if len(self._shapes) >= self.max_shapes:
+                    self.dropped += 1
+                    return
+                stats = self._shapes[key] = {**shape, 'count': 0, 'seconds': 0.0, 'max_seconds': 0.0, 'rows': 0}
+            stats['count'] += 1
+            stats['seconds'] += seconds
+            stats['max_seconds'] = max(stats['max_seconds'], seconds)
+            stats['rows'] += rows
+            stats['example'] = example
+
+    def top(self, limit: int) -> list[dict]:
+        """
+        Lists the shapes taking the most time overall.
+        :param limit: the maximum number of shapes.
+        :return: the statistics of the shapes, slowest first.
+        """
+        with self._lock:
+            shapes = sorted(self._shapes.values(), key=lambda stats: stats['seconds'], reverse=True)[:limit]
+            return [{
+                'shape': stats['key'],
+                'filters': [list(item) for item in stats['filters']],
+                'sort': stats['sort'],
+                'paging': stats['paging'],
+                'count': stats['count'],
+                'total_ms': round(stats['seconds'] * 1000, 3),
+                'mean_ms': round(stats['seconds'] * 1000 / stats['count'], 3),
+                'max_ms': round(stats['max_seconds'] * 1000, 3),
+                'mean_rows': round(stats['rows'] / stats['count'], 1),
+                'example': dict(stats['example']),
+            } for stats in shapes]
+
+    def clear(self) -> None:
+        """
+        Forgets all the recorded shapes.
+        :return: None
+        """
+        with self._lock:
+            self._shapes.clear()
+            self.dropped = 0
+
+
+def get_query_recorder() -> QueryShapeRecorder | None:
+    """
+    Gets the query shape recorder of the current Flask app, creating it on first use.
+    :return: the recorder, or None if it is disabled.
+    """
+    extensions = current_app.extensions
+    if 'query_recorder' not in extensions:
+        size = current_app.config.get('QUERY_SHAPES_SIZE', DEFAULT_QUERY_SHAPES_SIZE)
+        extensions.setdefault('query_recorder', QueryShapeRecorder(size) if size > 0 else None)
+    return extensions['query_recorder']
+
+
+def query_shape(args) -> dict:
+    """
+    Normalizes the query parameters of a list query into its shape: the filtered fields with their operators,
+    the sort and the pagination, without the values.
+    :param args: the query parameters.
+    :return: the shape, with its key.
+    """
+    filters = sorted({split_filter(name) for name, value in args.items() if value and split_filter(name)})
+    sort = args.get('sort') or ''
+    paging = 'cursor' if 'cursor' in args else 'offset'
+    key = (f"filters={','.join(f'{field}:{operator}' for field, operator in filters)};"
+           f"sort={sort};paging={paging}")
+    return {'key': key, 'filters': filters, 'sort': sort, 'paging': paging}
+
+
+def record_query_shape(build: Callable[[], Response]) -> Response:
+    """
+    Builds the response of a list query, recording its shape, its latency and its number of rows
+    (set in g.query_rows by the builder) when the recorder is enabled.
+    :param build: the function building the response.
+    :return: the response.
+    """
+    recorder = get_query_recorder()
+    if recorder is None:
+        return build()
+
+    start = time.perf_counter()
+    response = build()
+    if response.status_code == 200:
+        example = request.args.to_dict()
+        if example.get('cursor'):
+            # A cursor expires with the data, the shape is explained on its first page
+            example['cursor'] = ''
+        recorder.record(query_shape(request.args), example, time.perf_counter() - start, g.get('query_rows', 0))
+    return response
+
+
+def shape_statement(example: dict, dialect_name: str):
+    """
+    Builds the statement reading the page of a recorded list query.
+    :param example: the query parameters of the query.
+    :param dialect_name: the name of the database dialect.
+    :return: the select statement.
+    """
+    filters = parse_filters(example)
+    sort_keys = parse_sort(example.get('sort'))
+    fields = [field.strip() for field in example['fields'].split(',')] if example.get('fields') else None
+    per_page = int(example.get('per_page', 10))
+
+    columns = [etablissement_table.c[field] for field in fields] if fields else [etablissement_table]
+    statement = select(*columns).where(*filter_conditions(etablissement_table.c, filters, dialect_name))
+    if 'cursor' in example:
+        # The first page reads the first segment of the pagination
+        conditions, order_by = keyset_segments(Etablissement, keyset_keys(sort_keys))[0]
+        return statement.where(*conditions).order_by(*order_by).limit(per_page + 1)
+    page = max(int(example.get('page', 1)), 1)
+    return statement.order_by(*[
+        etablissement_table.c[field].desc() if desc else etablissement_table.c[field] for field, desc in sort_keys
+    ]).limit(per_page).offset((page - 1) * per_page)
+
+
+def _plan_nodes(node: dict):
+    """
+    Walks the nodes of a PostgreSQL JSON plan.
+    :param node: the root node.
+    :return: an iterator over the node and its descendants.
+    """
+    yield node
+    for child in node.get('Plans', []):
+        yield from _plan_nodes(child)
+
+
+def explain(connection: Connection, statement, analyze: bool = False) -> dict:
+    """
+    Explains the plan of a statement: EXPLAIN (FORMAT JSON) on PostgreSQL, with ANALYZE and BUFFERS when asked,
+    EXPLAIN QUERY PLAN on SQLite, the statement being timed when asked since SQLite cannot analyze it.
+    :param connection: an open connection to the database.
+    :param statement: the explained statement.
+    :param analyze: whether to run the statement to get its actual execution time.
+    :return: the SQL of the statement, its plan, the indexes it uses, whether it scans the whole
+    Etablissement table, and its execution time in milliseconds when analyzed.
+    """
+    table_name = etablissement_table.name
+    if connection.dialect.name == 'postgresql':
+        compiled = statement.compile(dialect=connection.dialect)
+        options = 'FORMAT JSON, ANALYZE, BUFFERS' if analyze else 'FORMAT JSON'
+        plan = connection.exec_driver_sql(f"EXPLAIN ({options}) {compiled}", compiled.params).scalar()
+        nodes = list(_plan_nodes(plan[0]['Plan']))
+        return {
+            'sql': str(compiled),
+            'plan': plan,
+            'indexes': sorted({node['Index Name'] for node in nodes if 'Index Name' in node}),
+            'full_scan': any(node['Node Type'] == 'Seq Scan' and node.get('Relation Name') == table_name
+                             for node in nodes),
+            'execution_ms': plan[0].get('Execution Time'),
+        }
+
+    sql = str(statement.compile(dialect=connection.dialect, compile_kwargs={'literal_binds': True}))
+    details = [row[3] for row in connection.exec_driver_sql(f"EXPLAIN QUERY PLAN {sql}").all()]
+    execution_ms = None
+    if analyze:
+        start = time.perf_counter()
+        connection.exec_driver_sql(sql).all()
+        execution_ms = round((time.perf_counter() - start) * 1000, 3)
+    return {
+        'sql': sql,
+        'plan': details,
+        'indexes': sorted({match.group(1) for detail in details for match in _SQLITE_INDEX.finditer(detail)}),
+        'full_scan': any(detail.startswith(f"SCAN {table_name}") and 'INDEX' not in detail for detail in details),
+        'execution_ms': execution_ms,
+    }
+
+
+def index_columns(filters: list, sort: str) -> list[str]:
+    """
+    Chooses the columns of the index serving a shape: the equality filters first, then the sort, then one range
+    filter, which is the order in which a B-tree index can serve them all.
+    :param filters: the (field, operator) filters of the shape.
+    :param sort: the sort of the shape.
+    :return: the columns of the index, empty if no index would help.
+    """
+    columns = []
+    for field, operator in filters:
+        if operator in EQUALITY_OPERATORS and field not in columns:
+            columns.append(field)
+    for field, _ in parse_sort(sort):
+        if field not in columns:
+            columns.append(field)
+    for field, operator in filters:
+        if operator in RANGE_OPERATORS and field not in columns:
+            columns.append(field)
+            break
+    return columns[:MAX_INDEX_COLUMNS]
+
+
+def existing_indexes(connection: Connection) -> dict[str, list[str]]:
+    """
+    Lists the indexes of the Etablissement table, primary key included.
+    :param connection: an open connection to the database.
+    :return: the columns of each index, by name.
+    """
+    inspector = inspect(connection)
+    indexes = {index['name']: index['column_names'] for index in inspector.get_indexes(etablissement_table.name)}
+    primary_key = inspector.get_pk_constraint(etablissement_table.name)
+    indexes[primary_key.get('name') or 'primary_key'] = primary_key['constrained_columns']
+    return indexes
+
+
+def suggest_index(shape: dict, indexes: dict[str, list[str]], dialect_name: str) -> dict | None:
+    """
+    Suggests the index serving a shape, unless an existing index already starts with its columns.
+    :param shape: the statistics of the shape, with its filters and sort.
+    :param indexes: the columns of the existing indexes, by name.
+    :param dialect_name: the name of the database dialect.
+    :return: the name, columns and PostgreSQL operator classes of the index, or None if no index is missing.
+    """
+    columns = index_columns(shape['filters'], shape['sort'])
+    if not columns or columns[0] == 'siret':
+        return None
+    if any(existing[:len(columns)] == columns for existing in indexes.values()):
+        return None
+
+    # LIKE prefixes only use the pattern operator classes on PostgreSQL
+    prefixed = {field for field, operator in shape['filters'] if operator == 'prefix'}
+    ops = {column: 'varchar_pattern_ops' for column in columns if column in prefixed} \
+        if dialect_name == 'postgresql' else {}
+    return {'name': f"idx_{'_'.join(columns)}"[:MAX_INDEX_NAME_LENGTH], 'columns': columns, 'postgresql_ops': ops}
+
+
+def suggest_indexes(connection: Connection, shapes: list[dict]) -> list[dict]:
+    """
+    Suggests the missing indexes of shapes, each index once, for the slowest shapes first.
+    :param connection: an open connection to the database.
+    :param shapes: the statistics of the shapes.
+    :return: the suggested indexes, with the shapes they serve.
+    """
+    indexes = existing_indexes(connection)
+    suggestions = {}
+    for shape in shapes:
+        suggestion = suggest_index(shape, indexes, connection.dialect.name)
+        if suggestion is not None:
+            suggestions.setdefault(suggestion['name'], {**suggestion, 'shapes': []})['shapes'].append(shape['shape'])
+    return list(suggestions.values())
+
+
+def _index_expressions(suggestion: dict) -> list[str]:
+    """
+    Writes the columns of a suggested index with their operator classes.
+    :param suggestion: the suggested index.
+    :return: the column expressions.
+    """
+    return [f"{column} {suggestion['postgresql_ops'][column]}" if column in suggestion['postgresql_ops'] else column
+            for column in suggestion['columns']]
+
+
+def migration_sql(suggestions: list[dict], dialect_name: str) -> str:
+    """
+    Writes the SQL script creating suggested indexes, without locking the table on PostgreSQL.
+    :param suggestions: the suggested indexes.
+    :param dialect_name: the name of the database dialect.
+    :return: the SQL script.
+    """
+    concurrently = ' CONCURRENTLY' if dialect_name == 'postgresql' else ''
+    return ''.join(
+        f"CREATE INDEX{concurrently} IF NOT EXISTS {suggestion['name']} "
+        f"ON {etablissement_table.name} ({', '.join(_index_expressions(suggestion))});\n"
+        for suggestion in suggestions
+    )
+
+
+def migration_script(suggestions: list[dict], down_revision: str | None = None) -> str:
+    """
+    Writes the Alembic migration (flask db upgrade) creating suggested indexes, concurrently on PostgreSQL.
+    The matching db.Index lines of Etablissement.__table_args__ are written in its docstring.
+    :param suggestions: the suggested indexes.
+    :param down_revision: the revision the migration follows, None for the first migration.
+    :return: the Python source of the migration.
+    """
+    revision = uuid.uuid4().hex[:12]
+    model_lines = []
+    upgrade = []
+    downgrade = []
+    empty = ['        pass\n']
+    for suggestion in suggestions:
+        ops = f", postgresql_ops={suggestion['postgresql_ops']!r}" if suggestion['postgresql_ops'] else ''
+        columns = ', '.join(repr(column) for column in suggestion['columns'])
+        model_lines.append(f"    db.Index({suggestion['name']!r}, {columns}{ops}),\n")
+        upgrade.append(f"        op.create_index({suggestion['name']!r}, {etablissement_table.name!r}, [{columns}],\n"
+                       f"                        if_not_exists=True, postgresql_concurrently=True{ops})\n")
+        downgrade.append(f"        op.drop_index({suggestion['name']!r}, table_name={etablissement_table.name!r},\n"
+                         f"                      if_exists=True, postgresql_concurrently=True)\n")
+
+    return (
+        f'"""\nAdd the indexes suggested by the index advisor.\n\n'
+        f'Indexes of Etablissement.__table_args__:\n{"".join(model_lines)}"""\n\n'
+        f"from alembic import op\n\n"
+        f"revision = {revision!r}\n"
+        f"down_revision = {down_revision!r}\n"
+        f"branch_labels = None\n"
+        f"depends_on = None\n\n\n"
+        f"def upgrade():\n"
+        f"    # Concurrent index builds cannot run in a transaction\n"
+        f"    with op.get_context().autocommit_block():\n"
+        f"{''.join(upgrade or empty)}\n\n"
+        f"def downgrade():\n"
+        f"    with op.get_context().autocommit_block():\n"
+        f"{''.join(downgrade or empty)}"
+    )
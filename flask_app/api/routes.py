@@ -2,17 +2,67 @@
 API routes.
 """
 
-from datetime import datetime
-
-from sqlalchemy import inspect
-
-from flask import request, jsonify, abort, Response, Blueprint
+import csv
+import hmac
+import io
+import json
+import math
 
+from datetime import datetime
+from typing import Iterator
+
+from sqlalchemy import select
+from sqlalchemy.exc import SQLAlchemyError
+
+from flask import request, jsonify, abort, current_app, g, Response, Blueprint, stream_with_context
+
+from flask_app.api.counting import COUNT_MODES, count_etablissements, get_count_cache
+from flask_app.api.detail_cache import cached_etablissement, get_detail_cache
+from flask_app.api.filters import filter_conditions, in_values, parse_filters, parse_sort
+from flask_app.api.ingest_status import add_rate, ingest_progress, is_ready
+from flask_app.api.list_cache import cached_list_response, get_list_cache
+from flask_app.api.query_shapes import explain, get_query_recorder, migration_script, migration_sql, \
+    record_query_shape, shape_statement, suggest_indexes
+from flask_app.api.pagination import decode_cursor, encode_cursor, keyset_keys, keyset_segments
+from flask_app.api.validation import validate_etablissement_changes, validate_new_etablissement
+from flask_app.api.serializers import ETABLISSEMENT_FIELD_SET, ETABLISSEMENT_FIELDS, dumps, get_date_format, \
+    json_response, row_serializer, serialize_rows
 from flask_app.db import db
+from flask_app.db.audit_storage import select_audit_entries
+from flask_app.db.bulk_write import BULK_MODES, DEFAULT_BULK_CHUNK_SIZE, bulk_write
+from flask_app.db.init_db import csv_file_path
 from flask_app.db.models import Etablissement
+from flask_app.db.routing import get_replica_router, primary_reads, replica_reads
+from flask_app.db.search import MIN_QUERY_LENGTH, search_statement
 
 api_bp = Blueprint('api', __name__)
 
+# Number of rows fetched from the server-side cursor at once by the export route
+DEFAULT_EXPORT_BATCH_SIZE = 1000
+
+# Maximum number of sirets and sirens of a lookup request
+DEFAULT_LOOKUP_MAX_ITEMS = 1000
+
+# Number of identifiers resolved by each query of a lookup request
+DEFAULT_LOOKUP_BATCH_SIZE = 500
+
+# Maximum number of Etablissements of a bulk write request
+DEFAULT_BULK_MAX_ITEMS = 100000
+
+# Maximum number of audit entries per page
+MAX_AUDIT_PAGE_SIZE = 1000
+
+# Maximum number of results of a search
+MAX_SEARCH_LIMIT = 100
+
+# Maximum number of query shapes explained at once, each EXPLAIN ANALYZE running its query
+MAX_EXPLAINED_SHAPES = 20
+
+EXPORT_MIMETYPES = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
 
 def etablissement_to_dict(etablissement: Etablissement) -> dict:
     """
@@ -20,8 +70,7 @@ def etablissement_to_dict(etablissement: Etablissement) -> dict:
     :param etablissement: instance of an etablissement.
     :return: dictionnary representation of the etablissement.
     """
-    inspector = inspect(etablissement)
-    return {column.key: getattr(etablissement, column.key) for column in inspector.mapper.column_attrs}
+    return {field: getattr(etablissement, field) for field in ETABLISSEMENT_FIELDS}
 
 
 @api_bp.route("/hello", methods=["GET"])
@@ -36,81 +85,635 @@ def hello_world() -> Response:
 @api_bp.route("/db_check", methods=["GET"])
 def count_establishments() -> Response:
     """
-    Test DB.
-    :return: a json with the count of Etablissements.
+    Test DB. The count is exact (and cached for a short time) by default, or estimated with count=estimate.
+    :return: a json with the count of Etablissements and whether it is exact or estimated.
+    """
+    mode = request.args.get('count', 'exact')
+    if mode not in COUNT_MODES:
+        abort(400, description=f"Invalid count mode: {mode}")
+
+    count, exact = count_etablissements(Etablissement.query, {}, mode)
+    return jsonify({'count': count, 'count_type': 'exact' if exact else 'estimate'})
+
+
+@api_bp.route("/ready", methods=["GET"])
+@primary_reads
+def ready() -> Response:
+    """
+    Tell whether the API can serve the data: the database answers and the snapshot or the CSV file is loaded.
+    :return: a json containing the readiness and the progress of the ingest, with a 503 status until ready.
     """
-    count = Etablissement.query.count()
-    return jsonify({'count': count})
+    try:
+        status = ingest_progress(db.session.connection(), csv_file_path(),
+                                 current_app.config.get("INGEST_SNAPSHOT_PATH"))
+    except SQLAlchemyError as e:
+        db.session.rollback()
+        return json_response({'ready': False, 'error': f"Database unavailable: {e.__class__.__name__}"}, 503)
+    db.session.rollback()
+    serving = is_ready(status)
+    return json_response({'ready': serving, 'ingest': status}, 200 if serving else 503)
+
+
+@api_bp.route("/ingest/status", methods=["GET"])
+@primary_reads
+def get_ingest_status() -> Response:
+    """
+    Get the progress of the load of the snapshot or the CSV file: state, rows and offsets loaded, rate and estimated
+    time left.
+    :return: a json containing the progress.
+    """
+    status = ingest_progress(db.session.connection(), csv_file_path(), current_app.config.get("INGEST_SNAPSHOT_PATH"))
+    db.session.rollback()
+    return json_response(add_rate(status))
+
+
+def parse_filters_and_sort() -> tuple[dict, list[tuple[str, bool]]]:
+    """
+    Reads the filters and the sort of a list of Etablissements from the query parameters.
+    Filters are written 'field=value' for equality, or 'field__operator=value' with the operators
+    gt, gte, lt, lte, prefix, in (comma-separated values) and is_null (true or false).
+    :return: the filters by query parameter, and the (field, descending) sort keys.
+    """
+    try:
+        return parse_filters(request.args), parse_sort(request.args.get('sort'))
+    except ValueError as e:
+        abort(400, description=str(e))
+
+
+def parse_fields() -> list[str] | None:
+    """
+    Reads the columns requested with the 'fields' query parameter (comma-separated), if any.
+    :return: the requested columns in the requested order, or None to get all of them.
+    """
+    fields = request.args.get('fields')
+    if not fields:
+        return None
+    return validate_fields(fields.split(','))
+
+
+def validate_fields(fields: list[str]) -> list[str]:
+    """
+    Checks that requested columns exist, dropping duplicates.
+    :param fields: the requested columns.
+    :return: the requested columns in the requested order.
+    """
+    selected = []
+    for field in fields:
+        field = field.strip() if isinstance(field, str) else field
+        if field not in ETABLISSEMENT_FIELD_SET:
+            abort(400, description=f"Invalid field: {field}")
+        if field not in selected:
+            selected.append(field)
+    return selected
+
+
+def select_fields(query, fields: list[str]):
+    """
+    Restricts a query of Etablissements to some columns, so that only them are read from the database.
+    :param query: the query of the Etablissements.
+    :param fields: the columns to select.
+    :return: the query returning rows of the selected columns instead of Etablissement objects.
+    """
+    return query.with_entities(*[getattr(Etablissement, field) for field in fields])
+
+
+def sort_clauses(sort_keys: list[tuple[str, bool]]) -> list:
+    """
+    Builds the ORDER BY clauses of a list of Etablissements.
+    :param sort_keys: the (field, descending) sort keys.
+    :return: the list of ordering clauses.
+    """
+    return [
+        getattr(Etablissement, field).desc() if desc else getattr(Etablissement, field)
+        for field, desc in sort_keys
+    ]
 
 
 @api_bp.route("/etablissements", methods=["GET"])
 def get_etablissements() -> Response:
     """
-    Get a list of Etablissements with optional filters, sorting, and pagination.
+    Get a list of Etablissements with optional filters, sorting, pagination and projection on some fields.
+    The responses are cached until the table changes and carry an ETag, a request with a matching
+    If-None-Match header gets a 304 response.
+    :return: a list of etablissements.
+    """
+    return cached_list_response(lambda: record_query_shape(list_etablissements))
+
+
+def list_etablissements() -> Response:
+    """
+    Reads and serializes the page of Etablissements of the current request.
     :return: a list of etablissements.
     """
     page = request.args.get('page', 1, type=int)
     per_page = request.args.get('per_page', 10, type=int)
 
+    filter_args, sort_keys = parse_filters_and_sort()
+    fields = parse_fields()
+
     query = Etablissement.query
+    if filter_args:
+        query = query.filter(*filter_conditions(Etablissement.__table__.c, filter_args, db.engine.dialect.name))
+
+    count = request.args.get('count')
+    if count is not None and count not in COUNT_MODES:
+        abort(400, description=f"Invalid count mode: {count}")
+
+    # Implement keyset pagination when a cursor is given (an empty cursor asks for the first page)
+    if 'cursor' in request.args:
+        result = get_etablissements_after_cursor(query, filter_args, sort_keys, request.args['cursor'], per_page,
+                                                 count, fields)
+        g.query_rows = len(result['items'])
+        return json_response(result)
+
+    page_query = query
+    if sort_keys:
+        page_query = page_query.order_by(*sort_clauses(sort_keys))
+
+    # Implement pagination, the total being counted (or estimated) by the counting subsystem.
+    # Rows are read as tuples of the selected columns and serialized without building Etablissement objects.
+    output_fields = fields or ETABLISSEMENT_FIELDS
+    pagination = select_fields(page_query, output_fields).paginate(page=page, per_page=per_page, error_out=False,
+                                                                   count=False)
+    items = serialize_rows(pagination.items, output_fields)
+    g.query_rows = len(items)
+    total, exact = count_etablissements(query, filter_args, count or 'exact')
+
+    return json_response({
+        'total': total,
+        'total_type': 'exact' if exact else 'estimate',
+        'pages': math.ceil(total / pagination.per_page) if total else 0,
+        'page': page,
+        'per_page': per_page,
+        'items': items
+    })
 
-    # List of valid fields for filtering and sorting
-    inspector = inspect(Etablissement)
-    valid_fields = [column.key for column in inspector.mapper.column_attrs]
 
-    # Implement filters
-    filter_args = {}
-    for field in valid_fields:
-        value = request.args.get(field)
-        if value:
-            filter_args[field] = value
+def get_etablissements_after_cursor(query, filter_args: dict, sort_keys: list[tuple[str, bool]], cursor: str,
+                                    per_page: int, count: str | None, fields: list[str] | None = None) -> dict:
+    """
+    Get a page of Etablissements with keyset pagination: the page starts after the row encoded in the cursor,
+    so every page costs the same whatever its depth. The total is only counted when asked for.
+    :param query: the filtered query of the Etablissements.
+    :param filter_args: the filters of the query, by query parameter.
+    :param sort_keys: the requested (field, descending) sort keys.
+    :param cursor: the cursor returned with the previous page, or an empty string for the first page.
+    :param per_page: the number of items per page.
+    :param count: 'exact' or 'estimate' to count the total number of matching Etablissements.
+    :param fields: the columns to return, or None to return all of them.
+    :return: the page, with the cursor of the next page (None on the last page).
+    """
+    if per_page < 1:
+        abort(400, description="Invalid per_page: must be at least 1")
 
-    if filter_args:
-        query = query.filter_by(**filter_args)
-
-    # Implement sorting
-    sort = request.args.get('sort')
-    if sort:
-        sort_fields = []
-        for field in sort.split(','):
-            desc = False
-            if field.startswith('-'):
-                desc = True
-                field = field[1:]
-            if field in valid_fields:
-                column_attr = getattr(Etablissement, field)
-                if desc:
-                    column_attr = column_attr.desc()
-                sort_fields.append(column_attr)
-            else:
-                abort(400, description=f"Invalid sort field: {field}")
-        if sort_fields:
-            query = query.order_by(*sort_fields)
-
-    # Implement pagination
-    pagination = query.paginate(page=page, per_page=per_page, error_out=False)
-    items = [etablissement_to_dict(e) for e in pagination.items]
-
-    return jsonify({
-        'total': pagination.total,
-        'pages': pagination.pages,
-        'page': page,
+    keys = keyset_keys(sort_keys)
+    values = None
+    if cursor:
+        try:
+            values = decode_cursor(Etablissement, keys, cursor)
+        except ValueError as e:
+            abort(400, description=f"Invalid cursor: {e}")
+
+    # The sort keys are selected after the returned columns, to build the cursor
+    output_fields = fields or ETABLISSEMENT_FIELDS
+    selected_fields = output_fields + [field for field, _ in keys if field not in output_fields]
+    page_query = select_fields(query, selected_fields)
+
+    # Fetch one more row to know whether there is a next page, from the next segments when a segment runs out
+    rows = []
+    for conditions, order_by in keyset_segments(Etablissement, keys, values):
+        rows += page_query.filter(*conditions).order_by(*order_by).limit(per_page + 1 - len(rows)).all()
+        if len(rows) > per_page:
+            break
+    next_cursor = encode_cursor(keys, rows[per_page - 1]._mapping) if len(rows) > per_page else None
+    items = serialize_rows(rows[:per_page], output_fields)
+
+    result = {
         'per_page': per_page,
+        'next_cursor': next_cursor,
         'items': items
+    }
+    if count is not None:
+        result['total'], exact = count_etablissements(query, filter_args, count)
+        result['total_type'] = 'exact' if exact else 'estimate'
+    return result
+
+
+@api_bp.route("/etablissements/export", methods=["GET"])
+def export_etablissements() -> Response:
+    """
+    Export all the Etablissements matching the filters of the list route, as NDJSON (format=ndjson, default)
+    or CSV (format=csv). Rows are read from a server-side cursor and streamed as they come,
+    so the memory used stays the same whatever the size of the export.
+    :return: a streamed response with one line per etablissement.
+    """
+    export_format = request.args.get('format', 'ndjson')
+    if export_format not in EXPORT_MIMETYPES:
+        abort(400, description=f"Invalid export format: {export_format}")
+
+    filter_args, sort_keys = parse_filters_and_sort()
+    fields = parse_fields()
+    table = Etablissement.__table__
+    columns = [table.c[field] for field in fields] if fields else [table]
+    statement = select(*columns).where(*filter_conditions(table.c, filter_args, db.engine.dialect.name)).order_by(*[
+        table.c[field].desc() if desc else table.c[field] for field, desc in sort_keys
+    ])
+    batch_size = current_app.config.get('EXPORT_BATCH_SIZE', DEFAULT_EXPORT_BATCH_SIZE)
+
+    def generate() -> Iterator[str]:
+        """
+        Streams the rows of the export, one chunk of text per batch of rows fetched from the cursor.
+        :return: an iterator over the chunks of the export.
+        """
+        result = db.session.connection().execute(statement.execution_options(yield_per=batch_size))
+        keys = list(result.keys())
+
+        if export_format == 'csv':
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            writer.writerow(keys)
+            for partition in result.partitions():
+                writer.writerows(partition)
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+            if buffer.tell():
+                yield buffer.getvalue()
+        else:
+            serialize = row_serializer(tuple(keys), get_date_format())
+            for partition in result.partitions():
+                yield b''.join([dumps(serialize(row)) + b'\n' for row in partition])
+
+    return Response(stream_with_context(generate()), mimetype=EXPORT_MIMETYPES[export_format])
+
+
+def read_identifiers(data: dict, key: str) -> list[str]:
+    """
+    Reads a list of identifiers from the body of a lookup request, dropping duplicates.
+    :param data: the body of the request.
+    :param key: 'sirets' or 'sirens'.
+    :return: the identifiers in the requested order.
+    """
+    values = data.get(key, [])
+    if not isinstance(values, list) or not all(isinstance(value, str) for value in values):
+        abort(400, description=f"'{key}' must be a list of strings")
+    return list(dict.fromkeys(values))
+
+
+@api_bp.route("/etablissements/lookup", methods=["POST"])
+@replica_reads
+def lookup_etablissements() -> Response:
+    """
+    Get many Etablissements at once by SIRET and/or SIREN, with one query per batch of identifiers.
+    The body is a json object with the lists 'sirets' and 'sirens', and optionally the list of 'fields' to return.
+    :return: a json containing the found etablissements and the identifiers that matched nothing.
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        abort(400, description="No input data provided")
+
+    sirets = read_identifiers(data, 'sirets')
+    sirens = read_identifiers(data, 'sirens')
+    max_items = current_app.config.get('LOOKUP_MAX_ITEMS', DEFAULT_LOOKUP_MAX_ITEMS)
+    if not sirets and not sirens:
+        abort(400, description="No sirets or sirens provided")
+    if len(sirets) + len(sirens) > max_items:
+        abort(400, description=f"Too many identifiers: at most {max_items} per request")
+
+    fields = data.get('fields') or parse_fields()
+    if fields is not None and not isinstance(fields, list):
+        abort(400, description="'fields' must be a list of field names")
+    output_fields = validate_fields(fields) if fields else ETABLISSEMENT_FIELDS
+    # The identifiers are selected after the returned columns, to find the misses
+    selected_fields = output_fields + [field for field in ('siret', 'siren') if field not in output_fields]
+    columns = [getattr(Etablissement, field) for field in selected_fields]
+    siret_index = selected_fields.index('siret')
+    siren_index = selected_fields.index('siren')
+
+    batch_size = current_app.config.get('LOOKUP_BATCH_SIZE', DEFAULT_LOOKUP_BATCH_SIZE)
+    rows_by_siret = {}
+    for column, values in ((Etablissement.siret, sirets), (Etablissement.siren, sirens)):
+        for start in range(0, len(values), batch_size):
+            statement = select(*columns).where(in_values(column, values[start:start + batch_size], db.engine.dialect.name))
+            if column is Etablissement.siren:
+                statement = statement.order_by(Etablissement.siret)
+            for row in db.session.execute(statement):
+                rows_by_siret.setdefault(row[siret_index], row)
+
+    found_sirens = {row[siren_index] for row in rows_by_siret.values()}
+    return json_response({
+        'items': serialize_rows(list(rows_by_siret.values()), output_fields),
+        'missing': {
+            'sirets': [siret for siret in sirets if siret not in rows_by_siret],
+            'sirens': [siren for siren in sirens if siren not in found_sirens],
+        }
     })
 
 
+def read_bulk_records() -> list:
+    """
+    Reads the records of a bulk write request, sent as a JSON array or as NDJSON (one record per line).
+    :return: the records sent by the client.
+    """
+    if request.mimetype == 'application/x-ndjson':
+        records = []
+        for line_number, line in enumerate(request.get_data(as_text=True).splitlines(), start=1):
+            if not line.strip():
+                continue
+            try:
+                records.append(json.loads(line))
+            except ValueError as e:
+                abort(400, description=f"Malformed JSON on line {line_number}: {e}")
+        return records
+
+    records = request.get_json(silent=True)
+    if not isinstance(records, list):
+        abort(400, description="Expected a JSON array or NDJSON of Etablissements")
+    return records
+
+
+def validate_bulk_record(mode: str, data) -> dict:
+    """
+    Validates a record of a bulk write request with the rules of the single record routes.
+    :param mode: 'insert', 'update' or 'upsert'.
+    :param data: the record sent by the client.
+    :return: the converted record.
+    :raise ValueError: if the record is invalid.
+    """
+    if mode != 'update':
+        return validate_new_etablissement(data)
+
+    if not isinstance(data, dict) or 'siret' not in data:
+        raise ValueError("Missing required field(s): siret")
+    changes = validate_etablissement_changes({key: value for key, value in data.items() if key != 'siret'})
+    return {'siret': data['siret'], **changes}
+
+
+@api_bp.route("/etablissements/bulk", methods=["POST"])
+def bulk_write_etablissements() -> Response:
+    """
+    Create and/or update many Etablissements at once, with one transaction and a few multi-row statements
+    per chunk of records. The 'mode' query parameter is 'insert' (default), 'update' or 'upsert'.
+    :return: a json containing the number of written records and the status of each record.
+    """
+    mode = request.args.get('mode', 'insert')
+    if mode not in BULK_MODES:
+        abort(400, description=f"Invalid mode: {mode}. Use one of: {', '.join(BULK_MODES)}")
+
+    records = read_bulk_records()
+    if not records:
+        abort(400, description="No input data provided")
+    max_items = current_app.config.get('BULK_MAX_ITEMS', DEFAULT_BULK_MAX_ITEMS)
+    if len(records) > max_items:
+        abort(400, description=f"Too many Etablissements: at most {max_items} per request")
+
+    statuses = []
+    valid_records = []
+    seen_sirets = set()
+    for index, data in enumerate(records):
+        try:
+            record = validate_bulk_record(mode, data)
+            if not isinstance(record['siret'], str):
+                raise ValueError("Invalid field: siret must be a string")
+            if record['siret'] in seen_sirets:
+                raise ValueError("Duplicate SIRET in the request")
+        except ValueError as e:
+            siret = data.get('siret') if isinstance(data, dict) else None
+            statuses.append({'index': index, 'siret': siret, 'status': 'error', 'error': str(e)})
+            continue
+        seen_sirets.add(record['siret'])
+        valid_records.append((index, record))
+
+    statuses.extend(bulk_write(mode, valid_records,
+                               current_app.config.get('BULK_CHUNK_SIZE', DEFAULT_BULK_CHUNK_SIZE)))
+    statuses.sort(key=lambda status: status['index'])
+
+    counts = {'inserted': 0, 'updated': 0, 'error': 0}
+    for status in statuses:
+        counts[status['status']] += 1
+    return json_response({
+        'mode': mode,
+        'inserted': counts['inserted'],
+        'updated': counts['updated'],
+        'errors': counts['error'],
+        'items': statuses,
+    })
+
+
+def parse_timestamp(name: str) -> datetime | None:
+    """
+    Reads an ISO 8601 date or datetime from the query parameters.
+    :param name: the name of the query parameter.
+    :return: the datetime, or None if the parameter is not given.
+    """
+    value = request.args.get(name)
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError as e:
+        abort(400, description=f"Invalid date format for '{name}': {e}")
+
+
+@api_bp.route("/audit", methods=["GET"])
+def get_audit_log() -> Response:
+    """
+    Get the audit history, newest first, with pagination. The entries can be filtered by 'siret', 'table_name'
+    and 'operation', and by a time range with 'since' (included) and 'until' (excluded).
+    :return: a json containing the list of audit entries.
+    """
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = min(max(request.args.get('per_page', 100, type=int), 1), MAX_AUDIT_PAGE_SIZE)
+
+    filters = {key: request.args[key] for key in ('table_name', 'operation') if key in request.args}
+    if 'siret' in request.args:
+        filters.update(table_name=Etablissement.__tablename__, record_id=request.args['siret'])
+
+    statement = select_audit_entries(db.session.connection(), filters,
+                                     parse_timestamp('since'), parse_timestamp('until'))
+    rows = db.session.execute(statement.limit(per_page).offset((page - 1) * per_page)).mappings()
+    return json_response({
+        'page': page,
+        'per_page': per_page,
+        'items': [{**row, 'timestamp': row['timestamp'].isoformat()} for row in rows],
+    })
+
+
+@api_bp.route("/etablissements/search", methods=["GET"])
+def search_etablissements() -> Response:
+    """
+    Search Etablissements by name and address (enseignes, denomination_usuelle, libelle_voie and libelle_commune),
+    tolerating typos. The 'q' query parameter is the search, 'limit' the maximum number of results.
+    :return: a json containing the best matching etablissements, with their score, best first.
+    """
+    return cached_list_response(find_etablissements)
+
+
+def find_etablissements() -> Response:
+    """
+    Runs the search of the current request.
+    :return: a json containing the best matching etablissements, with their score.
+    """
+    query = request.args.get('q', '').strip()
+    if len(query) < MIN_QUERY_LENGTH:
+        abort(400, description=f"The search must have at least {MIN_QUERY_LENGTH} characters")
+    limit = min(max(request.args.get('limit', 20, type=int), 1), MAX_SEARCH_LIMIT)
+    output_fields = parse_fields() or ETABLISSEMENT_FIELDS
+
+    statement = search_statement(db.engine.dialect.name, query,
+                                 [getattr(Etablissement, field) for field in output_fields], limit)
+    rows = db.session.execute(statement).all() if statement is not None else []
+    items = serialize_rows(rows, output_fields)
+    for item, row in zip(items, rows):
+        item['score'] = round(float(row[-1]), 6)
+    return json_response({'q': query, 'items': items})
+
+
 @api_bp.route("/etablissements/<string:siret>", methods=["GET"])
 def get_etablissement(siret: str) -> Response:
     """
-    Get an Etablissement by SIRET.
+    Get an Etablissement by SIRET, through the read-through cache of Etablissements.
+    Only the columns listed in the 'fields' query parameter are returned, if given, and read from the database
+    when the Etablissement is not cached.
     :param siret: the siret number of the etablissement to retrieve.
     :return: a json containing the wanted etablissement.
     """
-    etablissement = Etablissement.query.get(siret)
-    if etablissement is None:
+    def load(fields: list[str] | None) -> dict | None:
+        """
+        Reads the Etablissement from the database.
+        :param fields: the columns to read, or None to read all of them.
+        :return: the serialized Etablissement, or None if it does not exist.
+        """
+        fields = fields or ETABLISSEMENT_FIELDS
+        row = db.session.execute(
+            select(*[getattr(Etablissement, field) for field in fields]).where(Etablissement.siret == siret)
+        ).first()
+        return serialize_rows([row], fields)[0] if row is not None else None
+
+    item = cached_etablissement(siret, load, parse_fields())
+    if item is None:
         abort(404, description="Etablissement not found")
-    return jsonify(etablissement_to_dict(etablissement))
+    return json_response(item)
+
+
+@api_bp.route("/cache/stats", methods=["GET"])
+def get_cache_stats() -> Response:
+    """
+    Get the counters of the caches of this process: hits, misses, evictions and sizes.
+    :return: a json containing the counters of each cache.
+    """
+    detail_cache = get_detail_cache()
+    list_cache = get_list_cache()
+    return json_response({
+        'etablissements': detail_cache.stats() if detail_cache is not None else None,
+        'counts': get_count_cache().stats(),
+        'lists': list_cache.stats() if list_cache is not None else None,
+    })
+
+
+def require_admin() -> None:
+    """
+    Checks that the request carries the admin token of the app in its X-Admin-Token header.
+    The admin routes do not exist when no ADMIN_TOKEN is configured.
+    :return: None
+    """
+    token = current_app.config.get('ADMIN_TOKEN')
+    if not token:
+        abort(404)
+    if not hmac.compare_digest(request.headers.get('X-Admin-Token', ''), token):
+        abort(403, description="Invalid admin token")
+
+
+def recorded_shapes(limit: int) -> list[dict]:
+    """
+    Gets the slowest recorded query shapes.
+    :param limit: the maximum number of shapes.
+    :return: the statistics of the shapes, slowest first.
+    """
+    recorder = get_query_recorder()
+    if recorder is None:
+        abort(409, description="The query shape recorder is disabled, set QUERY_SHAPES_SIZE to enable it")
+    return recorder.top(limit)
+
+
+@api_bp.route("/admin/query-shapes", methods=["GET"])
+def get_query_shapes() -> Response:
+    """
+    Get the shapes of the list queries (filtered fields and operators, sort, pagination) recorded by this process,
+    with their number of calls, latencies and mean number of rows, the slowest overall first.
+    :return: a json containing the shapes.
+    """
+    require_admin()
+    limit = max(request.args.get('limit', 50, type=int), 1)
+    return json_response({'shapes': recorded_shapes(limit), 'dropped': get_query_recorder().dropped})
+
+
+@api_bp.route("/admin/query-shapes", methods=["DELETE"])
+def clear_query_shapes() -> Response:
+    """
+    Forget the recorded query shapes, for instance after an index change.
+    :return: a json containing a success message.
+    """
+    require_admin()
+    recorded_shapes(1)
+    get_query_recorder().clear()
+    return jsonify({'message': 'Query shapes cleared'})
+
+
+@api_bp.route("/admin/query-shapes/explain", methods=["GET"])
+def explain_query_shapes() -> Response:
+    """
+    Explain the plan of the slowest recorded query shapes, replaying their last parameters. With analyze=true,
+    the queries are run to get their actual execution time. The indexes missing for these shapes are suggested.
+    :return: a json containing the shapes with their plan, and the suggested indexes.
+    """
+    require_admin()
+    limit = min(max(request.args.get('limit', 5, type=int), 1), MAX_EXPLAINED_SHAPES)
+    analyze = request.args.get('analyze', 'false').lower() == 'true'
+    shapes = recorded_shapes(limit)
+
+    connection = db.session.connection()
+    for shape in shapes:
+        shape['explain'] = explain(connection, shape_statement(shape['example'], connection.dialect.name), analyze)
+    suggestions = suggest_indexes(connection, shapes)
+    db.session.rollback()
+    return json_response({'shapes': shapes, 'suggested_indexes': suggestions})
+
+
+@api_bp.route("/admin/index-suggestions", methods=["GET"])
+def get_index_suggestions() -> Response:
+    """
+    Suggest the indexes missing for the recorded query shapes: the equality filters, then the sort, then a range
+    filter of each shape, unless an existing index starts with these columns. With format=sql or format=alembic,
+    get the script creating them, the Alembic migration following the 'down_revision' query parameter.
+    :return: a json containing the suggested indexes, or the migration script.
+    """
+    require_admin()
+    limit = max(request.args.get('limit', 50, type=int), 1)
+    script_format = request.args.get('format', 'json')
+    if script_format not in ('json', 'sql', 'alembic'):
+        abort(400, description=f"Invalid format: {script_format}")
+
+    suggestions = suggest_indexes(db.session.connection(), recorded_shapes(limit))
+    dialect_name = db.engine.dialect.name
+    db.session.rollback()
+    if script_format == 'sql':
+        return Response(migration_sql(suggestions, dialect_name), mimetype='application/sql')
+    if script_format == 'alembic':
+        return Response(migration_script(suggestions, request.args.get('down_revision')), mimetype='text/x-python')
+    return json_response({'suggested_indexes': suggestions})
+
+
+@api_bp.route("/admin/replicas", methods=["GET"])
+def get_replicas() -> Response:
+    """
+    Get the replication lag of the read replicas measured by this process, the replicas serving the reads,
+    and the number of reads sent to the replicas and to the primary when no replica was healthy.
+    :return: a json containing the state of the replicas, or null without replicas.
+    """
+    require_admin()
+    router = get_replica_router()
+    return json_response({'replicas': router.stats() if router is not None else None})
 
 
 @api_bp.route("/etablissements", methods=["POST"])
@@ -119,22 +722,10 @@ def create_etablissement() -> (Response, int):
     Create a new Etablissement. The fields 'siret', 'siren' and 'nic' are required.
     :return: a json containing the created etablissement or an error message.
     """
-    data = request.get_json()
-    if not data:
-        abort(400, description="No input data provided")
-
-    # Ensure obligatory fields are provided
-    required_fields = ['siret', 'siren', 'nic']
-    missing_fields = [field for field in required_fields if field not in data]
-    if missing_fields:
-        abort(400, description=f"Missing required field(s): {', '.join(missing_fields)}")
-
-    # Convert 'date_creation' to datetime.date if it's present
-    if 'date_creation' in data:
-        try:
-            data['date_creation'] = datetime.strptime(data['date_creation'], '%Y-%m-%d').date()
-        except ValueError as e:
-            abort(400, description=f"Invalid date format for 'date_creation': {e}")
+    try:
+        data = validate_new_etablissement(request.get_json())
+    except ValueError as e:
+        abort(400, description=str(e))
 
     # Check if Etablissement with the same SIRET already exists
     existing_etablissement = Etablissement.query.get(data['siret'])
@@ -166,24 +757,14 @@ def update_etablissement(siret: str) -> Response:
     if etablissement is None:
         abort(404, description="Etablissement not found")
 
-    data = request.get_json()
-    if not data:
-        abort(400, description="No input data provided")
-
-    # Prevent changing the obligatory fields
-    unmodifiable_fields = ['siret', 'siren', 'nic']
-    for field in unmodifiable_fields:
-        if field in data:
-            abort(400, description=f"Cannot change the '{field}' of an Etablissement")
+    try:
+        data = validate_etablissement_changes(request.get_json())
+    except ValueError as e:
+        abort(400, description=str(e))
 
     # Update fields
-    inspector = inspect(Etablissement)
-    valid_fields = [column.key for column in inspector.mapper.column_attrs]
     for key, value in data.items():
-        if key in valid_fields:
-            setattr(etablissement, key, value)
-        else:
-            abort(400, description=f"Invalid field: {key}")
+        setattr(etablissement, key, value)
 
     try:
         db.session.commit()
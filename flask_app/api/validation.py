@@ -0,0 +1,68 @@
+"""
+Validation of the Etablissement records sent to the write routes.
+"""
+
+from datetime import date, datetime
+
+from flask_app.api.serializers import ETABLISSEMENT_FIELD_SET, ETABLISSEMENT_COLUMN_TYPES
+
+# Fields that must be given to create an Etablissement
+REQUIRED_FIELDS = ('siret', 'siren', 'nic')
+
+# Fields that identify an Etablissement and cannot be changed once it is created
+IMMUTABLE_FIELDS = ('siret', 'siren', 'nic')
+
+
+def convert_values(data: dict) -> dict:
+    """
+    Checks the fields of a record and converts the dates given as strings.
+    :param data: the record sent by the client.
+    :return: a new record with the converted values.
+    :raise ValueError: if a field is unknown or a date is malformed.
+    """
+    values = {}
+    for key, value in data.items():
+        if key not in ETABLISSEMENT_FIELD_SET:
+            raise ValueError(f"Invalid field: {key}")
+        if isinstance(value, str):
+            try:
+                if ETABLISSEMENT_COLUMN_TYPES[key] is date:
+                    value = datetime.strptime(value, '%Y-%m-%d').date()
+                elif ETABLISSEMENT_COLUMN_TYPES[key] is datetime:
+                    value = datetime.fromisoformat(value)
+            except ValueError as e:
+                raise ValueError(f"Invalid date format for '{key}': {e}") from e
+        values[key] = value
+    return values
+
+
+def validate_new_etablissement(data) -> dict:
+    """
+    Validates a record of a new Etablissement.
+    :param data: the record sent by the client.
+    :return: the converted record.
+    :raise ValueError: if the record is empty, lacks a required field or has an invalid value.
+    """
+    if not data or not isinstance(data, dict):
+        raise ValueError("No input data provided")
+
+    missing_fields = [field for field in REQUIRED_FIELDS if field not in data]
+    if missing_fields:
+        raise ValueError(f"Missing required field(s): {', '.join(missing_fields)}")
+    return convert_values(data)
+
+
+def validate_etablissement_changes(data) -> dict:
+    """
+    Validates the changes of an existing Etablissement.
+    :param data: the changed fields sent by the client.
+    :return: the converted changes.
+    :raise ValueError: if there are no changes, an immutable field is changed or a value is invalid.
+    """
+    if not data or not isinstance(data, dict):
+        raise ValueError("No input data provided")
+
+    for field in IMMUTABLE_FIELDS:
+        if field in data:
+            raise ValueError(f"Cannot change the '{field}' of an Etablissement")
+    return convert_values(data)
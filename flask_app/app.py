@@ -6,8 +6,16 @@ from flask import Flask
 from flask_migrate import Migrate
 from flask_app.db import db
 from flask_app.api.routes import api_bp
+from flask_app.cli import audit_cli, ingest_cli
 from flask_app.db.init_db import initialize_database
-from flask_app import db_url
+from flask_app.db.routing import engine_options, REPLICA_BIND_PREFIX
+from flask_app.metrics import metrics_bp
+from flask_app import db_url, ingest_workers, ingest_chunk_size, count_cache_ttl, json_date_format, \
+    lookup_max_items, bulk_max_items, bulk_chunk_size, audit_ingest_mode, audit_retention_months, \
+    detail_cache_size, detail_cache_ttl, detail_cache_url, list_cache_size, list_cache_ttl, query_shapes_size, \
+    admin_token, metrics_sample_rate, n_plus_one_threshold, init_lock_file, ingest_on_startup, ingest_csv_path, \
+    ingest_lock_file, ingest_snapshot_path, db_replica_urls, replica_max_lag, replica_check_interval, db_pool_size, \
+    db_max_overflow, db_pool_timeout, db_pool_recycle, db_pool_pre_ping, web_concurrency
 
 
 def create_app() -> Flask:
@@ -19,6 +27,40 @@ def create_app() -> Flask:
     flask_app = Flask(__name__)
     flask_app.config["SQLALCHEMY_DATABASE_URI"] = db_url
     flask_app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    pool_options = (db_pool_size, db_max_overflow, db_pool_timeout, db_pool_recycle, db_pool_pre_ping)
+    flask_app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(db_url, *pool_options)
+    flask_app.config["SQLALCHEMY_BINDS"] = {
+        f"{REPLICA_BIND_PREFIX}{index}": {"url": url, **engine_options(url, *pool_options)}
+        for index, url in enumerate(db_replica_urls)
+    }
+    flask_app.config["REPLICA_MAX_LAG"] = replica_max_lag
+    flask_app.config["REPLICA_CHECK_INTERVAL"] = replica_check_interval
+    flask_app.config["INGEST_WORKERS"] = ingest_workers
+    flask_app.config["INGEST_CHUNK_SIZE"] = ingest_chunk_size
+    flask_app.config["COUNT_CACHE_TTL"] = count_cache_ttl
+    flask_app.config["JSON_DATE_FORMAT"] = json_date_format
+    flask_app.config["LOOKUP_MAX_ITEMS"] = lookup_max_items
+    flask_app.config["BULK_MAX_ITEMS"] = bulk_max_items
+    flask_app.config["BULK_CHUNK_SIZE"] = bulk_chunk_size
+    flask_app.config["AUDIT_INGEST_MODE"] = audit_ingest_mode
+    flask_app.config["AUDIT_RETENTION_MONTHS"] = audit_retention_months
+    flask_app.config["DETAIL_CACHE_SIZE"] = detail_cache_size
+    flask_app.config["DETAIL_CACHE_TTL"] = detail_cache_ttl
+    flask_app.config["DETAIL_CACHE_URL"] = detail_cache_url
+    flask_app.config["WEB_CONCURRENCY"] = web_concurrency
+    flask_app.config["LIST_CACHE_SIZE"] = list_cache_size
+    flask_app.config["LIST_CACHE_TTL"] = list_cache_ttl
+    flask_app.config["QUERY_SHAPES_SIZE"] = query_shapes_size
+    flask_app.config["ADMIN_TOKEN"] = admin_token
+    flask_app.config["METRICS_SAMPLE_RATE"] = metrics_sample_rate
+    flask_app.config["N_PLUS_ONE_THRESHOLD"] = n_plus_one_threshold
+    if init_lock_file:
+        flask_app.config["INIT_LOCK_FILE"] = init_lock_file
+    flask_app.config["INGEST_ON_STARTUP"] = ingest_on_startup
+    flask_app.config["INGEST_CSV_PATH"] = ingest_csv_path
+    flask_app.config["INGEST_SNAPSHOT_PATH"] = ingest_snapshot_path
+    if ingest_lock_file:
+        flask_app.config["INGEST_LOCK_FILE"] = ingest_lock_file
 
     # Initialize extensions
     db.init_app(flask_app)
@@ -26,10 +68,19 @@ def create_app() -> Flask:
 
     # Register blueprints
     flask_app.register_blueprint(api_bp, url_prefix="/api")
+    flask_app.register_blueprint(metrics_bp)
+
+    # Register CLI commands
+    flask_app.cli.add_command(ingest_cli)
+    flask_app.cli.add_command(audit_cli)
 
     # Run database initialization (if needed)
     with flask_app.app_context():
         initialize_database()
+        # Close the connections of the initialization, so that the workers forked from a preloaded app
+        # do not share them and open their own
+        for engine in db.engines.values():
+            engine.dispose()
 
     return flask_app
 
@@ -0,0 +1,155 @@
+"""
+Asynchronous (ASGI) Flask-compatible application, serving the Etablissement routes with an async database driver.
+"""
+
+import asyncio
+
+from flask import Flask
+from hypercorn.middleware import AsyncioWSGIMiddleware
+from quart import abort, g, Quart
+from werkzeug.exceptions import HTTPException
+from werkzeug.routing import Map
+
+from flask_app.api.async_routes import async_api_bp
+from flask_app.db.async_db import async_database_url, create_async_database
+from flask_app.db.routing import engine_options
+from flask_app import db_url, json_date_format, lookup_max_items, db_pool_size, db_max_overflow, db_pool_timeout, \
+    db_pool_recycle, db_pool_pre_ping, async_max_concurrency, ingest_csv_path, \
+    ingest_snapshot_path
+
+# Default maximum number of requests served at once by a process, the others being rejected with a 503 status
+DEFAULT_ASYNC_MAX_CONCURRENCY = 2000
+
+# Maximum size in bytes of the request bodies passed to the Flask app, which the bulk writes of many records reach
+WSGI_MAX_BODY_SIZE = 256 * 1024 * 1024
+
+
+def matched_rule(url_map: Map, scope: dict) -> str | None:
+    """
+    Finds the rule of a URL map matching the path and the method of a request.
+    :param url_map: the URL map of an app.
+    :param scope: the ASGI scope of the request.
+    :return: the rule, like '/api/etablissements/<string:siret>', or None if no rule matches.
+    """
+    try:
+        rule, _ = url_map.bind('localhost').match(scope['path'], method=scope['method'], return_rule=True)
+    except HTTPException:
+        return None
+    return rule.rule
+
+
+class FlaskFallback:
+    """
+    ASGI middleware sending the requests of the routes not ported to the async app (export, search, bulk, audit,
+    admin...) to the Flask app, run in the threads of the executor of the event loop. A request goes to the async app
+    when its route is the one of the Flask app: /etablissements/export does not go to /etablissements/<siret>.
+    """
+
+    def __init__(self, async_app: Quart, flask_app: Flask, max_body_size: int = WSGI_MAX_BODY_SIZE):
+        """
+        Wraps the ASGI callable of the async app.
+        :param async_app: the async app.
+        :param flask_app: the Flask app serving the other routes.
+        :param max_body_size: the maximum size in bytes of the request bodies passed to the Flask app.
+        """
+        self.async_app = async_app
+        self.asgi_app = async_app.asgi_app
+        self.flask_app = flask_app
+        self.wsgi_app = AsyncioWSGIMiddleware(self.read_whole_input, max_body_size)
+
+    def read_whole_input(self, environ: dict, start_response):
+        """
+        Runs the Flask app on a request whose body was read before, so that its input is read whole even without
+        a Content-Length header, like with a chunked body.
+        :param environ: the WSGI environment of the request.
+        :param start_response: the WSGI callable starting the response.
+        :return: the body of the response.
+        """
+        environ['wsgi.input_terminated'] = True
+        return self.flask_app(environ, start_response)
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope['type'] == 'http':
+            rule = matched_rule(self.flask_app.url_map, scope)
+            if rule is not None and rule != matched_rule(self.async_app.url_map, scope):
+                await self.wsgi_app(scope, receive, send)
+                return
+        await self.asgi_app(scope, receive, send)
+
+
+def create_async_app(initialize: bool = True, flask_app: Flask | None = None) -> Quart:
+    """
+    ASGI application factory.
+    Creates the async app serving the /api/etablissements routes, and the other routes with the Flask app.
+    The database is initialized by the Flask app, with its single initializer, and the asyncio engine is created
+    in each worker once its event loop runs.
+    :param initialize: whether to create the Flask app, initializing the database like it does at startup.
+    :param flask_app: the Flask app serving the routes not ported to the async app, instead of a new one.
+    :return: a new Quart app instance.
+    """
+    if flask_app is None and initialize:
+        from flask_app.app import create_app
+        flask_app = create_app()
+
+    async_app = Quart(__name__)
+    async_app.config["SQLALCHEMY_DATABASE_URI"] = db_url
+    async_app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(
+        db_url, db_pool_size, db_max_overflow, db_pool_timeout, db_pool_recycle, db_pool_pre_ping, asynchronous=True)
+    async_app.config["JSON_DATE_FORMAT"] = json_date_format
+    async_app.config["LOOKUP_MAX_ITEMS"] = lookup_max_items
+    async_app.config["ASYNC_MAX_CONCURRENCY"] = async_max_concurrency
+    async_app.config["INGEST_CSV_PATH"] = ingest_csv_path
+    async_app.config["INGEST_SNAPSHOT_PATH"] = ingest_snapshot_path
+
+    async_app.register_blueprint(async_api_bp, url_prefix="/api")
+    if flask_app is not None:
+        async_app.asgi_app = FlaskFallback(async_app, flask_app)
+
+    @async_app.before_serving
+    async def open_database() -> None:
+        """
+        Creates the asyncio engine of the database and the limit of the requests served at once.
+        :return: None
+        """
+        url = async_database_url(async_app.config["SQLALCHEMY_DATABASE_URI"], async_app.instance_path)
+        engine, sessionmaker = create_async_database(url, async_app.config.get("SQLALCHEMY_ENGINE_OPTIONS", {}))
+        async_app.extensions['async_engine'] = engine
+        async_app.extensions['async_sessionmaker'] = sessionmaker
+        async_app.extensions['async_slots'] = asyncio.Semaphore(
+            async_app.config.get("ASYNC_MAX_CONCURRENCY", DEFAULT_ASYNC_MAX_CONCURRENCY))
+
+    @async_app.after_serving
+    async def close_database() -> None:
+        """
+        Closes the connections of the asyncio engine.
+        :return: None
+        """
+        engine = async_app.extensions.pop('async_engine', None)
+        if engine is not None:
+            await engine.dispose()
+
+    @async_app.before_request
+    async def take_slot() -> None:
+        """
+        Takes a slot for the request, rejecting it with a 503 status when all the slots are taken,
+        so that the memory of a process stays bounded whatever the load. Waiting for a database connection
+        is bounded by the pool timeout.
+        :return: None
+        """
+        slots = async_app.extensions['async_slots']
+        if slots.locked():
+            abort(503, description="Too many requests in progress, retry later")
+        await slots.acquire()
+        g.async_slot = True
+
+    @async_app.teardown_request
+    async def release_slot(exception) -> None:
+        """
+        Releases the slot of the request.
+        :param exception: the exception raised by the request, if any.
+        :return: None
+        """
+        if g.pop('async_slot', False):
+            async_app.extensions['async_slots'].release()
+
+    return async_app
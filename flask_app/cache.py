@@ -0,0 +1,203 @@
+"""
+In-process and shared caches.
+"""
+
+import json
+import threading
+import time
+
+from collections import OrderedDict
+from typing import Any, Hashable
+
+try:
+    import redis
+except ImportError:  # pragma: no cover - redis is optional, the in-process cache is used without it
+    redis = None
+
+# Returned by the get method of the caches when a key is missing or expired
+MISSING = object()
+
+
+class TTLCache:
+    """
+    Thread-safe in-process cache with a time to live per entry and a maximum number of entries.
+    The least recently used entries are evicted first when the cache is full.
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: float = 60.0):
+        """
+        Initializes an empty cache.
+        :param max_size: the maximum number of entries.
+        :param ttl: the default time to live of the entries, in seconds.
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key: Hashable, default: Any = MISSING) -> Any:
+        """
+        Reads an entry of the cache.
+        :param key: the key of the entry.
+        :param default: the value returned when the entry is missing or expired.
+        :return: the cached value, or the default value.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            expires_at, value = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: Hashable, value: Any, ttl: float | None = None) -> None:
+        """
+        Writes an entry of the cache, evicting the least recently used entries if the cache is full.
+        :param key: the key of the entry.
+        :param value: the value to cache.
+        :param ttl: the time to live of the entry in seconds, defaults to the ttl of the cache.
+        :return: None
+        """
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key: Hashable) -> None:
+        """
+        Removes an entry of the cache, if present.
+        :param key: the key of the entry.
+        :return: None
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        """
+        Removes all the entries of the cache.
+        :return: None
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        """
+        Counts the entries of the cache, expired entries included until they are read.
+        :return: the number of entries.
+        """
+        return len(self._entries)
+
+    def stats(self) -> dict:
+        """
+        Gets the counters of the cache.
+        :return: the number of hits, misses, evictions and expirations, the hit ratio, the size and the maximum size.
+        """
+        lookups = self.hits + self.misses
+        return {
+            'backend': 'local',
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': round(self.hits / lookups, 4) if lookups else None,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'size': len(self),
+            'max_size': self.max_size,
+        }
+
+
+class RedisCache:
+    """
+    Cache shared by the processes of the application, stored in Redis with a time to live per entry.
+    The values are stored as JSON. It has the interface of TTLCache, which stands in for it when Redis is not used.
+    """
+
+    def __init__(self, url: str, prefix: str, ttl: float = 60.0):
+        """
+        Initializes the client of the cache, the connection being opened on first use.
+        :param url: the URL of the Redis server, like redis://cache:6379/0.
+        :param prefix: the prefix of the keys of the cache, so that several caches can share a server.
+        :param ttl: the default time to live of the entries, in seconds.
+        """
+        if redis is None:
+            raise RuntimeError("The redis package is required to use a shared cache")
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    def _key(self, key: Hashable) -> str:
+        """
+        Builds the Redis key of an entry.
+        :param key: the key of the entry.
+        :return: the prefixed key.
+        """
+        return f"{self.prefix}:{key}"
+
+    def get(self, key: Hashable, default: Any = MISSING) -> Any:
+        """
+        Reads an entry of the cache.
+        :param key: the key of the entry.
+        :param default: the value returned when the entry is missing or expired.
+        :return: the cached value, or the default value.
+        """
+        value = self.client.get(self._key(key))
+        if value is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return json.loads(value)
+
+    def set(self, key: Hashable, value: Any, ttl: float | None = None) -> None:
+        """
+        Writes an entry of the cache.
+        :param key: the key of the entry.
+        :param value: the JSON-serializable value to cache.
+        :param ttl: the time to live of the entry in seconds, defaults to the ttl of the cache.
+        :return: None
+        """
+        self.client.set(self._key(key), json.dumps(value), px=int((self.ttl if ttl is None else ttl) * 1000))
+
+    def delete(self, key: Hashable) -> None:
+        """
+        Removes an entry of the cache, if present.
+        :param key: the key of the entry.
+        :return: None
+        """
+        self.client.delete(self._key(key))
+
+    def clear(self) -> None:
+        """
+        Removes all the entries of the cache.
+        :return: None
+        """
+        keys = list(self.client.scan_iter(match=f"{self.prefix}:*", count=1000))
+        for start in range(0, len(keys), 1000):
+            self.client.delete(*keys[start:start + 1000])
+
+    def stats(self) -> dict:
+        """
+        Gets the counters of this process, the evictions being handled by the Redis server.
+        :return: the number of hits and misses and the hit ratio.
+        """
+        lookups = self.hits + self.misses
+        return {
+            'backend': 'redis',
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': round(self.hits / lookups, 4) if lookups else None,
+        }
@@ -0,0 +1,108 @@
+"""
+Command line interface of the Flask application.
+"""
+
+import click
+
+from flask import current_app
+from flask.cli import AppGroup
+
+from flask_app.db import db
+from flask_app.db.audit import DEFAULT_AUDIT_INGEST_MODE
+from flask_app.db.audit_storage import DEFAULT_AUDIT_RETENTION_MONTHS, maintain_audit_log
+from flask_app.db.delta_sync import DEFAULT_SYNC_BATCH_SIZE, sync_csv
+from flask_app.db.init_db import run_ingest
+from flask_app.db.snapshot import DEFAULT_ROW_GROUP_SIZE, DEFAULT_SNAPSHOT_COMPRESSION, DEFAULT_SNAPSHOT_FORMAT, \
+    SNAPSHOT_FORMATS, pyarrow, write_snapshot
+
+ingest_cli = AppGroup('ingest', help="Load and synchronize the SIRENE data.")
+
+audit_cli = AppGroup('audit', help="Maintain the audit log.")
+
+
+@ingest_cli.command('load')
+@click.option('--csv-path', type=click.Path(exists=True, dir_okay=False), default=None,
+              help="Path of the StockEtablissement CSV file. Defaults to INGEST_CSV_PATH.")
+@click.option('--snapshot', 'snapshot_path', type=click.Path(exists=True, file_okay=False), default=None,
+              help="Directory of a snapshot written by `flask ingest snapshot`, loaded instead of the CSV file. "
+                   "Defaults to INGEST_SNAPSHOT_PATH.")
+@click.option('--wait/--no-wait', default=True, show_default=True,
+              help="Wait for the ingest running in another process to finish, instead of exiting.")
+def load_command(csv_path: str | None, snapshot_path: str | None, wait: bool) -> None:
+    """
+    Loads the snapshot, or else the CSV file, into an empty Etablissement table, or resumes its interrupted load,
+    then builds the missing indexes. Follow the progress with /api/ingest/status.
+    :param csv_path: path of the StockEtablissement CSV file.
+    :param snapshot_path: directory of the snapshot.
+    :param wait: whether to wait for the ingest running in another process.
+    :return: None
+    """
+    if csv_path is not None:
+        current_app.config['INGEST_CSV_PATH'] = csv_path
+    if snapshot_path is not None:
+        current_app.config['INGEST_SNAPSHOT_PATH'] = snapshot_path
+    if not run_ingest(wait):
+        raise click.ClickException("The CSV file is loaded by another process.")
+
+
+@ingest_cli.command('sync')
+@click.argument('csv_path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--batch-size', type=int, default=DEFAULT_SYNC_BATCH_SIZE, show_default=True,
+              help="Number of rows compared and written per transaction.")
+def sync_command(csv_path: str, batch_size: int) -> None:
+    """
+    Applies the inserts, updates and closures of a new stock or daily update file.
+    :param csv_path: path of the StockEtablissement-shaped CSV file.
+    :param batch_size: number of rows compared and written per transaction.
+    :return: None
+    """
+    stats = sync_csv(csv_path, batch_size,
+                     audit_mode=current_app.config.get('AUDIT_INGEST_MODE', DEFAULT_AUDIT_INGEST_MODE))
+    click.echo(f"Synchronized {stats['rows']} rows in {stats['seconds']}s: {stats['inserted']} inserted, "
+               f"{stats['updated']} updated ({stats['closed']} closed), {stats['unchanged']} unchanged, "
+               f"{stats['superseded']} superseded.")
+
+
+@ingest_cli.command('snapshot')
+@click.argument('path', type=click.Path(file_okay=False))
+@click.option('--format', 'snapshot_format', type=click.Choice(SNAPSHOT_FORMATS), default=DEFAULT_SNAPSHOT_FORMAT,
+              show_default=True, help="Parquet files, or Arrow IPC files memory-mapped without copy when uncompressed.")
+@click.option('--compression', default=DEFAULT_SNAPSHOT_COMPRESSION, show_default=True,
+              help="Compression codec: zstd, lz4, none, or snappy and gzip for Parquet.")
+@click.option('--row-group-size', type=int, default=DEFAULT_ROW_GROUP_SIZE, show_default=True,
+              help="Number of rows of the row groups.")
+def snapshot_command(path: str, snapshot_format: str, compression: str, row_group_size: int) -> None:
+    """
+    Writes a typed columnar snapshot of the Etablissement table, one file per département, replacing the
+    previous snapshot of the directory once complete.
+    :param path: directory of the snapshot.
+    :param snapshot_format: 'parquet' or 'arrow'.
+    :param compression: the compression codec.
+    :param row_group_size: number of rows of the row groups.
+    :return: None
+    """
+    if pyarrow is None:
+        raise click.ClickException("The snapshots require pyarrow: pip install pyarrow")
+    with db.engine.connect() as connection:
+        stats = write_snapshot(connection, path, snapshot_format, None if compression == 'none' else compression,
+                               row_group_size)
+    click.echo(f"Wrote {stats['rows']} rows into {stats['partitions']} partitions ({stats['bytes']} bytes) "
+               f"in {stats['seconds']}s.")
+
+
+@audit_cli.command('maintain')
+@click.option('--retention-months', type=int, default=None,
+              help="Number of months of audit history kept, 0 keeps everything. Defaults to AUDIT_RETENTION_MONTHS.")
+def maintain_command(retention_months: int | None) -> None:
+    """
+    Upgrades an audit_log table created by a previous version, creates the audit_log partitions of the coming months
+    (or archives the past months) and drops the expired ones. To be run at least monthly, for example from cron.
+    :param retention_months: number of months of audit history kept.
+    :return: None
+    """
+    if retention_months is None:
+        retention_months = current_app.config.get('AUDIT_RETENTION_MONTHS', DEFAULT_AUDIT_RETENTION_MONTHS)
+    with db.engine.begin() as connection:
+        changes = maintain_audit_log(connection, retention_months)
+    click.echo(f"Upgraded: {', '.join(changes['upgraded']) or 'none'}. Created: {', '.join(changes['created']) or 'none'}. "
+               f"Archived: {', '.join(changes['archived']) or 'none'}. Dropped: {', '.join(changes['dropped']) or 'none'}.")
@@ -4,5 +4,7 @@ Initialization file for the database management.
 
 from flask_sqlalchemy import SQLAlchemy
 
-# Initialize the SQLAlchemy instance
-db = SQLAlchemy()
+from flask_app.db.routing import RoutingSession
+
+# Initialize the SQLAlchemy instance, whose sessions send the reads of the read requests to the replicas
+db = SQLAlchemy(session_options={'class_': RoutingSession})
@@ -0,0 +1,48 @@
+"""
+Asynchronous access to the database with SQLAlchemy's asyncio extension, used by the ASGI serving mode.
+"""
+
+import os
+
+from sqlalchemy import make_url
+from sqlalchemy.ext.asyncio import async_sessionmaker, AsyncEngine, AsyncSession, create_async_engine
+
+# Asynchronous driver of each supported database
+ASYNC_DRIVERS = {
+    'postgresql': 'asyncpg',
+    'sqlite': 'aiosqlite',
+}
+
+
+def async_database_url(url: str, instance_path: str | None = None) -> str:
+    """
+    Converts the URL of the database to use its asynchronous driver. Relative SQLite paths are resolved
+    against the instance folder, like Flask-SQLAlchemy does, so that both serving modes use the same file.
+    :param url: the URL of the database, with any driver.
+    :param instance_path: the instance folder of the app.
+    :return: the URL with the asynchronous driver.
+    :raise ValueError: if the database has no supported asynchronous driver.
+    """
+    parsed = make_url(url)
+    backend = parsed.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        raise ValueError(f"No asynchronous driver for {backend} databases, use one of: {', '.join(ASYNC_DRIVERS)}")
+
+    parsed = parsed.set(drivername=f"{backend}+{ASYNC_DRIVERS[backend]}")
+    if backend == 'sqlite' and parsed.database not in (None, '', ':memory:') and instance_path is not None \
+            and not parsed.database.startswith('file:') and not os.path.isabs(parsed.database):
+        parsed = parsed.set(database=os.path.join(instance_path, parsed.database))
+    return parsed.render_as_string(hide_password=False)
+
+
+def create_async_database(url: str, options: dict) -> tuple[AsyncEngine, async_sessionmaker[AsyncSession]]:
+    """
+    Creates the asyncio engine of the database and the factory of its sessions.
+    The sessions do not expire the objects on commit, since an expired attribute cannot be loaded implicitly
+    with asyncio.
+    :param url: the URL of the database, with its asynchronous driver.
+    :param options: the options of the engine.
+    :return: the engine and the session factory.
+    """
+    engine = create_async_engine(url, **options)
+    return engine, async_sessionmaker(engine, expire_on_commit=False)
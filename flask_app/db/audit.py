@@ -0,0 +1,167 @@
+"""
+Audit of the changes of the database, recorded as the changed columns of each row.
+"""
+
+import datetime
+
+from sqlalchemy import event, insert, inspect
+from sqlalchemy.engine import Connection
+from sqlalchemy.orm import Session
+
+from flask_app.db.models import AuditLog
+
+# Audit of the bulk writers (ingest and delta sync): one summary entry per batch, one entry per row, or none
+AUDIT_INGEST_MODES = ('batch', 'row', 'off')
+DEFAULT_AUDIT_INGEST_MODE = 'batch'
+
+audit_table = AuditLog.__table__
+
+
+def serialize_value(value):
+    """
+    Converts dates and datetimes into ISO 8601 strings to make them JSON serializable.
+    :param value: the value to serialize.
+    :return: the serialized value.
+    """
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    return value
+
+
+def serialize_row_data(row_data: dict) -> dict:
+    """
+    Serialize row data to make it JSON serializable.
+    :param row_data: the data to serialize.
+    :return: the serialized data.
+    """
+    return {key: serialize_value(value) for key, value in row_data.items()}
+
+
+def audit_entry(table_name: str, operation: str, row_data: dict, record_id: str | None = None) -> dict:
+    """
+    Builds an audit entry, as a row of the audit_log table.
+    :param table_name: name of the affected table.
+    :param operation: 'INSERT', 'UPDATE', 'DELETE', or the name of a bulk writer for summary entries.
+    :param row_data: the recorded data.
+    :param record_id: the primary key of the affected row, None for summary entries.
+    :return: the values of the audit_log row.
+    """
+    return {'table_name': table_name, 'operation': operation, 'row_data': row_data, 'record_id': record_id}
+
+
+def insert_data(values: dict) -> dict:
+    """
+    Builds the data of an INSERT entry: the columns that were given a value.
+    :param values: the values of the inserted row.
+    :return: the serialized non-null values.
+    """
+    return {key: serialize_value(value) for key, value in values.items() if value is not None}
+
+
+def update_data(key: dict, old: dict, new: dict) -> dict | None:
+    """
+    Builds the data of an UPDATE entry: the primary key of the row and the old and new values
+    of its changed columns.
+    :param key: the primary key of the row.
+    :param old: the stored values of the changed columns.
+    :param new: the new values of the columns.
+    :return: the serialized changes, or None if no value changed.
+    """
+    changes = {
+        column: {'old': serialize_value(old.get(column)), 'new': serialize_value(value)}
+        for column, value in new.items()
+        if column not in key and old.get(column) != value
+    }
+    if not changes:
+        return None
+    return {**serialize_row_data(key), 'changes': changes}
+
+
+def instance_entry(operation: str, instance) -> dict | None:
+    """
+    Builds the audit entry of an ORM instance flushed to the database.
+    The old values of the updated columns come from the attribute history of the instance.
+    :param operation: 'INSERT', 'UPDATE' or 'DELETE'.
+    :param instance: the flushed instance.
+    :return: the audit entry, or None if an updated instance has no changed column.
+    """
+    state = inspect(instance)
+    columns = [attribute.key for attribute in state.mapper.column_attrs]
+    table_name = instance.__tablename__
+    key = {column.key: getattr(instance, column.key) for column in state.mapper.primary_key}
+    record_id = ','.join(str(value) for value in key.values())
+
+    if operation == 'INSERT':
+        return audit_entry(table_name, operation, insert_data({key: getattr(instance, key) for key in columns}),
+                           record_id)
+    if operation == 'DELETE':
+        return audit_entry(table_name, operation,
+                           serialize_row_data({key: getattr(instance, key) for key in columns}), record_id)
+
+    old = {}
+    new = {}
+    for column in columns:
+        history = state.attrs[column].history
+        if history.added or history.deleted:
+            old[column] = history.deleted[0] if history.deleted else None
+            new[column] = history.added[0] if history.added else None
+    data = update_data(key, old, new)
+    return audit_entry(table_name, operation, data, record_id) if data is not None else None
+
+
+def write_audit_entries(connection: Connection, entries: list[dict]) -> None:
+    """
+    Writes audit entries with one multi-row insert.
+    :param connection: the connection of the audited transaction.
+    :param entries: the audit entries.
+    :return: None
+    """
+    if entries:
+        connection.execute(insert(audit_table), entries)
+
+
+def batch_entries(mode: str, table_name: str, operation: str, summary: dict, inserted: list[dict] = (),
+                  updated: list[tuple[dict, dict, dict]] = (), key: str = 'siret') -> list[dict]:
+    """
+    Builds the audit entries of a batch of a bulk writer, following the audit mode of the bulk writers.
+    :param mode: 'batch' for one summary entry, 'row' for one entry per written row, 'off' for none.
+    :param table_name: name of the affected table.
+    :param operation: name of the bulk writer, recorded as the operation of the summary entry.
+    :param summary: the data of the summary entry.
+    :param inserted: the values of the inserted rows.
+    :param updated: the primary key, stored values and new values of the updated rows.
+    :param key: the primary key column of the table.
+    :return: the audit entries.
+    """
+    if mode == 'off':
+        return []
+    if mode == 'batch':
+        return [audit_entry(table_name, operation, serialize_row_data(summary))]
+
+    entries = [audit_entry(table_name, 'INSERT', insert_data(values), values[key]) for values in inserted]
+    for row_key, old, new in updated:
+        data = update_data(row_key, old, new)
+        if data is not None:
+            entries.append(audit_entry(table_name, 'UPDATE', data, row_key[key]))
+    return entries
+
+
+@event.listens_for(Session, "after_flush")
+def audit_flush(session: Session, flush_context) -> None:
+    """
+    Event listener recording the inserts, updates and deletes of a flush with one multi-row insert.
+    The new, dirty and deleted collections and the attribute history still describe the flushed changes.
+    :param session: The SQLAlchemy Session instance that flushed.
+    :param flush_context: Flush-specific context provided by SQLAlchemy (not used here).
+    :return: None
+    """
+    entries = []
+    for operation, instances in (('INSERT', session.new), ('UPDATE', session.dirty), ('DELETE', session.deleted)):
+        for instance in instances:
+            # Skip logging for the AuditLog table itself
+            if isinstance(instance, AuditLog):
+                continue
+            entry = instance_entry(operation, instance)
+            if entry is not None:
+                entries.append(entry)
+    write_audit_entries(session.connection(), entries)
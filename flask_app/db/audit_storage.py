@@ -0,0 +1,379 @@
+"""
+Monthly storage of the audit_log table: native range partitions on PostgreSQL, rollover into monthly
+archive tables on the other databases, and retention by dropping whole months.
+"""
+
+import datetime
+import re
+
+from sqlalchemy import DateTime, TextClause, bindparam, column, func, inspect, select, table, text, union_all, update
+from sqlalchemy.engine import Connection
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.schema import CreateIndex, CreateTable
+
+from flask_app.db.models import AuditLog, Etablissement
+
+# Number of monthly partitions created in advance on PostgreSQL, after the current month
+PARTITIONS_AHEAD = 2
+
+# Number of months of audit history kept, 0 keeps everything
+DEFAULT_AUDIT_RETENTION_MONTHS = 12
+
+audit_table = AuditLog.__table__
+
+DEFAULT_PARTITION = f"{audit_table.name}_default"
+
+# Name of an audit_log table created before the partitioning, while it is copied into the partitioned one
+UNPARTITIONED_TABLE = f"{audit_table.name}_unpartitioned"
+
+_MONTH_TABLE = re.compile(rf"^{audit_table.name}_(\d{{4}})_(\d{{2}})$")
+
+
+@compiles(CreateTable, 'postgresql')
+def create_partitioned_audit_log(element, compiler, **kw) -> str:
+    """
+    Creates the audit_log table partitioned by range of timestamp on PostgreSQL.
+    The primary key of a partitioned table must contain the partition key.
+    :param element: the CREATE TABLE construct.
+    :param compiler: the DDL compiler of the dialect.
+    :return: the CREATE TABLE statement.
+    """
+    ddl = compiler.visit_create_table(element, **kw)
+    if element.element is not audit_table:
+        return ddl
+    quote = compiler.preparer.quote
+    ddl = ddl.replace(f"PRIMARY KEY ({quote('id')})", f"PRIMARY KEY ({quote('id')}, {quote('timestamp')})")
+    return f"{ddl.rstrip()} PARTITION BY RANGE ({quote('timestamp')})\n\n"
+
+
+def month_start(day: datetime.date) -> datetime.date:
+    """
+    Gets the first day of the month of a date.
+    :param day: the date.
+    :return: the first day of its month.
+    """
+    return datetime.date(day.year, day.month, 1)
+
+
+def add_months(month: datetime.date, months: int) -> datetime.date:
+    """
+    Moves the first day of a month by a number of months.
+    :param month: the first day of a month.
+    :param months: the number of months to add, possibly negative.
+    :return: the first day of the resulting month.
+    """
+    index = month.year * 12 + month.month - 1 + months
+    return datetime.date(index // 12, index % 12 + 1, 1)
+
+
+def month_table_name(month: datetime.date) -> str:
+    """
+    Names the partition or archive table of a month.
+    :param month: the first day of the month.
+    :return: the table name, like audit_log_2024_03.
+    """
+    return f"{audit_table.name}_{month.year:04d}_{month.month:02d}"
+
+
+def month_tables(connection: Connection) -> dict[datetime.date, str]:
+    """
+    Lists the monthly partitions or archive tables of the audit_log table.
+    :param connection: an open connection to the database.
+    :return: the table names, by first day of their month.
+    """
+    names = set(inspect(connection).get_table_names())
+    if connection.dialect.name == 'postgresql':
+        # The partitions are listed from the catalog, whatever the reflection does with them
+        names.update(connection.execute(
+            text("SELECT child.relname FROM pg_inherits JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+                 "WHERE pg_inherits.inhparent = CAST(:table AS regclass)"),
+            {'table': audit_table.name}
+        ).scalars())
+
+    tables = {}
+    for name in names:
+        match = _MONTH_TABLE.match(name)
+        if match:
+            tables[datetime.date(int(match.group(1)), int(match.group(2)), 1)] = name
+    return tables
+
+
+def is_partitioned(connection: Connection) -> bool:
+    """
+    Tells whether the audit_log table is natively partitioned, a table created before the partitioning
+    was introduced is not.
+    :param connection: an open connection to the database.
+    :return: True on PostgreSQL when audit_log is a partitioned table.
+    """
+    if connection.dialect.name != 'postgresql':
+        return False
+    return connection.execute(
+        text("SELECT 1 FROM pg_partitioned_table WHERE partrelid = CAST(:table AS regclass)"),
+        {'table': audit_table.name}
+    ).first() is not None
+
+
+def _today() -> datetime.date:
+    """
+    Gets the current UTC date, the timestamps of the audit entries being written by the database.
+    :return: the current date.
+    """
+    return datetime.datetime.now(datetime.timezone.utc).date()
+
+
+def _timestamps(statement: TextClause, *names: str) -> TextClause:
+    """
+    Types bound parameters of a textual statement as timestamps, so that they are written like
+    the timestamps of the audit_log table on every database.
+    :param statement: the textual statement.
+    :param names: the names of the timestamp parameters.
+    :return: the typed statement.
+    """
+    return statement.bindparams(*[bindparam(name, type_=DateTime) for name in names])
+
+
+def create_partitions(connection: Connection, today: datetime.date, ahead: int = PARTITIONS_AHEAD,
+                      since: datetime.date | None = None) -> list[str]:
+    """
+    Creates the partitions of the current and next months, and the default partition receiving the
+    entries of the months without a partition.
+    :param connection: an open connection to a PostgreSQL database.
+    :param today: the current date.
+    :param ahead: the number of months created after the current month.
+    :param since: a date of the first month created, defaults to the current month.
+    :return: the names of the created partitions.
+    """
+    existing = set(month_tables(connection).values())
+    preparer = connection.dialect.identifier_preparer
+    created = []
+    month = month_start(since if since is not None else today)
+    while month <= add_months(month_start(today), ahead):
+        name = month_table_name(month)
+        if name not in existing:
+            connection.execute(text(
+                f"CREATE TABLE {preparer.quote(name)} PARTITION OF {preparer.quote(audit_table.name)} "
+                f"FOR VALUES FROM ('{month.isoformat()}') TO ('{add_months(month, 1).isoformat()}')"
+            ))
+            created.append(name)
+        month = add_months(month, 1)
+    connection.execute(text(
+        f"CREATE TABLE IF NOT EXISTS {preparer.quote(DEFAULT_PARTITION)} "
+        f"PARTITION OF {preparer.quote(audit_table.name)} DEFAULT"
+    ))
+    return created
+
+
+def rollover(connection: Connection, today: datetime.date) -> list[str]:
+    """
+    Moves the entries of the past months of the audit_log table into one archive table per month,
+    so that audit_log only holds the current month.
+    :param connection: an open connection to the database.
+    :param today: the current date.
+    :return: the names of the archive tables that received entries.
+    """
+    current = month_start(today)
+    oldest = connection.execute(
+        select(func.min(audit_table.c.timestamp)).where(audit_table.c.timestamp < current)
+    ).scalar()
+    if oldest is None:
+        return []
+
+    preparer = connection.dialect.identifier_preparer
+    source = preparer.quote(audit_table.name)
+    timestamp = preparer.quote('timestamp')
+    in_month = f"{timestamp} >= :start AND {timestamp} < :end"
+    has_entries = _timestamps(text(f"SELECT 1 FROM {source} WHERE {in_month} LIMIT 1"), 'start', 'end')
+    delete_entries = _timestamps(text(f"DELETE FROM {source} WHERE {in_month}"), 'start', 'end')
+
+    archived = []
+    month = month_start(oldest)
+    while month < current:
+        bounds = {'start': datetime.datetime.combine(month, datetime.time()),
+                  'end': datetime.datetime.combine(add_months(month, 1), datetime.time())}
+        if connection.execute(has_entries, bounds).first():
+            name = month_table_name(month)
+            archive = preparer.quote(name)
+            connection.execute(text(f"CREATE TABLE IF NOT EXISTS {archive} AS SELECT * FROM {source} WHERE 1 = 0"))
+            connection.execute(text(
+                f"CREATE INDEX IF NOT EXISTS {preparer.quote(f'idx_{name}_record_id')} "
+                f"ON {archive} (record_id, {timestamp})"
+            ))
+            connection.execute(
+                _timestamps(text(f"INSERT INTO {archive} SELECT * FROM {source} WHERE {in_month}"), 'start', 'end'),
+                bounds
+            )
+            connection.execute(delete_entries, bounds)
+            archived.append(name)
+        month = add_months(month, 1)
+    return archived
+
+
+def drop_expired(connection: Connection, today: datetime.date, retention_months: int) -> list[str]:
+    """
+    Drops the monthly partitions or archive tables older than the retention period.
+    :param connection: an open connection to the database.
+    :param today: the current date.
+    :param retention_months: the number of months kept, the current one included. 0 keeps everything.
+    :return: the names of the dropped tables.
+    """
+    if retention_months <= 0:
+        return []
+    cutoff = add_months(month_start(today), 1 - retention_months)
+    preparer = connection.dialect.identifier_preparer
+    dropped = []
+    for month, name in sorted(month_tables(connection).items()):
+        if month < cutoff:
+            connection.execute(text(f"DROP TABLE {preparer.quote(name)}"))
+            dropped.append(name)
+
+    if is_partitioned(connection):
+        # Entries of months without a partition land in the default partition
+        connection.execute(
+            _timestamps(text(f"DELETE FROM {preparer.quote(DEFAULT_PARTITION)} "
+                             f"WHERE {preparer.quote('timestamp')} < :cutoff"), 'cutoff'),
+            {'cutoff': datetime.datetime.combine(cutoff, datetime.time())}
+        )
+    return dropped
+
+
+def partition_audit_log(connection: Connection, today: datetime.date) -> None:
+    """
+    Converts an audit_log table created before the partitioning into a partitioned table on PostgreSQL:
+    the table is renamed, the partitioned table is created with the partitions of the months of its entries,
+    then the entries are copied into it and the former table is dropped.
+    :param connection: an open connection to a PostgreSQL database, in a transaction.
+    :param today: the current date.
+    :return: Nothing.
+    """
+    preparer = connection.dialect.identifier_preparer
+    source, legacy = preparer.quote(audit_table.name), preparer.quote(UNPARTITIONED_TABLE)
+    inspector = inspect(connection)
+    columns = [audit_column['name'] for audit_column in inspector.get_columns(audit_table.name)
+               if audit_column['name'] in audit_table.c]
+    primary_key = inspector.get_pk_constraint(audit_table.name)['name']
+    sequence = connection.execute(text(f"SELECT pg_get_serial_sequence('{source}', 'id')")).scalar()
+
+    # The constraint, the indexes and the sequence keep their names when the table is renamed, free them
+    connection.execute(text(f"ALTER TABLE {source} RENAME TO {legacy}"))
+    if primary_key:
+        connection.execute(text(f"ALTER TABLE {legacy} RENAME CONSTRAINT {preparer.quote(primary_key)} "
+                                f"TO {preparer.quote(f'{UNPARTITIONED_TABLE}_pkey')}"))
+    if sequence:
+        connection.execute(text(f"ALTER SEQUENCE {sequence} RENAME TO {preparer.quote(f'{UNPARTITIONED_TABLE}_id_seq')}"))
+    for index in audit_table.indexes:
+        connection.execute(text(f"DROP INDEX IF EXISTS {preparer.quote(index.name)}"))
+
+    audit_table.create(connection)
+    oldest = connection.execute(text(f"SELECT min({preparer.quote('timestamp')}) FROM {legacy}")).scalar()
+    create_partitions(connection, today, since=oldest.date() if oldest is not None else None)
+    copied = ', '.join(preparer.quote(name) for name in columns)
+    connection.execute(text(f"INSERT INTO {source} ({copied}) SELECT {copied} FROM {legacy}"))
+    connection.execute(text(f"SELECT setval(pg_get_serial_sequence('{source}', 'id'), max(id)) FROM {source}"))
+    connection.execute(text(f"DROP TABLE {legacy}"))
+
+
+def upgrade_audit_log(connection: Connection, today: datetime.date | None = None) -> list[str]:
+    """
+    Brings an audit_log table created by a previous version in line with the model, which create_all does not do
+    for a table that already exists: converts it into a partitioned table on PostgreSQL, adds the record_id column,
+    filled with the siret of the audited Etablissements, and creates the missing indexes.
+    :param connection: an open connection to the database, in a transaction.
+    :param today: the current date, defaults to the current UTC date.
+    :return: the names of the upgraded tables.
+    """
+    if not inspect(connection).has_table(audit_table.name):
+        return []
+    today = today if today is not None else _today()
+    upgraded = []
+    if connection.dialect.name == 'postgresql' and not is_partitioned(connection):
+        partition_audit_log(connection, today)
+        upgraded.append(audit_table.name)
+
+    if 'record_id' not in {audit_column['name'] for audit_column in inspect(connection).get_columns(audit_table.name)}:
+        record_id = audit_table.c.record_id
+        connection.execute(text(
+            f"ALTER TABLE {connection.dialect.identifier_preparer.quote(audit_table.name)} "
+            f"ADD COLUMN {record_id.name} {record_id.type.compile(dialect=connection.dialect)}"
+        ))
+        siret = Etablissement.__table__.primary_key.columns.keys()[0]
+        connection.execute(
+            update(audit_table)
+            .where(audit_table.c.table_name == Etablissement.__tablename__,
+                   audit_table.c.operation.in_(('INSERT', 'UPDATE', 'DELETE')))
+            .values(record_id=audit_table.c.row_data[siret].as_string())
+        )
+        upgraded.append(audit_table.name)
+
+    for index in audit_table.indexes:
+        connection.execute(CreateIndex(index, if_not_exists=True))
+    return sorted(set(upgraded))
+
+
+def maintain_audit_log(connection: Connection, retention_months: int = DEFAULT_AUDIT_RETENTION_MONTHS,
+                       today: datetime.date | None = None) -> dict:
+    """
+    Upgrades an audit_log table created by a previous version, prepares the storage of the coming months
+    and applies the retention: creates the next partitions on a partitioned PostgreSQL table, rolls the past months
+    over into archive tables otherwise, then drops the months older than the retention period.
+    :param connection: an open connection to the database, in a transaction.
+    :param retention_months: the number of months kept, the current one included. 0 keeps everything.
+    :param today: the current date, defaults to the current UTC date.
+    :return: the names of the upgraded, created, archived and dropped tables.
+    """
+    today = today if today is not None else _today()
+    upgraded = upgrade_audit_log(connection, today)
+    if is_partitioned(connection):
+        created, archived = create_partitions(connection, today), []
+    else:
+        created, archived = [], rollover(connection, today)
+    return {'upgraded': upgraded, 'created': created, 'archived': archived,
+            'dropped': drop_expired(connection, today, retention_months)}
+
+
+def audit_sources(connection: Connection, since: datetime.datetime | None = None,
+                  until: datetime.datetime | None = None) -> list:
+    """
+    Lists the tables holding the audit entries of a time range: audit_log alone when it is partitioned,
+    since PostgreSQL prunes the partitions itself, audit_log and the overlapping archive tables otherwise.
+    :param connection: an open connection to the database.
+    :param since: the start of the time range, None for no lower bound.
+    :param until: the end of the time range, None for no upper bound.
+    :return: the table constructs to read.
+    """
+    if is_partitioned(connection):
+        return [audit_table]
+
+    sources = [audit_table]
+    for month, name in sorted(month_tables(connection).items(), reverse=True):
+        if since is not None and datetime.datetime.combine(add_months(month, 1), datetime.time()) <= since:
+            continue
+        if until is not None and datetime.datetime.combine(month, datetime.time()) > until:
+            continue
+        sources.append(table(name, *[column(audit_column.name, audit_column.type)
+                                     for audit_column in audit_table.columns]))
+    return sources
+
+
+def select_audit_entries(connection: Connection, filters: dict, since: datetime.datetime | None = None,
+                         until: datetime.datetime | None = None):
+    """
+    Builds the query of the audit entries matching filters and a time range, newest first,
+    over audit_log and the archive tables of the time range.
+    :param connection: an open connection to the database.
+    :param filters: the required values, by column of audit_log (table_name, operation, record_id).
+    :param since: the start of the time range (included), None for no lower bound.
+    :param until: the end of the time range (excluded), None for no upper bound.
+    :return: the select statement of the entries.
+    """
+    statements = []
+    for source in audit_sources(connection, since, until):
+        conditions = [source.c[key] == value for key, value in filters.items()]
+        if since is not None:
+            conditions.append(source.c.timestamp >= since)
+        if until is not None:
+            conditions.append(source.c.timestamp < until)
+        statements.append(select(*[source.c[audit_column.name] for audit_column in audit_table.columns])
+                          .where(*conditions))
+
+    statement = statements[0] if len(statements) == 1 else union_all(*statements)
+    return statement.order_by(statement.selected_columns.timestamp.desc(), statement.selected_columns.id.desc())
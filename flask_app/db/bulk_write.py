@@ -0,0 +1,141 @@
+"""
+Batched inserts and updates of Etablissements sent through the bulk write API.
+"""
+
+from sqlalchemy import bindparam, insert, select, update
+from sqlalchemy.engine import Connection, Engine
+
+from flask_app.db import db
+from flask_app.db.audit import audit_entry, insert_data, update_data, write_audit_entries
+from flask_app.db.events import bump_etablissements_version, notify_etablissements_changed
+from flask_app.db.models import Etablissement
+
+# Number of records written in one transaction
+DEFAULT_BULK_CHUNK_SIZE = 1000
+
+BULK_MODES = ('insert', 'update', 'upsert')
+
+etablissement_table = Etablissement.__table__
+
+_COLUMNS = [column.name for column in etablissement_table.columns]
+
+
+def _fetch_existing(connection: Connection, sirets: list[str]) -> dict[str, dict]:
+    """
+    Reads the stored rows of the Etablissements of a chunk.
+    :param connection: the connection of the chunk transaction.
+    :param sirets: the SIRETs of the chunk.
+    :return: the stored rows as dictionaries, by SIRET.
+    """
+    rows = connection.execute(select(etablissement_table).where(etablissement_table.c.siret.in_(sirets))).mappings()
+    return {row['siret']: dict(row) for row in rows}
+
+
+def _update_rows(connection: Connection, changes: list[dict]) -> None:
+    """
+    Updates existing rows with one executemany UPDATE per set of changed columns.
+    :param connection: the connection of the chunk transaction.
+    :param changes: the changed values of each row, with its SIRET.
+    :return: None
+    """
+    groups: dict[tuple, list[dict]] = {}
+    for change in changes:
+        groups.setdefault(tuple(sorted(key for key in change if key != 'siret')), []).append(change)
+
+    for keys, rows in groups.items():
+        if not keys:
+            continue
+        statement = (
+            update(etablissement_table)
+            .where(etablissement_table.c.siret == bindparam('key_siret'))
+            .values({key: bindparam(key) for key in keys})
+        )
+        connection.execute(statement, [
+            {'key_siret': row['siret'], **{key: row[key] for key in keys}} for row in rows
+        ])
+
+
+def write_chunk(connection: Connection, mode: str, records: list[tuple[int, dict]]) -> list[dict]:
+    """
+    Writes a chunk of validated records: one read of the stored rows, one multi-row INSERT,
+    one multi-row UPDATE per set of changed columns, and one multi-row insert of the audit entries,
+    which record the changed columns only.
+    :param connection: the connection of the chunk transaction.
+    :param mode: 'insert', 'update' or 'upsert'.
+    :param records: the validated records with their index in the request. The records of the 'update'
+    mode contain the SIRET and the changed fields, the other modes contain the required fields.
+    :return: the status of each record, in order.
+    """
+    existing = _fetch_existing(connection, [record['siret'] for _, record in records])
+
+    statuses = []
+    inserts = []
+    updates = []
+    audit_entries = []
+    for index, record in records:
+        siret = record['siret']
+        stored = existing.get(siret)
+        status = {'index': index, 'siret': siret}
+        statuses.append(status)
+
+        if stored is None:
+            if mode == 'update':
+                status.update(status='error', error="Etablissement not found")
+                continue
+            row = {column: record.get(column) for column in _COLUMNS}
+            inserts.append(row)
+            audit_entries.append(audit_entry(etablissement_table.name, 'INSERT', insert_data(row), siret))
+            status['status'] = 'inserted'
+            continue
+
+        if mode == 'insert':
+            status.update(status='error', error="Etablissement with this SIRET already exists")
+            continue
+        changed_keys = [field for field in ('siren', 'nic') if field in record and record[field] != stored[field]]
+        if changed_keys:
+            status.update(status='error', error=f"Cannot change the '{changed_keys[0]}' of an Etablissement")
+            continue
+        updates.append(record)
+        changes = update_data({'siret': siret}, stored, record)
+        if changes is not None:
+            audit_entries.append(audit_entry(etablissement_table.name, 'UPDATE', changes, siret))
+        status['status'] = 'updated'
+
+    if inserts:
+        connection.execute(insert(etablissement_table), inserts)
+    if updates:
+        _update_rows(connection, updates)
+    write_audit_entries(connection, audit_entries)
+    return statuses
+
+
+def bulk_write(mode: str, records: list[tuple[int, dict]], chunk_size: int = DEFAULT_BULK_CHUNK_SIZE,
+               engine: Engine | None = None) -> list[dict]:
+    """
+    Writes validated records in chunks, one transaction per chunk. A chunk rejected by the database
+    is rolled back and all its records are reported as errors, the other chunks are still written.
+    :param mode: 'insert', 'update' or 'upsert'.
+    :param records: the validated records with their index in the request.
+    :param chunk_size: the number of records written per transaction.
+    :param engine: the engine of the database, defaults to the engine of the Flask app.
+    :return: the status of each record.
+    """
+    engine = engine if engine is not None else db.engine
+    statuses = []
+    for start in range(0, len(records), chunk_size):
+        chunk = records[start:start + chunk_size]
+        try:
+            with engine.begin() as connection:
+                chunk_statuses = write_chunk(connection, mode, chunk)
+                written = {status['siret'] for status in chunk_statuses if status['status'] != 'error'}
+                if written:
+                    bump_etablissements_version(connection)
+        except Exception as e:
+            statuses.extend({'index': index, 'siret': record['siret'], 'status': 'error',
+                             'error': f"Error writing Etablissements: {e}"} for index, record in chunk)
+            continue
+
+        statuses.extend(chunk_statuses)
+        if written:
+            notify_etablissements_changed('bulk', written)
+    return statuses
@@ -0,0 +1,89 @@
+"""
+Durable checkpoints of the CSV ingest, used to resume an interrupted load.
+"""
+
+import os
+
+from sqlalchemy import insert, select, update
+from sqlalchemy.engine import Connection
+
+from flask_app.db import db
+from flask_app.db.models import IngestCheckpoint
+
+checkpoint_table = IngestCheckpoint.__table__
+
+
+def file_identity(csv_path: str) -> dict:
+    """
+    Identifies a version of a CSV file by its path, size and modification time.
+    :param csv_path: path of the CSV file.
+    :return: the identity columns of the checkpoints of the file.
+    """
+    stat = os.stat(csv_path)
+    return {
+        'source_path': os.path.abspath(csv_path),
+        'source_size': stat.st_size,
+        'source_mtime_ns': stat.st_mtime_ns,
+    }
+
+
+def load_checkpoints(connection: Connection, identity: dict) -> list[dict]:
+    """
+    Reads the checkpoints of a version of a CSV file.
+    :param connection: an open connection to the database.
+    :param identity: the identity of the file, as returned by file_identity.
+    :return: the checkpoints ordered by range start, as dictionaries.
+    """
+    query = select(checkpoint_table).where(
+        *[checkpoint_table.c[key] == value for key, value in identity.items()]
+    ).order_by(checkpoint_table.c.range_start)
+    return [dict(row._mapping) for row in connection.execute(query)]
+
+
+def create_checkpoints(connection: Connection, identity: dict, ranges: list[tuple[int, int]],
+                       data_start: int) -> list[dict]:
+    """
+    Records one checkpoint per byte range before the ingest of a file starts.
+    :param connection: an open connection to the database.
+    :param identity: the identity of the file, as returned by file_identity.
+    :param ranges: the (start, end) offsets of the byte ranges.
+    :param data_start: offset of the first data record, the header line being line 1 of the first range.
+    :return: the created checkpoints ordered by range start, as dictionaries.
+    """
+    if ranges:
+        connection.execute(insert(checkpoint_table), [
+            dict(identity, range_start=start, range_end=end, byte_offset=start,
+                 line_number=1 if start == data_start else 0, rows_loaded=0, completed=False)
+            for start, end in ranges
+        ])
+    return load_checkpoints(connection, identity)
+
+
+def advance_checkpoint(connection: Connection, checkpoint_id: int, byte_offset: int, line_number: int,
+                       rows_loaded: int, completed: bool = False) -> None:
+    """
+    Moves a checkpoint forward. Must run in the transaction of the batch it records.
+    :param connection: the connection of the batch transaction.
+    :param checkpoint_id: the id of the checkpoint.
+    :param byte_offset: offset of the first byte not loaded yet.
+    :param line_number: last line committed, counted from the start of the range.
+    :param rows_loaded: number of rows committed for the range.
+    :param completed: whether the whole range has been loaded.
+    :return: None
+    """
+    connection.execute(
+        update(checkpoint_table)
+        .where(checkpoint_table.c.id == checkpoint_id)
+        .values(byte_offset=byte_offset, line_number=line_number, rows_loaded=rows_loaded,
+                completed=completed, updated_at=db.func.now())
+    )
+
+
+def has_incomplete_checkpoints(connection: Connection) -> bool:
+    """
+    Tells whether an ingest of any file was interrupted.
+    :param connection: an open connection to the database.
+    :return: True if at least one checkpoint is not completed.
+    """
+    query = select(checkpoint_table.c.id).where(checkpoint_table.c.completed.is_(False)).limit(1)
+    return connection.execute(query).first() is not None
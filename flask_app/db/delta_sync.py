@@ -0,0 +1,151 @@
+"""
+Incremental synchronization of the Etablissement table with a new SIRENE stock or daily update file.
+"""
+
+import os
+import time
+
+from sqlalchemy import select
+from sqlalchemy.engine import Connection, Engine
+
+from flask_app.db import db
+from flask_app.db.audit import DEFAULT_AUDIT_INGEST_MODE, batch_entries, write_audit_entries
+from flask_app.db.events import bump_etablissements_version, notify_etablissements_changed
+from flask_app.db.ingest import ByteRangeReader, iter_batches, read_header, upsert_rows
+from flask_app.db.models import Etablissement
+from flask_app.db.parsers import CSV_FIELDS, make_row_converter
+
+# Number of rows compared with the database and written in one transaction
+DEFAULT_SYNC_BATCH_SIZE = 5000
+
+# Administrative state of a closed establishment
+CLOSED_STATE = 'F'
+
+etablissement_table = Etablissement.__table__
+
+_SIRET = CSV_FIELDS.index('siret')
+_DATE_DERNIER_TRAITEMENT = CSV_FIELDS.index('date_dernier_traitement')
+_ETAT_ADMINISTRATIF = CSV_FIELDS.index('etat_administratif')
+
+
+def is_newer(incoming, stored) -> bool:
+    """
+    Tells whether an incoming date_dernier_traitement may carry changes compared to the stored one.
+    Rows without a date cannot be ordered and are always compared by content.
+    :param incoming: the date of the row of the file.
+    :param stored: the date of the row of the database.
+    :return: True if the row must be compared by content.
+    """
+    return incoming is None or stored is None or incoming > stored
+
+
+def latest_versions(batch: list[tuple]) -> list[tuple]:
+    """
+    Keeps only the most recent version of each SIRET of a batch, update files may contain several.
+    :param batch: the converted rows.
+    :return: the rows, one per SIRET.
+    """
+    latest = {}
+    for row in batch:
+        current = latest.get(row[_SIRET])
+        if current is None or is_newer(row[_DATE_DERNIER_TRAITEMENT], current[_DATE_DERNIER_TRAITEMENT]):
+            latest[row[_SIRET]] = row
+    return list(latest.values())
+
+
+def sync_batch(connection: Connection, batch: list[tuple], audit_mode: str = DEFAULT_AUDIT_INGEST_MODE) -> dict:
+    """
+    Applies the inserts, updates and closures of a batch of converted rows.
+    Only the date_dernier_traitement of the existing rows is read for the whole batch, the full rows are
+    read only for the rows with a newer date, and rows equal to the stored ones are not written.
+    :param connection: the connection of the batch transaction.
+    :param batch: the converted rows, ordered like CSV_FIELDS.
+    :param audit_mode: 'batch' for one audit entry per batch, 'row' for one per written row, 'off' for none.
+    :return: the number of rows inserted, updated and unchanged, of older versions of a SIRET of the batch
+    (superseded), and of written rows closing an establishment (closed, inserted or updated), with the SIRETs
+    of the written rows.
+    """
+    rows = latest_versions(batch)
+    stats = {'inserted': 0, 'updated': 0, 'closed': 0, 'unchanged': 0, 'superseded': len(batch) - len(rows)}
+
+    stored_dates = dict(connection.execute(
+        select(etablissement_table.c.siret, etablissement_table.c.date_dernier_traitement)
+        .where(etablissement_table.c.siret.in_([row[_SIRET] for row in rows]))
+    ).all())
+
+    changes = []
+    updated = []
+    candidates = {}
+    for row in rows:
+        siret = row[_SIRET]
+        if siret not in stored_dates:
+            changes.append(row)
+            stats['inserted'] += 1
+            if row[_ETAT_ADMINISTRATIF] == CLOSED_STATE:
+                stats['closed'] += 1
+        elif is_newer(row[_DATE_DERNIER_TRAITEMENT], stored_dates[siret]):
+            candidates[siret] = row
+        else:
+            stats['unchanged'] += 1
+
+    if candidates:
+        columns = [etablissement_table.c[field] for field in CSV_FIELDS]
+        stored_rows = connection.execute(
+            select(*columns).where(etablissement_table.c.siret.in_(list(candidates)))
+        ).all()
+        for stored in stored_rows:
+            row = candidates[stored[_SIRET]]
+            if row == tuple(stored):
+                stats['unchanged'] += 1
+                continue
+            changes.append(row)
+            updated.append(({'siret': stored[_SIRET]}, dict(zip(CSV_FIELDS, stored)), dict(zip(CSV_FIELDS, row))))
+            stats['updated'] += 1
+            if row[_ETAT_ADMINISTRATIF] == CLOSED_STATE and stored[_ETAT_ADMINISTRATIF] != CLOSED_STATE:
+                stats['closed'] += 1
+
+    written = [dict(zip(CSV_FIELDS, row)) for row in changes]
+    upsert_rows(connection, written)
+    if written:
+        # The inserted rows come first in the changes, before the updated ones
+        write_audit_entries(connection, batch_entries(
+            audit_mode, etablissement_table.name, 'SYNC', stats,
+            inserted=written[:stats['inserted']], updated=updated
+        ))
+    stats['sirets'] = {row[_SIRET] for row in changes}
+    return stats
+
+
+def sync_csv(csv_path: str, batch_size: int = DEFAULT_SYNC_BATCH_SIZE, engine: Engine | None = None,
+             audit_mode: str = DEFAULT_AUDIT_INGEST_MODE) -> dict:
+    """
+    Synchronizes the Etablissement table with a new stock or daily update file, one transaction per batch.
+    :param csv_path: path of the StockEtablissement-shaped CSV file.
+    :param batch_size: number of rows compared and written per transaction.
+    :param engine: the engine of the synchronized database, defaults to the engine of the Flask app.
+    :param audit_mode: 'batch' for one audit entry per batch, 'row' for one per written row, 'off' for none.
+    :return: the statistics of the run (rows read, inserted, updated, closed, unchanged, superseded, seconds).
+    """
+    engine = engine if engine is not None else db.engine
+    start = time.perf_counter()
+    header, data_start = read_header(csv_path)
+    stats = {'rows': 0, 'inserted': 0, 'updated': 0, 'closed': 0, 'unchanged': 0, 'superseded': 0}
+
+    with open(csv_path, 'rb') as file:
+        reader = ByteRangeReader(file, data_start, os.path.getsize(csv_path))
+        for batch in iter_batches(reader, make_row_converter(header), batch_size):
+            with engine.begin() as connection:
+                batch_stats = sync_batch(connection, batch, audit_mode)
+                if batch_stats['sirets']:
+                    bump_etablissements_version(connection)
+            changed_sirets = batch_stats.pop('sirets')
+            if changed_sirets:
+                notify_etablissements_changed('sync', changed_sirets)
+            stats['rows'] += len(batch)
+            for key, value in batch_stats.items():
+                stats[key] += value
+            print(f"Synchronized {stats['rows']} rows: {stats['inserted']} inserted, {stats['updated']} updated "
+                  f"({stats['closed']} closed), {stats['unchanged']} unchanged, {stats['superseded']} superseded.")
+
+    stats['seconds'] = round(time.perf_counter() - start, 3)
+    return stats
@@ -0,0 +1,95 @@
+"""
+Notifications of the changes of the Etablissement table.
+"""
+
+from blinker import Namespace
+from sqlalchemy import event, select
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import Connection
+from sqlalchemy.orm import Session
+
+from flask_app.db.models import Etablissement, TableVersion
+
+version_table = TableVersion.__table__
+
+_signals = Namespace()
+
+# Sent after the rows of the Etablissement table changed, with the changed SIRETs (None when unknown)
+etablissements_changed = _signals.signal('etablissements-changed')
+
+
+def notify_etablissements_changed(sender: str, sirets: set[str] | None = None) -> None:
+    """
+    Notifies the receivers that rows of the Etablissement table were inserted, updated or deleted.
+    Called by the bulk writers, which do not go through the ORM session.
+    :param sender: the name of the writer.
+    :param sirets: the SIRETs of the changed rows, or None if they are unknown.
+    :return: None
+    """
+    etablissements_changed.send(sender, sirets=sirets)
+
+
+def bump_etablissements_version(connection: Connection) -> None:
+    """
+    Increments the version of the Etablissement table in the transaction writing it, so that every process
+    sees the new version when the transaction commits. The version row stays locked until the commit,
+    the bulk writers call it last in their transactions.
+    :param connection: the connection of the writing transaction, to a PostgreSQL or SQLite database.
+    :return: None
+    """
+    dialect_insert = postgresql.insert if connection.dialect.name == 'postgresql' else sqlite.insert
+    statement = dialect_insert(version_table).values(table_name=Etablissement.__tablename__, version=1)
+    connection.execute(statement.on_conflict_do_update(index_elements=['table_name'],
+                                                       set_={'version': version_table.c.version + 1}))
+
+
+def etablissements_version(connection: Connection | Session) -> int:
+    """
+    Reads the version of the Etablissement table, with a lookup of its primary key.
+    :param connection: a connection or a session of the database.
+    :return: the version, 0 for a table never written.
+    """
+    return connection.scalar(
+        select(version_table.c.version).where(version_table.c.table_name == Etablissement.__tablename__)
+    ) or 0
+
+
+@event.listens_for(Session, "after_flush")
+def collect_changed_etablissements(session: Session, flush_context) -> None:
+    """
+    Event listener collecting the SIRETs of the Etablissements flushed in the current transaction,
+    and bumping the version of the table in it.
+    :param session: The SQLAlchemy Session instance that flushed.
+    :param flush_context: Flush-specific context provided by SQLAlchemy (not used here).
+    :return: None
+    """
+    sirets = {
+        instance.siret
+        for instance in (*session.new, *session.dirty, *session.deleted)
+        if isinstance(instance, Etablissement)
+    }
+    if sirets:
+        session.info.setdefault('changed_sirets', set()).update(sirets)
+        bump_etablissements_version(session.connection())
+
+
+@event.listens_for(Session, "after_commit")
+def send_changed_etablissements(session: Session) -> None:
+    """
+    Event listener notifying the changes of the Etablissement table once they are committed.
+    :param session: The SQLAlchemy Session instance that committed.
+    :return: None
+    """
+    sirets = session.info.pop('changed_sirets', None)
+    if sirets:
+        notify_etablissements_changed('session', sirets)
+
+
+@event.listens_for(Session, "after_rollback")
+def discard_changed_etablissements(session: Session) -> None:
+    """
+    Event listener forgetting the changes of a rolled back transaction.
+    :param session: The SQLAlchemy Session instance that rolled back.
+    :return: None
+    """
+    session.info.pop('changed_sirets', None)
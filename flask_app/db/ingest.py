@@ -0,0 +1,458 @@
+"""
+Bulk ingest engine for the StockEtablissement CSV file.
+"""
+
+import csv
+import io
+import multiprocessing
+import os
+import time
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from datetime import date, datetime
+from typing import Callable, Iterable, Iterator
+
+from sqlalchemy import create_engine, insert
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.pool import NullPool
+
+from flask_app.db import db
+from flask_app.db.audit import DEFAULT_AUDIT_INGEST_MODE, batch_entries, write_audit_entries
+from flask_app.db.checkpoints import advance_checkpoint, create_checkpoints, file_identity, load_checkpoints
+from flask_app.db.events import bump_etablissements_version, notify_etablissements_changed
+from flask_app.db.models import Etablissement
+from flask_app.db.parsers import CSV_COLUMNS, CSV_FIELDS, make_row_converter, parse_bool, parse_date, \
+    parse_datetime, parse_int
+
+# Number of rows sent to the database in one COPY or executemany call, each batch in its own transaction
+DEFAULT_BATCH_SIZE = 50000
+
+# Approximate size in bytes of the byte ranges loaded by each worker of a parallel ingest
+DEFAULT_CHUNK_SIZE = 64 * 1024 * 1024
+
+# Size of the blocks read while looking for the record boundaries of the byte ranges
+READ_BLOCK_SIZE = 16 * 1024 * 1024
+
+COPY_SQL = f"COPY {Etablissement.__tablename__} ({', '.join(CSV_FIELDS)}) FROM STDIN"
+
+# Characters that must be escaped in the text format of COPY
+_COPY_ESCAPES = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
+
+
+def _format_text(value: str | None) -> str:
+    """
+    Formats a string value for the text format of COPY.
+    :param value: the value to format.
+    :return: the escaped value, or the NULL marker.
+    """
+    if value is None:
+        return '\\N'
+    return value.translate(_COPY_ESCAPES)
+
+
+def _format_int(value: int | None) -> str:
+    """
+    Formats an integer value for the text format of COPY.
+    :param value: the value to format.
+    :return: the value as text, or the NULL marker.
+    """
+    return '\\N' if value is None else str(value)
+
+
+def _format_bool(value: bool | None) -> str:
+    """
+    Formats a boolean value for the text format of COPY.
+    :param value: the value to format.
+    :return: 't' or 'f', or the NULL marker.
+    """
+    if value is None:
+        return '\\N'
+    return 't' if value else 'f'
+
+
+def _format_temporal(value: date | datetime | None) -> str:
+    """
+    Formats a date or datetime value for the text format of COPY.
+    :param value: the value to format.
+    :return: the ISO 8601 representation, or the NULL marker.
+    """
+    return '\\N' if value is None else value.isoformat()
+
+
+_FORMATTERS_BY_PARSER: dict[Callable, Callable] = {
+    parse_date: _format_temporal,
+    parse_datetime: _format_temporal,
+    parse_int: _format_int,
+    parse_bool: _format_bool,
+}
+
+# One COPY formatter per column, resolved once from the converter of the column
+COPY_FORMATTERS: list[Callable] = [_FORMATTERS_BY_PARSER.get(converter, _format_text)
+                                   for _, _, converter in CSV_COLUMNS]
+
+
+def copy_rows(connection: Connection, rows: list[tuple]) -> None:
+    """
+    Loads converted rows into the Etablissement table with PostgreSQL COPY FROM STDIN.
+    :param connection: an open connection to a PostgreSQL database.
+    :param rows: the converted rows, ordered like CSV_FIELDS.
+    :return: None
+    """
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write('\t'.join([formatter(value) for formatter, value in zip(COPY_FORMATTERS, row)]))
+        buffer.write('\n')
+    buffer.seek(0)
+
+    cursor = connection.connection.cursor()
+    try:
+        cursor.copy_expert(COPY_SQL, buffer)
+    finally:
+        cursor.close()
+
+
+def insert_rows(connection: Connection, rows: list[tuple]) -> None:
+    """
+    Loads converted rows into the Etablissement table with one executemany Core insert.
+    :param connection: an open connection to the database.
+    :param rows: the converted rows, ordered like CSV_FIELDS.
+    :return: None
+    """
+    connection.execute(insert(Etablissement.__table__), [dict(zip(CSV_FIELDS, row)) for row in rows])
+
+
+def upsert_rows(connection: Connection, rows: list[dict]) -> None:
+    """
+    Inserts rows into the Etablissement table, updating the existing rows with the same SIRET,
+    with one batched INSERT ... ON CONFLICT DO UPDATE statement.
+    All the rows must have the same keys.
+    :param connection: an open connection to a PostgreSQL or SQLite database.
+    :param rows: the rows to write, as dictionaries of column values.
+    :return: None
+    """
+    if not rows:
+        return
+    dialect_insert = postgresql.insert if connection.dialect.name == 'postgresql' else sqlite.insert
+    statement = dialect_insert(Etablissement.__table__)
+    update_columns = {key: statement.excluded[key] for key in rows[0] if key != 'siret'}
+    if update_columns:
+        statement = statement.on_conflict_do_update(index_elements=['siret'], set_=update_columns)
+    else:
+        statement = statement.on_conflict_do_nothing(index_elements=['siret'])
+    connection.execute(statement, rows)
+
+
+def write_rows(connection: Connection, rows: list[tuple]) -> None:
+    """
+    Loads converted rows with the fastest method supported by the database of the connection.
+    :param connection: an open connection to the database.
+    :param rows: the converted rows, ordered like CSV_FIELDS.
+    :return: None
+    """
+    if not rows:
+        return
+    if connection.dialect.name == 'postgresql':
+        copy_rows(connection, rows)
+    else:
+        insert_rows(connection, rows)
+
+
+def iter_batches(records: Iterable[list[str]], convert: Callable, batch_size: int) -> Iterable[list[tuple]]:
+    """
+    Converts raw CSV records and groups them into batches.
+    Empty records are skipped, like csv.DictReader does.
+    :param records: the raw CSV records.
+    :param convert: the row converter built from the CSV header.
+    :param batch_size: the maximum number of rows per batch.
+    :return: an iterator over the batches of converted rows.
+    """
+    batch = []
+    for record in records:
+        if not record:
+            continue
+        batch.append(convert(record))
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class ByteRangeReader:
+    """
+    Iterates over the CSV records of a byte range of the file, keeping track of the byte offset reached.
+    The range must start and end on record boundaries.
+    """
+
+    def __init__(self, file, start: int, end: int):
+        """
+        Initializes the reader and moves the file to the start of the range.
+        :param file: the CSV file, opened in binary mode.
+        :param start: offset of the first byte of the range.
+        :param end: offset of the first byte after the range.
+        """
+        self.file = file
+        self.position = start
+        self.end = end
+        self.line_count = 0
+        self.file.seek(start)
+
+    def _lines(self) -> Iterator[str]:
+        """
+        Decodes the lines of the range one by one.
+        :return: an iterator over the decoded lines.
+        """
+        for line in self.file:
+            self.position += len(line)
+            self.line_count += 1
+            yield line.decode('utf-8')
+            if self.position >= self.end:
+                return
+
+    def __iter__(self) -> Iterator[list[str]]:
+        """
+        Parses the lines of the range. The csv module pulls exactly the lines of each record, so
+        position is the offset of the end of the last record returned.
+        :return: an iterator over the raw CSV records.
+        """
+        if self.position >= self.end:
+            return iter(())
+        return iter(csv.reader(self._lines()))
+
+
+def read_header(csv_path: str) -> tuple[list[str], int]:
+    """
+    Reads the header line of the CSV file.
+    :param csv_path: path of the CSV file.
+    :return: the column names and the offset of the first data record.
+    """
+    with open(csv_path, 'rb') as file:
+        line = file.readline()
+    return next(csv.reader([line.decode('utf-8')]), []), len(line)
+
+
+def split_byte_ranges(csv_path: str, start: int, chunk_size: int = DEFAULT_CHUNK_SIZE) -> list[tuple[int, int]]:
+    """
+    Splits the CSV file into byte ranges of about chunk_size bytes aligned on record boundaries.
+    A newline ends a record only when it is preceded by an even number of quotes, so quoted values
+    spanning several lines are never cut.
+    :param csv_path: path of the CSV file.
+    :param start: offset of the first data record.
+    :param chunk_size: approximate size of the ranges in bytes.
+    :return: the list of (start, end) offsets of the ranges.
+    """
+    size = os.path.getsize(csv_path)
+    ranges = []
+    range_start = start
+    target = start + chunk_size
+    offset = start
+    quotes = 0
+
+    with open(csv_path, 'rb') as file:
+        file.seek(start)
+        while target < size:
+            block = file.read(READ_BLOCK_SIZE)
+            if not block:
+                break
+            block_end = offset + len(block)
+            search_from = 0
+            while target < block_end:
+                index = block.find(b'\n', max(target - offset, search_from))
+                if index == -1:
+                    break
+                if (quotes + block.count(b'"', 0, index)) % 2 == 0:
+                    boundary = offset + index + 1
+                    ranges.append((range_start, boundary))
+                    range_start = boundary
+                    target = boundary + chunk_size
+                search_from = index + 1
+            quotes += block.count(b'"')
+            offset = block_end
+
+    if range_start < size:
+        ranges.append((range_start, size))
+    return ranges
+
+
+def load_byte_range(engine: Engine, csv_path: str, header: list[str], checkpoint: dict,
+                    batch_size: int = DEFAULT_BATCH_SIZE,
+                    on_batch: Callable[[int, ByteRangeReader], None] | None = None,
+                    audit_mode: str = DEFAULT_AUDIT_INGEST_MODE) -> int:
+    """
+    Converts and loads the records of a byte range of the CSV file from its checkpoint, one transaction per batch.
+    The checkpoint moves forward in the transaction of each batch, so a batch is either loaded and recorded
+    or neither, and a resumed load starts right after the last committed record.
+    :param engine: the engine to load the data with.
+    :param csv_path: path of the CSV file.
+    :param header: the column names read from the header of the file.
+    :param checkpoint: the checkpoint of the range, as returned by load_checkpoints.
+    :param batch_size: number of rows loaded per transaction.
+    :param on_batch: optional callback called after each batch with the number of rows loaded so far and the reader.
+    :param audit_mode: 'batch' for one audit entry per batch, 'row' for one per row, 'off' for none.
+    :return: the number of rows loaded by this call.
+    """
+    rows_loaded = 0
+    with open(csv_path, 'rb') as file:
+        reader = ByteRangeReader(file, checkpoint['byte_offset'], checkpoint['range_end'])
+        batch_start = reader.position
+        for batch in iter_batches(reader, make_row_converter(header), batch_size):
+            rows_loaded += len(batch)
+            summary = {'source': csv_path, 'byte_start': batch_start, 'byte_end': reader.position, 'rows': len(batch)}
+            with engine.begin() as connection:
+                write_rows(connection, batch)
+                write_audit_entries(connection, batch_entries(
+                    audit_mode, Etablissement.__tablename__, 'INGEST', summary,
+                    inserted=(dict(zip(CSV_FIELDS, row)) for row in batch)
+                ))
+                advance_checkpoint(connection, checkpoint['id'], reader.position,
+                                   checkpoint['line_number'] + reader.line_count,
+                                   checkpoint['rows_loaded'] + rows_loaded)
+                bump_etablissements_version(connection)
+            notify_etablissements_changed('ingest')
+            batch_start = reader.position
+            if on_batch is not None:
+                on_batch(rows_loaded, reader)
+
+        with engine.begin() as connection:
+            advance_checkpoint(connection, checkpoint['id'], reader.position,
+                               checkpoint['line_number'] + reader.line_count,
+                               checkpoint['rows_loaded'] + rows_loaded, completed=True)
+    return rows_loaded
+
+
+def prepare_checkpoints(engine: Engine, csv_path: str,
+                        split: Callable[[int], list[tuple[int, int]]]) -> tuple[list[str], list[dict]]:
+    """
+    Reads the header of the CSV file and the checkpoints of its ingest, creating them on the first run.
+    A resumed ingest keeps the byte ranges of the first run, whatever the current chunk size.
+    :param engine: the engine of the loaded database.
+    :param csv_path: path of the CSV file.
+    :param split: function returning the byte ranges of a first run from the offset of the first data record.
+    :return: the column names of the file and the checkpoints of the ranges not completed yet.
+    """
+    header, data_start = read_header(csv_path)
+    identity = file_identity(csv_path)
+    with engine.begin() as connection:
+        checkpoints = load_checkpoints(connection, identity)
+        if not checkpoints:
+            checkpoints = create_checkpoints(connection, identity, split(data_start), data_start)
+
+    pending = [checkpoint for checkpoint in checkpoints if not checkpoint['completed']]
+    resumed = [checkpoint for checkpoint in pending if checkpoint['byte_offset'] > checkpoint['range_start']]
+    if resumed:
+        print(f"Resuming the ingest of {len(resumed)} byte ranges from their last checkpoint.")
+    return header, pending
+
+
+def ingest_stats(rows: int, elapsed: float) -> dict:
+    """
+    Builds the statistics of an ingest run.
+    :param rows: the number of rows loaded.
+    :param elapsed: the duration of the run in seconds.
+    :return: a dictionary with the number of rows, the duration and the rate.
+    """
+    return {
+        'rows': rows,
+        'seconds': round(elapsed, 3),
+        'rows_per_second': round(rows / elapsed, 1) if elapsed > 0 else 0.0,
+    }
+
+
+def bulk_load_csv(csv_path: str, batch_size: int = DEFAULT_BATCH_SIZE, engine: Engine | None = None,
+                  audit_mode: str = DEFAULT_AUDIT_INGEST_MODE) -> dict:
+    """
+    Streams the CSV file, converts its columns and loads the rows into the Etablissement table in batches.
+    Uses COPY FROM STDIN on PostgreSQL and batched executemany inserts on the other databases.
+    An interrupted load resumes from its last checkpoint.
+    :param csv_path: path of the StockEtablissement CSV file.
+    :param batch_size: number of rows loaded per transaction.
+    :param engine: the engine to load the data with, defaults to the engine of the Flask app.
+    :param audit_mode: 'batch' for one audit entry per batch, 'row' for one per row, 'off' for none.
+    :return: the statistics of the run (rows, seconds, rows_per_second).
+    """
+    engine = engine if engine is not None else db.engine
+    start = time.perf_counter()
+    size = os.path.getsize(csv_path)
+    header, checkpoints = prepare_checkpoints(
+        engine, csv_path, lambda data_start: [(data_start, size)] if size > data_start else []
+    )
+
+    def report(rows_loaded: int, reader: ByteRangeReader) -> None:
+        """
+        Prints the progress of the load after each batch.
+        :param rows_loaded: the number of rows loaded so far.
+        :param reader: the reader of the file.
+        :return: None
+        """
+        stats = ingest_stats(rows_loaded, time.perf_counter() - start)
+        print(f"Loaded {stats['rows']} rows up to byte {reader.position} ({stats['rows_per_second']} rows/s).")
+
+    rows_loaded = 0
+    for checkpoint in checkpoints:
+        rows_loaded += load_byte_range(engine, csv_path, header, checkpoint, batch_size, on_batch=report,
+                                       audit_mode=audit_mode)
+    return ingest_stats(rows_loaded, time.perf_counter() - start)
+
+
+def _load_shard(database_url: str, csv_path: str, header: list[str], checkpoint: dict, batch_size: int,
+                audit_mode: str) -> int:
+    """
+    Loads one byte range of the CSV file in a worker process, over a connection of its own.
+    :param database_url: the URL of the database to load the data into.
+    :param csv_path: path of the CSV file.
+    :param header: the column names read from the header of the file.
+    :param checkpoint: the checkpoint of the range.
+    :param batch_size: number of rows loaded per transaction.
+    :param audit_mode: 'batch' for one audit entry per batch, 'row' for one per row, 'off' for none.
+    :return: the number of rows loaded.
+    """
+    connect_args = {'timeout': 60} if database_url.startswith('sqlite') else {}
+    engine = create_engine(database_url, poolclass=NullPool, connect_args=connect_args)
+    try:
+        return load_byte_range(engine, csv_path, header, checkpoint, batch_size, audit_mode=audit_mode)
+    finally:
+        engine.dispose()
+
+
+def parallel_load_csv(csv_path: str, workers: int, chunk_size: int = DEFAULT_CHUNK_SIZE,
+                      batch_size: int = DEFAULT_BATCH_SIZE, engine: Engine | None = None,
+                      audit_mode: str = DEFAULT_AUDIT_INGEST_MODE) -> dict:
+    """
+    Splits the CSV file into byte ranges aligned on record boundaries and loads them concurrently,
+    each range being parsed, converted and loaded by a worker process over its own connection.
+    The database must be reachable from other processes (a file or a server, not an in-memory SQLite).
+    An interrupted load resumes each range from its last checkpoint.
+    :param csv_path: path of the StockEtablissement CSV file.
+    :param workers: number of worker processes.
+    :param chunk_size: approximate size of the byte ranges in bytes.
+    :param batch_size: number of rows loaded per transaction.
+    :param engine: the engine whose database is loaded, defaults to the engine of the Flask app.
+    :param audit_mode: 'batch' for one audit entry per batch, 'row' for one per row, 'off' for none.
+    :return: the statistics of the run (rows, seconds, rows_per_second).
+    """
+    engine = engine if engine is not None else db.engine
+    start = time.perf_counter()
+    header, checkpoints = prepare_checkpoints(
+        engine, csv_path, lambda data_start: split_byte_ranges(csv_path, data_start, chunk_size)
+    )
+    database_url = engine.url.render_as_string(hide_password=False)
+    print(f"Loading {len(checkpoints)} byte ranges with {workers} worker processes.")
+
+    rows_loaded = 0
+    # Spawned workers do not inherit the connections of the parent process
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+        futures = [
+            executor.submit(_load_shard, database_url, csv_path, header, checkpoint, batch_size, audit_mode)
+            for checkpoint in checkpoints
+        ]
+        for future in as_completed(futures):
+            rows_loaded += future.result()
+            stats = ingest_stats(rows_loaded, time.perf_counter() - start)
+            print(f"Loaded {stats['rows']} rows ({stats['rows_per_second']} rows/s).")
+
+    # The notifications of the workers do not reach the receivers of this process
+    notify_etablissements_changed('ingest')
+    return ingest_stats(rows_loaded, time.perf_counter() - start)
@@ -2,153 +2,216 @@
 Initialize the database.
 """
 
-import csv
+import os
+import subprocess
+import sys
 
-from datetime import datetime, date
+from flask import current_app
 
 from flask_app.db import db
+from flask_app.db.audit import DEFAULT_AUDIT_INGEST_MODE
+from flask_app.db.audit_storage import DEFAULT_AUDIT_RETENTION_MONTHS, maintain_audit_log
+from flask_app.db.checkpoints import file_identity, has_incomplete_checkpoints, load_checkpoints
+from flask_app.db.init_lock import DEFAULT_INGEST_LOCK_FILE, DEFAULT_INIT_LOCK_FILE, ingest_lock, \
+    initialization_lock
+from flask_app.db.ingest import DEFAULT_CHUNK_SIZE, bulk_load_csv, parallel_load_csv
 from flask_app.db.models import Etablissement
+from flask_app.db.search import create_search_index
+from flask_app.db.snapshot import MANIFEST_FILE, load_snapshot, pyarrow, read_manifest, snapshot_files
+from flask_app.db.parsers import parse_date, parse_datetime, parse_int, parse_bool  # noqa: F401
+
+# Indexes of the Etablissement table dropped from the model, removed from the existing databases
+OBSOLETE_INDEXES = (
+    'idx_siret',  # Duplicate of the primary key
+    'idx_code_postal',  # Served by idx_code_postal_siret
+    # Replaced by the same indexes ending with siret, the tie-breaker of the keyset pagination
+    'idx_code_postal_date_creation',
+    'idx_activite_principale_date_creation',
+    'idx_date_creation',
+)
 
 # CSV file path in Docker volume
 CSV_FILE_PATH = '/docker-entrypoint-initdb.d/StockEtablissement.csv'
 
+# Load of the CSV file at startup: in a separate process while the app serves ('background'),
+# before the app serves ('sync'), or not at all ('off', the load being run with `flask ingest load`)
+INGEST_ON_STARTUP_MODES = ('background', 'sync', 'off')
+DEFAULT_INGEST_ON_STARTUP = 'background'
+
+
+def csv_file_path() -> str:
+    """
+    Gets the path of the CSV file loaded into the database.
+    :return: the INGEST_CSV_PATH of the app, the file of the Docker volume by default.
+    """
+    return current_app.config.get("INGEST_CSV_PATH") or CSV_FILE_PATH
+
 
 def load_data_from_csv() -> None:
     """
-    Reads data from the CSV file and inserts it into the database row by row to avoid memory issues.
+    Streams the CSV file into the database with the bulk ingest engine, batch by batch to avoid memory issues.
+    The load runs when the Etablissement table is empty, and resumes from its last checkpoint when a previous
+    load of the same file was interrupted.
+    The file is split between several worker processes when INGEST_WORKERS is greater than 1.
+    :return: Nothing.
+    """
+    csv_path = csv_file_path()
+    if not os.path.exists(csv_path):
+        print(f"CSV file {csv_path} not found, no data loaded.")
+        return
+
+    connection = db.session.connection()
+    checkpoints = load_checkpoints(connection, file_identity(csv_path))
+    if checkpoints and all(checkpoint['completed'] for checkpoint in checkpoints):
+        db.session.commit()
+        return
+
+    # Without checkpoints for this file, only load data if the Etablissement table is empty
+    if not checkpoints and db.session.query(Etablissement.siret).limit(1).first() is not None:
+        if has_incomplete_checkpoints(connection):
+            print("An interrupted ingest of another version of the CSV file cannot be resumed.")
+        db.session.commit()
+        return
+
+    # Release the connection of the session before loading through the engine
+    db.session.commit()
+    workers = current_app.config.get("INGEST_WORKERS", 1)
+    audit_mode = current_app.config.get("AUDIT_INGEST_MODE", DEFAULT_AUDIT_INGEST_MODE)
+    print("Loading data in bulk from CSV into the database.")
+    if workers > 1:
+        chunk_size = current_app.config.get("INGEST_CHUNK_SIZE", DEFAULT_CHUNK_SIZE)
+        stats = parallel_load_csv(csv_path, workers, chunk_size, audit_mode=audit_mode)
+    else:
+        stats = bulk_load_csv(csv_path, audit_mode=audit_mode)
+    print(f"Data loaded successfully from CSV into the database: {stats['rows']} rows "
+          f"in {stats['seconds']}s ({stats['rows_per_second']} rows/s).")
+
+
+def load_data_from_snapshot() -> bool:
+    """
+    Loads the columnar snapshot of INGEST_SNAPSHOT_PATH instead of the CSV file, when it is configured and present.
+    Like the CSV file, the snapshot is loaded into an empty Etablissement table, or resumed from its last checkpoint.
+    :return: whether the snapshot was used, False to load the CSV file instead.
+    """
+    path = current_app.config.get("INGEST_SNAPSHOT_PATH")
+    if not path:
+        return False
+    if not os.path.exists(os.path.join(path, MANIFEST_FILE)):
+        print(f"Snapshot {path} not found, loading the CSV file.")
+        return False
+    if pyarrow is None:
+        print("The snapshot cannot be read without pyarrow, loading the CSV file.")
+        return False
+
+    connection = db.session.connection()
+    checkpoints = [checkpoint for file_path in snapshot_files(path)
+                   for checkpoint in load_checkpoints(connection, file_identity(file_path))]
+    if checkpoints and all(checkpoint['completed'] for checkpoint in checkpoints):
+        db.session.commit()
+        return True
+    if not checkpoints and db.session.query(Etablissement.siret).limit(1).first() is not None:
+        db.session.commit()
+        return True
+
+    db.session.commit()
+    audit_mode = current_app.config.get("AUDIT_INGEST_MODE", DEFAULT_AUDIT_INGEST_MODE)
+    print(f"Loading the snapshot of {read_manifest(path)['created_at']} into the database.")
+    stats = load_snapshot(path, audit_mode=audit_mode)
+    print(f"Data loaded successfully from the snapshot into the database: {stats['rows']} rows "
+          f"in {stats['seconds']}s ({stats['rows_per_second']} rows/s).")
+    return True
+
+
+def maintain_audit_storage() -> None:
+    """
+    Creates the audit_log partitions of the coming months (or archives the past months) and drops
+    the months older than AUDIT_RETENTION_MONTHS.
     :return: Nothing.
     """
-    # Check if data already exists in the Etablissement table
-    if db.session.query(db.func.count(Etablissement.siret)).scalar() == 0:
-        print("Loading data row by row from CSV into the database.")
-        with open(CSV_FILE_PATH, 'r', encoding='utf-8') as file:
-            reader = csv.DictReader(file)
-            for row in reader:
-                # Map CSV columns to model fields
-                mapped_row = Etablissement(
-                    siren=row.get('siren'),
-                    nic=row.get('nic'),
-                    siret=row.get('siret'),
-                    statut_diffusion=row.get('statutDiffusionEtablissement'),
-                    date_creation=parse_date(row.get('dateCreationEtablissement')),
-                    tranche_effectifs=parse_int(row.get('trancheEffectifsEtablissement')),
-                    annee_effectifs=parse_int(row.get('anneeEffectifsEtablissement')),
-                    activite_principale_registre=row.get('activitePrincipaleRegistreMetiersEtablissement'),
-                    date_dernier_traitement=parse_datetime(row.get('dateDernierTraitementEtablissement')),
-                    etablissement_siege=parse_bool(row.get('etablissementSiege')),
-                    nombre_periodes=parse_int(row.get('nombrePeriodesEtablissement')),
-                    complement_adresse=row.get('complementAdresseEtablissement'),
-                    numero_voie=parse_int(row.get('numeroVoieEtablissement')),
-                    indice_repetition=row.get('indiceRepetitionEtablissement'),
-                    type_voie=row.get('typeVoieEtablissement'),
-                    libelle_voie=row.get('libelleVoieEtablissement'),
-                    code_postal=row.get('codePostalEtablissement'),
-                    libelle_commune=row.get('libelleCommuneEtablissement'),
-                    libelle_commune_etranger=row.get('libelleCommuneEtrangerEtablissement'),
-                    distribution_speciale=row.get('distributionSpecialeEtablissement'),
-                    code_commune=row.get('codeCommuneEtablissement'),
-                    code_cedex=row.get('codeCedexEtablissement'),
-                    libelle_cedex=row.get('libelleCedexEtablissement'),
-                    code_pays_etranger=row.get('codePaysEtrangerEtablissement'),
-                    libelle_pays_etranger=row.get('libellePaysEtrangerEtablissement'),
-                    complement_adresse2=row.get('complementAdresse2Etablissement'),
-                    numero_voie2=parse_int(row.get('numeroVoie2Etablissement')),
-                    indice_repetition2=row.get('indiceRepetition2Etablissement'),
-                    type_voie2=row.get('typeVoie2Etablissement'),
-                    libelle_voie2=row.get('libelleVoie2Etablissement'),
-                    code_postal2=row.get('codePostal2Etablissement'),
-                    libelle_commune2=row.get('libelleCommune2Etablissement'),
-                    libelle_commune_etranger2=row.get('libelleCommuneEtranger2Etablissement'),
-                    distribution_speciale2=row.get('distributionSpeciale2Etablissement'),
-                    code_commune2=row.get('codeCommune2Etablissement'),
-                    code_cedex2=row.get('codeCedex2Etablissement'),
-                    libelle_cedex2=row.get('libelleCedex2Etablissement'),
-                    code_pays_etranger2=row.get('codePaysEtranger2Etablissement'),
-                    libelle_pays_etranger2=row.get('libellePaysEtranger2Etablissement'),
-                    date_debut=parse_date(row.get('dateDebut')),
-                    etat_administratif=row.get('etatAdministratifEtablissement'),
-                    enseigne1=row.get('enseigne1Etablissement'),
-                    enseigne2=row.get('enseigne2Etablissement'),
-                    enseigne3=row.get('enseigne3Etablissement'),
-                    denomination_usuelle=row.get('denominationUsuelleEtablissement'),
-                    activite_principale=row.get('activitePrincipaleEtablissement'),
-                    nomenclature_activite_principale=row.get('nomenclatureActivitePrincipaleEtablissement'),
-                    caractere_employeur=row.get('caractereEmployeurEtablissement')
-                )
-
-                # Insert the row into the database
-                db.session.add(mapped_row)
-
-                # Commit periodically to reduce memory usage and prevent transaction bloat
-                if reader.line_num % 1000 == 0:
-                    print(f"Committing batch of rows up to line {reader.line_num}.")
-                    db.session.commit()
-
-            # Commit the remaining rows
-            db.session.commit()
-            print("Data loaded successfully row by row from CSV into the database.")
-
-
-def parse_date(date_str: str) -> date | None:
-    """
-    Parses a date string into a datetime.date object.
-    :param date_str: The date string to parse, formatted as 'YYYY-MM-DD'.
-    :return: A datetime.date object representing the parsed date, or None if parsing fails.
-    """
-    if date_str:
-        try:
-            return datetime.strptime(date_str, '%Y-%m-%d').date()
-        except ValueError:
-            pass  # Handle other date formats if necessary
-    return None
-
-
-def parse_datetime(datetime_str: str) -> date | None:
-    """
-    Parses a datetime string and returns a datetime.datetime object.
-    :param datetime_str: The datetime string to parse, formatted as 'YYYY-MM-DDTHH:MM:SS'.
-    :return: A datetime.datetime object representing the parsed datetime, or None if parsing fails.
-    """
-    if datetime_str:
-        try:
-            return datetime.strptime(datetime_str, '%Y-%m-%dT%H:%M:%S')
-        except ValueError:
-            pass  # Handle other datetime formats if necessary
-    return None
-
-
-def parse_int(value: str) -> int | None:
-    """
-    Parses a string to an integer.
-    :param value: The string to parse as an integer.
-    :return: An integer if the string can be parsed, otherwise None.
-    """
-    if value:
-        try:
-            return int(value)
-        except ValueError:
-            pass
-    return None
-
-
-def parse_bool(value: str) -> bool | None:
-    """
-    Parses a string into a boolean value.
-    :param value: The string to parse as a boolean. Accepted values (case-insensitive) include:
-                  'true', '1', 'yes', 'oui', 'o' for True.
-                  Any other value will be considered False.
-    :return: A boolean value (True or False), or None if the input is None.
-    """
-    if value is not None:
-        return value.lower() in ('true', '1', 'yes', 'oui', 'o')
-    return None
+    retention_months = current_app.config.get("AUDIT_RETENTION_MONTHS", DEFAULT_AUDIT_RETENTION_MONTHS)
+    with db.engine.begin() as connection:
+        changes = maintain_audit_log(connection, retention_months)
+    for action, tables in changes.items():
+        if tables:
+            print(f"Audit log tables {action}: {', '.join(tables)}.")
+
+
+def ensure_indexes() -> None:
+    """
+    Brings the indexes of an existing Etablissement table in line with the model: drops the obsolete ones
+    and creates the missing ones, which create_all does not do for a table that already exists.
+    :return: Nothing.
+    """
+    with db.engine.begin() as connection:
+        for name in OBSOLETE_INDEXES:
+            connection.exec_driver_sql(f"DROP INDEX IF EXISTS {connection.dialect.identifier_preparer.quote(name)}")
+        for index in Etablissement.__table__.indexes:
+            index.create(connection, checkfirst=True)
+
+
+def run_ingest(wait: bool = True) -> bool:
+    """
+    Loads the snapshot of INGEST_SNAPSHOT_PATH, or else the CSV file, if the table is empty or its last load was
+    interrupted, then builds the indexes missing from the table, which are built faster after the load.
+    A single process runs it at a time.
+    :param wait: whether to wait for the ingest running in another process, instead of giving up.
+    :return: whether this process ran the ingest, False if another process was running it.
+    """
+    lock_file = current_app.config.get("INGEST_LOCK_FILE", DEFAULT_INGEST_LOCK_FILE)
+    with ingest_lock(db.engine, lock_file, wait) as acquired:
+        if not acquired:
+            print("The CSV file is loaded by another process.")
+            return False
+        if not load_data_from_snapshot():
+            load_data_from_csv()
+        ensure_indexes()  # Update the indexes of a table created by a previous version
+        with db.engine.begin() as connection:
+            create_search_index(connection)  # Build the search indexes once the data is loaded
+    return True
+
+
+def start_background_ingest() -> subprocess.Popen:
+    """
+    Starts the ingest in a separate process running `flask ingest load`, so that the app serves during the load.
+    A process is used rather than a thread, which the workers forked from a preloaded app would not survive.
+    :return: the ingest process.
+    """
+    package_parent = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    environment = dict(os.environ, INGEST_ON_STARTUP='off')
+    environment['PYTHONPATH'] = os.pathsep.join(filter(None, [package_parent, os.environ.get('PYTHONPATH')]))
+    print("Loading the CSV file in the background.")
+    return subprocess.Popen([sys.executable, '-m', 'flask', '--app', 'flask_app.app:create_app', 'ingest', 'load'],
+                            env=environment)
 
 
 def initialize_database() -> None:
     """
-    Initializes the database by creating all necessary tables and populating
-    the data if the Etablissement table is empty.
+    Initializes the database by creating all necessary tables, and starts populating the data
+    (INGEST_ON_STARTUP) if the Etablissement table is empty or its last load was interrupted.
+    When several processes start together, only the one taking the initialization lock runs it,
+    the others skip it and start serving immediately.
     :return: nothing.
     """
+    lock_file = current_app.config.get("INIT_LOCK_FILE", DEFAULT_INIT_LOCK_FILE)
+    with initialization_lock(db.engine, lock_file) as elected:
+        if not elected:
+            print("The database is initialized by another process, skipping its initialization.")
+            return
+        initialize_database_once()
+
+
+def initialize_database_once() -> None:
+    """
+    Runs the initialization of the database, in the process holding the initialization lock.
+    :return: nothing.
+    """
+    mode = current_app.config.get("INGEST_ON_STARTUP", DEFAULT_INGEST_ON_STARTUP)
+    if mode not in INGEST_ON_STARTUP_MODES:
+        raise ValueError(f"Invalid INGEST_ON_STARTUP: {mode}, expected one of {', '.join(INGEST_ON_STARTUP_MODES)}")
+
     db.create_all()  # Create tables if they don't exist
-    load_data_from_csv()  # Load data if table is empty
+    maintain_audit_storage()  # Prepare the audit partitions before anything is audited
+    if mode == 'sync':
+        run_ingest()  # Load data if table is empty, or resume an interrupted load
+    elif mode == 'background':
+        start_background_ingest()
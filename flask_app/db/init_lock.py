@@ -0,0 +1,104 @@
+"""
+Locks electing the single process that initializes the database, or loads the CSV file, when several processes
+start together: a session advisory lock on PostgreSQL, an exclusive file lock on the other databases.
+"""
+
+import contextlib
+import os
+import tempfile
+
+from typing import Iterator
+
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - fcntl is Unix only, every process initializes the database without it
+    fcntl = None
+
+# Key of the PostgreSQL advisory lock of the initialization
+INIT_LOCK_KEY = 7_419_231_604
+
+# Key of the PostgreSQL advisory lock of the CSV ingest
+INGEST_LOCK_KEY = 7_419_231_605
+
+# Default path of the lock file of the initialization on the other databases
+DEFAULT_INIT_LOCK_FILE = os.path.join(tempfile.gettempdir(), 'flask_app_init.lock')
+
+# Default path of the lock file of the CSV ingest on the other databases
+DEFAULT_INGEST_LOCK_FILE = os.path.join(tempfile.gettempdir(), 'flask_app_ingest.lock')
+
+
+@contextlib.contextmanager
+def advisory_lock(engine: Engine, key: int = INIT_LOCK_KEY, wait: bool = False) -> Iterator[bool]:
+    """
+    Takes a PostgreSQL session advisory lock for the duration of the context.
+    The lock is held by a dedicated connection outside of any transaction, and released if the process dies.
+    :param engine: the engine of the PostgreSQL database.
+    :param key: the key of the lock.
+    :param wait: whether to wait for the lock, instead of giving up when another process holds it.
+    :return: an iterator yielding whether the lock was taken.
+    """
+    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+        if wait:
+            connection.execute(text("SELECT pg_advisory_lock(:key)"), {'key': key})
+            acquired = True
+        else:
+            acquired = connection.execute(text("SELECT pg_try_advisory_lock(:key)"), {'key': key}).scalar()
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                connection.execute(text("SELECT pg_advisory_unlock(:key)"), {'key': key})
+
+
+@contextlib.contextmanager
+def file_lock(path: str = DEFAULT_INIT_LOCK_FILE, wait: bool = False) -> Iterator[bool]:
+    """
+    Takes an exclusive lock on a file for the duration of the context.
+    The lock is released if the process dies.
+    :param path: the path of the lock file, created if needed.
+    :param wait: whether to wait for the lock, instead of giving up when another process holds it.
+    :return: an iterator yielding whether the lock was taken.
+    """
+    if fcntl is None:
+        yield True
+        return
+
+    with open(path, 'a') as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX if wait else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def initialization_lock(engine: Engine, lock_file: str = DEFAULT_INIT_LOCK_FILE):
+    """
+    Gets the lock electing the process that initializes the database: an advisory lock on PostgreSQL,
+    shared by all the hosts, a lock file on the other databases, shared by the processes of the host.
+    :param engine: the engine of the database.
+    :param lock_file: the path of the lock file on the other databases.
+    :return: the lock context manager, yielding whether this process was elected.
+    """
+    if engine.dialect.name == 'postgresql':
+        return advisory_lock(engine, INIT_LOCK_KEY)
+    return file_lock(lock_file)
+
+
+def ingest_lock(engine: Engine, lock_file: str = DEFAULT_INGEST_LOCK_FILE, wait: bool = False):
+    """
+    Gets the lock of the CSV ingest, so that a single process loads the file at a time.
+    :param engine: the engine of the database.
+    :param lock_file: the path of the lock file on the other databases.
+    :param wait: whether to wait for the running ingest to finish, instead of giving up.
+    :return: the lock context manager, yielding whether this process holds the lock.
+    """
+    if engine.dialect.name == 'postgresql':
+        return advisory_lock(engine, INGEST_LOCK_KEY, wait)
+    return file_lock(lock_file, wait)
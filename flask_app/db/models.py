@@ -6,9 +6,6 @@ import datetime
 
 from typing import Optional
 
-from sqlalchemy import event
-from sqlalchemy.orm import Session
-
 from flask_app.db import db
 
 
@@ -67,12 +64,22 @@ class Etablissement(db.Model):
     nomenclature_activite_principale = db.Column(db.String(50))
     caractere_employeur = db.Column(db.String(1))
 
-    # Define indexes
+    # Define indexes. The primary key already indexes siret. The composite indexes serve the filters on their
+    # first column alone, with a range or a sort on the second one. They end with siret, the tie-breaker of the
+    # keyset pagination, so that a page sorted on them is a seek on (sort column, siret) read in index order.
+    # On PostgreSQL, the varchar_pattern_ops indexes serve the prefix filters (LIKE 'prefix%'), which the ordinary
+    # indexes cannot serve in most collations.
     __table_args__ = (
         db.Index('idx_siren', 'siren'),
         db.Index('idx_nic', 'nic'),
-        db.Index('idx_siret', 'siret'),
-        db.Index('idx_code_postal', 'code_postal')
+        db.Index('idx_code_postal_siret', 'code_postal', 'siret'),
+        db.Index('idx_code_postal_date_creation_siret', 'code_postal', 'date_creation', 'siret'),
+        db.Index('idx_activite_principale_date_creation_siret', 'activite_principale', 'date_creation', 'siret'),
+        db.Index('idx_date_creation_siret', 'date_creation', 'siret'),
+        db.Index('idx_code_postal_pattern', 'code_postal',
+                 postgresql_ops={'code_postal': 'varchar_pattern_ops'}).ddl_if(dialect='postgresql'),
+        db.Index('idx_activite_principale_pattern', 'activite_principale',
+                 postgresql_ops={'activite_principale': 'varchar_pattern_ops'}).ddl_if(dialect='postgresql'),
     )
 
     def __init__(
@@ -230,107 +237,114 @@ class Etablissement(db.Model):
 class AuditLog(db.Model):
     """
     Audit table containing data about database transactions.
+    Partitioned by month of timestamp on PostgreSQL, see flask_app.db.audit_storage.
     """
     __tablename__ = 'audit_log'
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     table_name = db.Column(db.String(255), nullable=False)
-    operation = db.Column(db.String(10), nullable=False)  # INSERT, UPDATE, DELETE
+    operation = db.Column(db.String(10), nullable=False)  # INSERT, UPDATE, DELETE, or INGEST and SYNC summaries
     timestamp = db.Column(db.DateTime, default=db.func.now(), nullable=False)
+    record_id = db.Column(db.String(255))  # Primary key of the audited row, NULL for batch summaries
     row_data = db.Column(db.JSON, nullable=False)
 
-    def __init__(self, table_name: str, operation: str, row_data: dict):
+    # Define indexes
+    __table_args__ = (
+        db.Index('idx_audit_log_record_id', 'record_id', 'timestamp'),
+        db.Index('idx_audit_log_operation', 'operation', 'timestamp'),
+        db.Index('idx_audit_log_timestamp', 'timestamp'),
+    )
+
+    def __init__(self, table_name: str, operation: str, row_data: dict, record_id: Optional[str] = None):
         """
         Initializes an instance of the class with detailed attributes.
         :param table_name: name of the affected table.
         :param operation: operation of the affected table.
         :param row_data: data sent to the affected table.
+        :param record_id: primary key of the affected row (optional).
         """
         self.table_name = table_name
         self.operation = operation
         self.row_data = row_data
+        self.record_id = record_id
 
 
-def serialize_row_data(row_data: dict) -> dict:
-    """
-    Serialize row data to make it JSON serializable.
-    :param row_data: the data to serialize.
-    :return: the serialized data.
-    """
-    def serialize(value: datetime.date | datetime.datetime | str) -> str:
-        """
-        Converts a datetime.date, datetime.datetime, or string value into a string format.
-        :param value: The value to be serialized. It can be a datetime.date, datetime.datetime, or string.
-        :type value: datetime.date | datetime.datetime | str
-        :return: The serialized string representation of the input value.
-        """
-        if isinstance(value, (datetime.date, datetime.datetime)):
-            return value.isoformat()
-        return value
-
-    return {key: serialize(value) for key, value in row_data.items()}
-
-
-def record_audit_log(session: Session, operation: str, instance) -> None:
+class IngestCheckpoint(db.Model):
     """
-    Helper function to record an audit log entry for database operations.
-    :param session: The SQLAlchemy Session object to interact with the database.
-    :param operation: The type of operation performed ('INSERT', 'UPDATE', 'DELETE').
-    :param instance: The ORM-mapped instance representing the database record.
-    :return: None
+    Progress of the ingest of a byte range of a CSV file, committed together with each batch of rows.
+    A partition file of a snapshot has a single range, whose offsets (range_start, range_end, byte_offset and
+    line_number) count rows instead of bytes and lines.
     """
-    if isinstance(instance, AuditLog):
-        # Skip logging for the AuditLog table itself
-        return
-
-    # Get the table name from the instance's class
-    table_name = instance.__tablename__
+    __tablename__ = 'ingest_checkpoint'
 
-    # Serialize the row data
-    row_data = {}
-    if operation == 'DELETE':
-        # Collect data for delete operations
-        row_data = {
-            column.name: getattr(instance, column.name)
-            for column in instance.__table__.columns
-        }
-    elif operation in {'INSERT', 'UPDATE'}:
-        # Collect data for insert and update operations
-        row_data = {
-            column.name: getattr(instance, column.name)
-            for column in instance.__table__.columns
-        }
-
-    # Serialize row_data to handle non-serializable objects
-    serialized_row_data = serialize_row_data(row_data)
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    source_path = db.Column(db.String(1024), nullable=False)
+    source_size = db.Column(db.BigInteger, nullable=False)
+    source_mtime_ns = db.Column(db.BigInteger, nullable=False)
+    range_start = db.Column(db.BigInteger, nullable=False)  # First byte of the range, or row of a snapshot file
+    range_end = db.Column(db.BigInteger, nullable=False)  # First byte after the range, or row count of a snapshot file
+    byte_offset = db.Column(db.BigInteger, nullable=False)  # First byte not loaded yet, or row of a snapshot file
+    line_number = db.Column(db.BigInteger, nullable=False)  # Last line committed (relative to the range start), or row
+    rows_loaded = db.Column(db.BigInteger, nullable=False, default=0)
+    completed = db.Column(db.Boolean, nullable=False, default=False)
+    updated_at = db.Column(db.DateTime, default=db.func.now(), nullable=False)
 
-    # Create an AuditLog entry
-    audit_entry = AuditLog(
-        table_name=table_name,
-        operation=operation,
-        row_data=serialized_row_data
+    __table_args__ = (
+        db.UniqueConstraint('source_path', 'source_size', 'source_mtime_ns', 'range_start',
+                            name='uq_ingest_checkpoint_range'),
     )
-    # Add the audit entry to the session
-    session.add(audit_entry)
+
+    def __init__(
+            self,
+            source_path: str,
+            source_size: int,
+            source_mtime_ns: int,
+            range_start: int,
+            range_end: int,
+            byte_offset: int,
+            line_number: int,
+            rows_loaded: int = 0,
+            completed: bool = False
+    ):
+        """
+        Initializes an instance of the class with detailed attributes.
+        :param source_path: path of the ingested CSV file, or snapshot file.
+        :param source_size: size in bytes of the file, part of its identity.
+        :param source_mtime_ns: modification time of the file in nanoseconds, part of its identity.
+        :param range_start: offset of the first byte of the range, 0 for a snapshot file.
+        :param range_end: offset of the first byte after the range, the number of rows of a snapshot file.
+        :param byte_offset: offset of the first byte not loaded yet, the first row not loaded yet of a snapshot file.
+        :param line_number: last line committed, counted from the start of the range, the rows committed
+        of a snapshot file.
+        :param rows_loaded: number of rows committed.
+        :param completed: whether the whole range has been loaded.
+        """
+        self.source_path = source_path
+        self.source_size = source_size
+        self.source_mtime_ns = source_mtime_ns
+        self.range_start = range_start
+        self.range_end = range_end
+        self.byte_offset = byte_offset
+        self.line_number = line_number
+        self.rows_loaded = rows_loaded
+        self.completed = completed
 
 
-@event.listens_for(Session, "before_flush")
-def before_flush(session: Session, flush_context, instances) -> None:
+class TableVersion(db.Model):
     """
-    Event listener to handle auditing for insert, update, and delete operations before a flush.
-    :param session: The SQLAlchemy Session instance initiating the flush.
-    :param flush_context: Flush-specific context provided by SQLAlchemy (not used here).
-    :param instances: Instances involved in the flush (not directly used here).
-    :return: None
+    Version of a table, incremented by the transactions writing the table, so that every process
+    sees that the table changed once they commit.
     """
-    for instance in session.new:
-        # Handle inserts
-        record_audit_log(session, 'INSERT', instance)
+    __tablename__ = 'table_version'
 
-    for instance in session.dirty:
-        # Handle updates
-        record_audit_log(session, 'UPDATE', instance)
+    table_name = db.Column(db.String(255), primary_key=True)
+    version = db.Column(db.BigInteger, nullable=False, default=0)
 
-    for instance in session.deleted:
-        # Handle deletes
-        record_audit_log(session, 'DELETE', instance)
+    def __init__(self, table_name: str, version: int = 0):
+        """
+        Initializes an instance of the class with detailed attributes.
+        :param table_name: name of the versioned table.
+        :param version: number of committed transactions which wrote the table.
+        """
+        self.table_name = table_name
+        self.version = version
@@ -0,0 +1,151 @@
+"""
+Parsing helpers and column mapping for the StockEtablissement CSV file.
+"""
+
+from datetime import datetime, date
+from typing import Callable
+
+
+def parse_date(date_str: str) -> date | None:
+    """
+    Parses a date string into a datetime.date object.
+    :param date_str: The date string to parse, formatted as 'YYYY-MM-DD'.
+    :return: A datetime.date object representing the parsed date, or None if parsing fails.
+    """
+    if date_str:
+        try:
+            return datetime.strptime(date_str, '%Y-%m-%d').date()
+        except ValueError:
+            pass  # Handle other date formats if necessary
+    return None
+
+
+def parse_datetime(datetime_str: str) -> date | None:
+    """
+    Parses a datetime string and returns a datetime.datetime object.
+    :param datetime_str: The datetime string to parse, formatted as 'YYYY-MM-DDTHH:MM:SS'.
+    :return: A datetime.datetime object representing the parsed datetime, or None if parsing fails.
+    """
+    if datetime_str:
+        try:
+            return datetime.strptime(datetime_str, '%Y-%m-%dT%H:%M:%S')
+        except ValueError:
+            pass  # Handle other datetime formats if necessary
+    return None
+
+
+def parse_int(value: str) -> int | None:
+    """
+    Parses a string to an integer.
+    :param value: The string to parse as an integer.
+    :return: An integer if the string can be parsed, otherwise None.
+    """
+    if value:
+        try:
+            return int(value)
+        except ValueError:
+            pass
+    return None
+
+
+def parse_bool(value: str) -> bool | None:
+    """
+    Parses a string into a boolean value.
+    :param value: The string to parse as a boolean. Accepted values (case-insensitive) include:
+                  'true', '1', 'yes', 'oui', 'o' for True.
+                  Any other value will be considered False.
+    :return: A boolean value (True or False), or None if the input is None.
+    """
+    if value is not None:
+        return value.lower() in ('true', '1', 'yes', 'oui', 'o')
+    return None
+
+
+def parse_str(value: str) -> str | None:
+    """
+    Keeps a raw CSV value as is.
+    :param value: The string read from the CSV file.
+    :return: The same string, or None if the column is missing.
+    """
+    return value
+
+
+# Mapping of the Etablissement model fields to the CSV columns and their converters, in table order
+CSV_COLUMNS: list[tuple[str, str, Callable]] = [
+    ('siren', 'siren', parse_str),
+    ('nic', 'nic', parse_str),
+    ('siret', 'siret', parse_str),
+    ('statut_diffusion', 'statutDiffusionEtablissement', parse_str),
+    ('date_creation', 'dateCreationEtablissement', parse_date),
+    ('tranche_effectifs', 'trancheEffectifsEtablissement', parse_int),
+    ('annee_effectifs', 'anneeEffectifsEtablissement', parse_int),
+    ('activite_principale_registre', 'activitePrincipaleRegistreMetiersEtablissement', parse_str),
+    ('date_dernier_traitement', 'dateDernierTraitementEtablissement', parse_datetime),
+    ('etablissement_siege', 'etablissementSiege', parse_bool),
+    ('nombre_periodes', 'nombrePeriodesEtablissement', parse_int),
+    ('complement_adresse', 'complementAdresseEtablissement', parse_str),
+    ('numero_voie', 'numeroVoieEtablissement', parse_int),
+    ('indice_repetition', 'indiceRepetitionEtablissement', parse_str),
+    ('type_voie', 'typeVoieEtablissement', parse_str),
+    ('libelle_voie', 'libelleVoieEtablissement', parse_str),
+    ('code_postal', 'codePostalEtablissement', parse_str),
+    ('libelle_commune', 'libelleCommuneEtablissement', parse_str),
+    ('libelle_commune_etranger', 'libelleCommuneEtrangerEtablissement', parse_str),
+    ('distribution_speciale', 'distributionSpecialeEtablissement', parse_str),
+    ('code_commune', 'codeCommuneEtablissement', parse_str),
+    ('code_cedex', 'codeCedexEtablissement', parse_str),
+    ('libelle_cedex', 'libelleCedexEtablissement', parse_str),
+    ('code_pays_etranger', 'codePaysEtrangerEtablissement', parse_str),
+    ('libelle_pays_etranger', 'libellePaysEtrangerEtablissement', parse_str),
+    ('complement_adresse2', 'complementAdresse2Etablissement', parse_str),
+    ('numero_voie2', 'numeroVoie2Etablissement', parse_int),
+    ('indice_repetition2', 'indiceRepetition2Etablissement', parse_str),
+    ('type_voie2', 'typeVoie2Etablissement', parse_str),
+    ('libelle_voie2', 'libelleVoie2Etablissement', parse_str),
+    ('code_postal2', 'codePostal2Etablissement', parse_str),
+    ('libelle_commune2', 'libelleCommune2Etablissement', parse_str),
+    ('libelle_commune_etranger2', 'libelleCommuneEtranger2Etablissement', parse_str),
+    ('distribution_speciale2', 'distributionSpeciale2Etablissement', parse_str),
+    ('code_commune2', 'codeCommune2Etablissement', parse_str),
+    ('code_cedex2', 'codeCedex2Etablissement', parse_str),
+    ('libelle_cedex2', 'libelleCedex2Etablissement', parse_str),
+    ('code_pays_etranger2', 'codePaysEtranger2Etablissement', parse_str),
+    ('libelle_pays_etranger2', 'libellePaysEtranger2Etablissement', parse_str),
+    ('date_debut', 'dateDebut', parse_date),
+    ('etat_administratif', 'etatAdministratifEtablissement', parse_str),
+    ('enseigne1', 'enseigne1Etablissement', parse_str),
+    ('enseigne2', 'enseigne2Etablissement', parse_str),
+    ('enseigne3', 'enseigne3Etablissement', parse_str),
+    ('denomination_usuelle', 'denominationUsuelleEtablissement', parse_str),
+    ('activite_principale', 'activitePrincipaleEtablissement', parse_str),
+    ('nomenclature_activite_principale', 'nomenclatureActivitePrincipaleEtablissement', parse_str),
+    ('caractere_employeur', 'caractereEmployeurEtablissement', parse_str),
+]
+
+# Model fields in the order of the tuples produced by make_row_converter
+CSV_FIELDS: list[str] = [field for field, _, _ in CSV_COLUMNS]
+
+
+def make_row_converter(header: list[str]) -> Callable[[list[str]], tuple]:
+    """
+    Builds a function converting a raw CSV record into a tuple of typed values ordered like CSV_FIELDS.
+    The positions of the CSV columns are resolved once from the header instead of once per row.
+    :param header: the header line of the CSV file.
+    :return: a function taking the list of values of a record and returning the converted tuple.
+    """
+    positions = {name: index for index, name in enumerate(header)}
+    plan = [(positions.get(csv_name), converter) for _, csv_name, converter in CSV_COLUMNS]
+
+    def convert(record: list[str]) -> tuple:
+        """
+        Converts a raw CSV record. Missing columns are converted from None, like csv.DictReader does.
+        :param record: the list of values of a CSV record.
+        :return: the converted tuple.
+        """
+        size = len(record)
+        return tuple(
+            converter(record[index] if index is not None and index < size else None)
+            for index, converter in plan
+        )
+
+    return convert
@@ -0,0 +1,274 @@
+"""
+Routing of the reads to read-only replica databases, and tuned, instrumented connection pools.
+"""
+
+import itertools
+import threading
+import time
+
+from flask import current_app, has_app_context, has_request_context, request
+from flask_sqlalchemy.session import Session
+from sqlalchemy import make_url, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+from sqlalchemy.sql.dml import UpdateBase
+
+from flask_app.metrics import Histogram, SECONDS_BUCKETS
+
+# Prefix of the bind keys of the replica databases, like replica_0
+REPLICA_BIND_PREFIX = 'replica_'
+
+# Default maximum replication lag of a replica, in seconds, beyond which reads go to the primary
+DEFAULT_REPLICA_MAX_LAG = 5.0
+
+# Default interval between two checks of the lag of the replicas, in seconds
+DEFAULT_REPLICA_CHECK_INTERVAL = 5.0
+
+# Methods of the requests whose reads go to the replicas
+READ_METHODS = ('GET', 'HEAD')
+
+# Lag of a PostgreSQL replica: 0 when it replayed everything it received, NULL on a primary
+_POSTGRESQL_LAG_SQL = (
+    "SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+    "ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END"
+)
+
+
+class CheckoutWaitMixin:
+    """
+    Mixin of the queue pools measuring how long each checkout waits for a connection.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.wait_histogram = Histogram(SECONDS_BUCKETS)
+        self.timeouts = 0
+        self._wait_lock = threading.Lock()
+
+    def _do_get(self):
+        """
+        Gets a connection from the pool, recording the time waited, timeouts included.
+        :return: the pooled connection.
+        """
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except Exception:
+            with self._wait_lock:
+                self.timeouts += 1
+            raise
+        finally:
+            with self._wait_lock:
+                self.wait_histogram.observe(time.perf_counter() - start)
+
+
+class InstrumentedQueuePool(CheckoutWaitMixin, QueuePool):
+    """
+    Queue pool of the engines, measuring the checkout wait times.
+    """
+
+
+class InstrumentedAsyncQueuePool(CheckoutWaitMixin, AsyncAdaptedQueuePool):
+    """
+    Queue pool of the asyncio engines, measuring the checkout wait times.
+    """
+
+
+def engine_options(url: str | None, pool_size: int, max_overflow: int, pool_timeout: float, pool_recycle: int,
+                   pool_pre_ping: bool, asynchronous: bool = False) -> dict:
+    """
+    Builds the options of the engine of a database, with an instrumented queue pool.
+    SQLite in-memory databases keep the single static connection they need.
+    :param url: the URL of the database.
+    :param pool_size: the number of connections kept open.
+    :param max_overflow: the number of connections opened beyond pool_size under load.
+    :param pool_timeout: the time waited for a connection before giving up, in seconds.
+    :param pool_recycle: the age in seconds after which a connection is replaced, -1 to never replace them.
+    :param pool_pre_ping: whether to check that a connection is alive before using it.
+    :param asynchronous: whether the options are those of an asyncio engine.
+    :return: the options of the engine.
+    """
+    options = {'pool_pre_ping': pool_pre_ping, 'pool_recycle': pool_recycle}
+    if url is None:
+        return options
+    parsed = make_url(url)
+    if parsed.get_backend_name() == 'sqlite' and parsed.database in (None, '', ':memory:'):
+        return options
+    options.update(poolclass=InstrumentedAsyncQueuePool if asynchronous else InstrumentedQueuePool,
+                   pool_size=pool_size, max_overflow=max_overflow, pool_timeout=pool_timeout)
+    return options
+
+
+def replica_lag(engine: Engine) -> float:
+    """
+    Measures the replication lag of a replica.
+    :param engine: the engine of the replica.
+    :return: the lag in seconds, 0 for databases without replication.
+    """
+    if engine.dialect.name != 'postgresql':
+        return 0.0
+    with engine.connect() as connection:
+        lag = connection.execute(text(_POSTGRESQL_LAG_SQL)).scalar()
+    return float(lag or 0.0)
+
+
+class ReplicaRouter:
+    """
+    Round-robin choice of the replica serving a read, among the replicas whose lag is under the maximum.
+    The lags are checked at most once per interval, by the request that finds them outdated.
+    """
+
+    def __init__(self, replicas: dict[str, Engine], max_lag: float, check_interval: float):
+        """
+        :param replicas: the engines of the replicas, by bind key.
+        :param max_lag: the maximum lag of a replica, in seconds.
+        :param check_interval: the interval between two checks of the lags, in seconds.
+        """
+        self.replicas = replicas
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.lags: dict[str, float | None] = {key: None for key in replicas}
+        self.healthy: list[str] = []
+        self.replica_reads = 0
+        self.primary_fallbacks = 0
+        self._checked_at: float | None = None
+        self._next = itertools.count()
+        self._lock = threading.Lock()
+
+    def check(self) -> None:
+        """
+        Measures the lag of the replicas, a replica that cannot be reached being left out.
+        :return: None
+        """
+        healthy = []
+        for key, engine in self.replicas.items():
+            try:
+                lag = replica_lag(engine)
+            except Exception as e:
+                print(f"Replica {key} unavailable, its reads go to the primary: {e}")
+                lag = None
+            self.lags[key] = lag
+            if lag is not None and lag <= self.max_lag:
+                healthy.append(key)
+        self.healthy = healthy
+
+    def choose(self) -> Engine | None:
+        """
+        Chooses the replica serving a read.
+        :return: the engine of the replica, or None if no replica is healthy and the primary must serve it.
+        """
+        now = time.monotonic()
+        if self._checked_at is None or now - self._checked_at >= self.check_interval:
+            # A single request checks the lags, the others use the last results meanwhile
+            if self._lock.acquire(blocking=self._checked_at is None):
+                try:
+                    self._checked_at = now
+                    self.check()
+                finally:
+                    self._lock.release()
+
+        healthy = self.healthy
+        if not healthy:
+            self.primary_fallbacks += 1
+            return None
+        self.replica_reads += 1
+        return self.replicas[healthy[next(self._next) % len(healthy)]]
+
+    def stats(self) -> dict:
+        """
+        Gets the state of the replicas and the number of reads routed.
+        :return: the lags by replica, the healthy replicas, the reads sent to the replicas and those sent
+        to the primary because no replica was healthy.
+        """
+        return {'lags': dict(self.lags), 'healthy': list(self.healthy), 'replica_reads': self.replica_reads,
+                'primary_fallbacks': self.primary_fallbacks}
+
+
+def get_replica_router() -> ReplicaRouter | None:
+    """
+    Gets the replica router of the current Flask app, creating it on first use.
+    :return: the router, or None without replica binds.
+    """
+    extensions = current_app.extensions
+    if 'replica_router' not in extensions:
+        engines = extensions['sqlalchemy'].engines
+        replicas = {key: engine for key, engine in sorted(engines.items(), key=lambda item: str(item[0]))
+                    if isinstance(key, str) and key.startswith(REPLICA_BIND_PREFIX)}
+        router = ReplicaRouter(
+            replicas,
+            current_app.config.get('REPLICA_MAX_LAG', DEFAULT_REPLICA_MAX_LAG),
+            current_app.config.get('REPLICA_CHECK_INTERVAL', DEFAULT_REPLICA_CHECK_INTERVAL),
+        ) if replicas else None
+        extensions.setdefault('replica_router', router)
+    return extensions['replica_router']
+
+
+def replica_reads(view):
+    """
+    Marks a view that only reads, whatever its method, so that its reads go to the replicas.
+    :param view: the view function.
+    :return: the view function.
+    """
+    view.replica_reads = True
+    return view
+
+
+def primary_reads(view):
+    """
+    Marks a view that must read the latest committed data, whatever its method, like the readiness of the API,
+    so that its reads go to the primary.
+    :param view: the view function.
+    :return: the view function.
+    """
+    view.primary_reads = True
+    return view
+
+
+def reads_from_replica() -> bool:
+    """
+    Tells whether the reads of the current request may go to a replica: GET and HEAD requests,
+    and the views marked with replica_reads, except the views marked with primary_reads.
+    :return: True if the reads may go to a replica.
+    """
+    if not has_request_context():
+        return False
+    view = current_app.view_functions.get(request.endpoint)
+    if getattr(view, 'primary_reads', False):
+        return False
+    return request.method in READ_METHODS or getattr(view, 'replica_reads', False)
+
+
+class RoutingSession(Session):
+    """
+    Session sending the reads of the read requests to the replicas, and everything else to the primary.
+    Once a session writes, all its statements go to the primary, so that it reads its own writes.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and has_app_context():
+            if self._flushing or isinstance(clause, UpdateBase):
+                self.info['primary_only'] = True
+            elif not self.info.get('primary_only') and reads_from_replica():
+                replica = self.replica()
+                if replica is not None:
+                    return replica
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+    def replica(self) -> Engine | None:
+        """
+        Chooses the replica serving the reads of the session, once until it commits or closes, so that the page
+        and the counts of a request read the same replica, whatever the lags of the others.
+        :return: the engine of the replica, or None if the primary serves the reads.
+        """
+        if 'replica' not in self.info:
+            router = get_replica_router()
+            self.info['replica'] = router.choose() if router is not None else None
+        return self.info['replica']
+
+    def commit(self) -> None:
+        super().commit()
+        self.info.pop('replica', None)
+
+    def close(self) -> None:
+        super().close()
+        self.info.pop('replica', None)
@@ -0,0 +1,146 @@
+"""
+Full-text and typo-tolerant search over the names and addresses of the Etablissements:
+tsvector and trigram GIN indexes on PostgreSQL, an FTS5 trigram index on SQLite.
+"""
+
+import re
+
+from sqlalchemy import DDL, column, event, func, literal, literal_column, select, table, text
+from sqlalchemy.engine import Connection
+
+from flask_app.db.models import Etablissement
+
+# Columns searched by name
+SEARCH_COLUMNS = ('enseigne1', 'enseigne2', 'enseigne3', 'denomination_usuelle', 'libelle_voie', 'libelle_commune')
+
+# Text configuration of the PostgreSQL full-text search, without stemming nor stop words as names are searched
+TEXT_SEARCH_CONFIG = 'simple'
+
+# Minimum length of a search, the trigram indexes cannot match shorter words
+MIN_QUERY_LENGTH = 3
+
+etablissement_table = Etablissement.__table__
+
+FTS_TABLE = f"{etablissement_table.name}_search"
+
+# Searched document of a row on PostgreSQL, the same expression being used by the indexes and the queries
+_DOCUMENT_SQL = " || ' ' || ".join(f"coalesce({name}, '')" for name in SEARCH_COLUMNS)
+_TSVECTOR_SQL = f"to_tsvector('{TEXT_SEARCH_CONFIG}', {_DOCUMENT_SQL})"
+
+_POSTGRESQL_DDL = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    f"CREATE INDEX IF NOT EXISTS idx_{etablissement_table.name}_search_tsv "
+    f"ON {etablissement_table.name} USING GIN (({_TSVECTOR_SQL}))",
+    f"CREATE INDEX IF NOT EXISTS idx_{etablissement_table.name}_search_trgm "
+    f"ON {etablissement_table.name} USING GIN (({_DOCUMENT_SQL}) gin_trgm_ops)",
+]
+
+_NEW_VALUES = ', '.join(f"new.{name}" for name in SEARCH_COLUMNS)
+_OLD_VALUES = ', '.join(f"old.{name}" for name in SEARCH_COLUMNS)
+_FTS_COLUMNS = ', '.join(SEARCH_COLUMNS)
+
+# The FTS5 table indexes the rows of the Etablissement table (external content) by rowid, kept in sync by triggers
+_SQLITE_DDL = [
+    f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5({_FTS_COLUMNS}, "
+    f"content='{etablissement_table.name}', content_rowid='rowid', tokenize='trigram')",
+    f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_insert AFTER INSERT ON {etablissement_table.name} BEGIN "
+    f"INSERT INTO {FTS_TABLE} (rowid, {_FTS_COLUMNS}) VALUES (new.rowid, {_NEW_VALUES}); END",
+    f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_delete AFTER DELETE ON {etablissement_table.name} BEGIN "
+    f"INSERT INTO {FTS_TABLE} ({FTS_TABLE}, rowid, {_FTS_COLUMNS}) VALUES ('delete', old.rowid, {_OLD_VALUES}); END",
+    f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_update AFTER UPDATE ON {etablissement_table.name} BEGIN "
+    f"INSERT INTO {FTS_TABLE} ({FTS_TABLE}, rowid, {_FTS_COLUMNS}) VALUES ('delete', old.rowid, {_OLD_VALUES}); "
+    f"INSERT INTO {FTS_TABLE} (rowid, {_FTS_COLUMNS}) VALUES (new.rowid, {_NEW_VALUES}); END",
+]
+
+
+def create_search_index(connection: Connection) -> None:
+    """
+    Creates the search indexes of the Etablissement table if they do not exist, indexing the existing rows.
+    :param connection: an open connection to the database, in a transaction.
+    :return: None
+    """
+    if connection.dialect.name == 'postgresql':
+        for statement in _POSTGRESQL_DDL:
+            connection.exec_driver_sql(statement)
+    elif connection.dialect.name == 'sqlite':
+        exists = connection.exec_driver_sql(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (FTS_TABLE,)
+        ).first()
+        for statement in _SQLITE_DDL:
+            connection.exec_driver_sql(statement)
+        if not exists:
+            connection.exec_driver_sql(f"INSERT INTO {FTS_TABLE} ({FTS_TABLE}) VALUES ('rebuild')")
+
+
+@event.listens_for(etablissement_table, "after_create")
+def create_search_index_with_table(target, connection: Connection, **kw) -> None:
+    """
+    Event listener creating the SQLite search index together with the Etablissement table, so that its triggers
+    index the rows from the first insert. The PostgreSQL indexes are created after the initial load instead,
+    building a GIN index once being much faster than maintaining it during the load.
+    :param target: the created table.
+    :param connection: the connection creating the table.
+    :return: None
+    """
+    if connection.dialect.name == 'sqlite':
+        create_search_index(connection)
+
+
+event.listen(etablissement_table, "before_drop", DDL(f"DROP TABLE IF EXISTS {FTS_TABLE}").execute_if(dialect='sqlite'))
+
+
+def _fts_query(query: str) -> str:
+    """
+    Builds the FTS5 query of a search: any trigram of the words of the search, so that misspelled words still
+    match on their correct trigrams and the rows matching the most trigrams rank first.
+    :param query: the search of the user.
+    :return: the FTS5 MATCH expression, empty if no word is long enough.
+    """
+    trigrams = []
+    for word in re.findall(r"\w+", query.lower()):
+        for index in range(len(word) - 2):
+            trigram = word[index:index + 3]
+            if trigram not in trigrams:
+                trigrams.append(trigram)
+    return ' OR '.join(f'"{trigram}"' for trigram in trigrams)
+
+
+def search_statement(dialect_name: str, query: str, columns: list, limit: int):
+    """
+    Builds the ranked search of Etablissements by name and address.
+    On PostgreSQL, the rows matching the words of the search (full-text) or close to them (trigram word
+    similarity) are ranked by the sum of both scores. On SQLite, the rows sharing trigrams with the search
+    are ranked by BM25.
+    :param dialect_name: the name of the database dialect.
+    :param query: the search of the user.
+    :param columns: the columns of the Etablissement table to return, the score being added after them.
+    :param limit: the maximum number of rows.
+    :return: the select statement, or None if the search has no word long enough.
+    """
+    if dialect_name == 'postgresql':
+        # Parenthesized, the document is the indexed expression and the operand of <% as a whole
+        document = literal_column(f"({_DOCUMENT_SQL})")
+        tsvector = literal_column(_TSVECTOR_SQL)
+        tsquery = func.websearch_to_tsquery(literal_column(f"'{TEXT_SEARCH_CONFIG}'"), query)
+        score = (func.ts_rank(tsvector, tsquery) + func.word_similarity(query, document)).label('score')
+        return (
+            select(*columns, score)
+            .where(tsvector.op('@@')(tsquery) | literal(query).op('<%')(document))
+            .order_by(score.desc())
+            .limit(limit)
+        )
+
+    fts_query = _fts_query(query)
+    if not fts_query:
+        return None
+    fts_table = table(FTS_TABLE, column('rowid'))
+    rank = literal_column(f"bm25({FTS_TABLE})")
+    return (
+        select(*columns, (-rank).label('score'))
+        .select_from(etablissement_table.join(
+            fts_table, fts_table.c.rowid == literal_column(f"{etablissement_table.name}.rowid")
+        ))
+        .where(text(f"{FTS_TABLE} MATCH :fts_query").bindparams(fts_query=fts_query))
+        .order_by(rank)
+        .limit(limit)
+    )
@@ -0,0 +1,444 @@
+"""
+Columnar snapshots of the Etablissement table: typed Parquet or Arrow files partitioned by département,
+read by offline jobs and reloaded into an empty database faster than the CSV file.
+
+A snapshot is a directory with one file per département, in the Hive layout read by pyarrow.dataset:
+    <path>/departement=75/part-0.parquet
+    <path>/_snapshot.json   (format, compression, rows per partition and schema of the snapshot)
+"""
+
+import datetime
+import io
+import json
+import os
+import shutil
+import time
+
+from typing import Iterator
+
+from sqlalchemy import select
+from sqlalchemy.engine import Connection, Engine
+
+from flask_app.db import db
+from flask_app.db.audit import DEFAULT_AUDIT_INGEST_MODE, batch_entries, write_audit_entries
+from flask_app.db.checkpoints import advance_checkpoint, create_checkpoints, file_identity, load_checkpoints
+from flask_app.db.events import bump_etablissements_version, notify_etablissements_changed
+from flask_app.db.ingest import COPY_SQL, DEFAULT_BATCH_SIZE, ingest_stats, insert_rows
+from flask_app.db.models import Etablissement
+from flask_app.db.parsers import CSV_COLUMNS, CSV_FIELDS, parse_bool, parse_date, parse_datetime, parse_int
+
+try:
+    import pyarrow
+    import pyarrow.csv
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:  # pragma: no cover - pyarrow is optional, the snapshots are not available without it
+    pyarrow = None
+
+SNAPSHOT_FORMATS = ('parquet', 'arrow')
+DEFAULT_SNAPSHOT_FORMAT = 'parquet'
+DEFAULT_SNAPSHOT_COMPRESSION = 'zstd'
+
+# Number of rows of the row groups of the Parquet files and of the record batches of the Arrow files
+DEFAULT_ROW_GROUP_SIZE = 100000
+
+MANIFEST_FILE = '_snapshot.json'
+
+# Partition of the establishments without a French postal code
+UNKNOWN_DEPARTEMENT = 'inconnu'
+
+# COPY of the CSV rendering of the record batches, whose empty unquoted values are NULL and quoted ones are strings
+COPY_CSV_SQL = f"{COPY_SQL} WITH (FORMAT csv)"
+
+etablissement_table = Etablissement.__table__
+
+INSERT_SQL = f"INSERT INTO {etablissement_table.name} ({', '.join(CSV_FIELDS)}) VALUES ({', '.join('?' * len(CSV_FIELDS))})"
+
+
+def _require_pyarrow() -> None:
+    """
+    Checks that pyarrow is installed.
+    :return: None
+    :raise RuntimeError: if pyarrow is not installed.
+    """
+    if pyarrow is None:
+        raise RuntimeError("The snapshots require pyarrow: pip install pyarrow")
+
+
+def snapshot_schema():
+    """
+    Builds the Arrow schema of the snapshots from the converters of the CSV columns, in table order.
+    :return: the pyarrow.Schema of the snapshots.
+    """
+    _require_pyarrow()
+    types = {
+        parse_date: pyarrow.date32(),
+        parse_datetime: pyarrow.timestamp('us'),
+        parse_int: pyarrow.int32(),
+        parse_bool: pyarrow.bool_(),
+    }
+    return pyarrow.schema([(field, types.get(converter, pyarrow.string())) for field, _, converter in CSV_COLUMNS])
+
+
+def departement(code_postal: str | None) -> str:
+    """
+    Derives the département of an establishment from its postal code.
+    :param code_postal: the postal code.
+    :return: the code of the département: 3 digits overseas, 2A or 2B in Corsica, UNKNOWN_DEPARTEMENT without code.
+    """
+    if not code_postal or len(code_postal) != 5 or not code_postal.isdigit():
+        return UNKNOWN_DEPARTEMENT
+    if code_postal.startswith(('97', '98')):
+        return code_postal[:3]
+    if code_postal.startswith('20'):
+        return '2A' if code_postal < '20200' else '2B'
+    return code_postal[:2]
+
+
+def partition_file(path: str, partition: str, snapshot_format: str, part: int = 0) -> str:
+    """
+    Gets the path of a file of a partition.
+    :param path: the directory of the snapshot.
+    :param partition: the département of the partition.
+    :param snapshot_format: 'parquet' or 'arrow'.
+    :param part: the number of the file in the partition.
+    :return: the path of the file.
+    """
+    return os.path.join(path, f"departement={partition}", f"part-{part}.{snapshot_format}")
+
+
+class PartitionWriter:
+    """
+    Writes the rows of a partition to its file, one row group or record batch per row_group_size rows.
+    """
+
+    def __init__(self, file_path: str, schema, snapshot_format: str, compression: str | None, row_group_size: int):
+        """
+        Creates the file of the partition.
+        :param file_path: the path of the file.
+        :param schema: the schema of the snapshot.
+        :param snapshot_format: 'parquet' or 'arrow'.
+        :param compression: the compression codec, like 'zstd', or None.
+        :param row_group_size: the number of rows of the row groups.
+        """
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        self.file_path = file_path
+        self.schema = schema
+        self.row_group_size = row_group_size
+        self.rows: list[tuple] = []
+        self.row_count = 0
+        if snapshot_format == 'parquet':
+            self.writer = pyarrow.parquet.ParquetWriter(file_path, schema, compression=compression or 'none')
+        else:
+            options = pyarrow.ipc.IpcWriteOptions(compression=compression)
+            self.writer = pyarrow.ipc.new_file(file_path, schema, options=options)
+
+    def add(self, row: tuple) -> None:
+        """
+        Adds a row, writing a row group when enough rows are buffered.
+        :param row: the values of the row, ordered like CSV_FIELDS.
+        :return: None
+        """
+        self.rows.append(row)
+        if len(self.rows) >= self.row_group_size:
+            self.flush()
+
+    def flush(self) -> None:
+        """
+        Writes the buffered rows, converted column by column into Arrow arrays.
+        :return: None
+        """
+        if not self.rows:
+            return
+        columns = zip(*self.rows)
+        batch = pyarrow.record_batch([pyarrow.array(column, type=field.type)
+                                      for column, field in zip(columns, self.schema)], schema=self.schema)
+        self.writer.write_batch(batch)
+        self.row_count += len(self.rows)
+        self.rows = []
+
+    def close(self) -> None:
+        """
+        Writes the buffered rows and closes the file.
+        :return: None
+        """
+        self.flush()
+        self.writer.close()
+
+
+def write_snapshot(connection: Connection, path: str, snapshot_format: str = DEFAULT_SNAPSHOT_FORMAT,
+                   compression: str | None = DEFAULT_SNAPSHOT_COMPRESSION,
+                   row_group_size: int = DEFAULT_ROW_GROUP_SIZE) -> dict:
+    """
+    Streams the Etablissement table into a snapshot, replacing the previous snapshot of the path once complete.
+    :param connection: an open connection to the database.
+    :param path: the directory of the snapshot.
+    :param snapshot_format: 'parquet', or 'arrow' for Arrow IPC files (memory-mapped without copy when uncompressed).
+    :param compression: the compression codec ('zstd', 'lz4', or None), 'snappy' and 'gzip' being Parquet only.
+    :param row_group_size: the number of rows of the row groups.
+    :return: the statistics of the snapshot (rows, partitions, bytes, seconds, rows_per_second).
+    :raise ValueError: if the format is unknown.
+    """
+    _require_pyarrow()
+    if snapshot_format not in SNAPSHOT_FORMATS:
+        raise ValueError(f"Invalid snapshot format: {snapshot_format}, expected one of {', '.join(SNAPSHOT_FORMATS)}")
+    start = time.perf_counter()
+    schema = snapshot_schema()
+    temporary_path = path.rstrip(os.sep) + '.tmp'
+    shutil.rmtree(temporary_path, ignore_errors=True)
+
+    # Ordered by postal code, the rows of a département follow each other: a single file is open at a time, closed
+    # when the département changes. The rows without a valid postal code are spread over the order, each run of them
+    # is written to another file of their partition.
+    query = select(*[etablissement_table.c[field] for field in CSV_FIELDS]).order_by(etablissement_table.c.code_postal)
+    result = connection.execution_options(yield_per=row_group_size).execute(query)
+    code_postal_index = CSV_FIELDS.index('code_postal')
+    partitions: dict[str, int] = {}
+    files: dict[str, int] = {}
+    parts: dict[str, int] = {}
+    writer, current = None, None
+
+    def close_writer() -> None:
+        """
+        Closes the file of the current département and records its rows.
+        :return: None
+        """
+        writer.close()
+        files[os.path.relpath(writer.file_path, temporary_path)] = writer.row_count
+        partitions[current] = partitions.get(current, 0) + writer.row_count
+
+    try:
+        for rows in result.partitions():
+            for row in rows:
+                partition = departement(row[code_postal_index])
+                if partition != current:
+                    if writer is not None:
+                        close_writer()
+                    part = parts[partition] = parts.get(partition, -1) + 1
+                    writer = PartitionWriter(partition_file(temporary_path, partition, snapshot_format, part), schema,
+                                             snapshot_format, compression, row_group_size)
+                    current = partition
+                writer.add(tuple(row))
+    finally:
+        if writer is not None:
+            close_writer()
+
+    manifest = {
+        'table': etablissement_table.name,
+        'format': snapshot_format,
+        'compression': compression,
+        'created_at': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+        'rows': sum(partitions.values()),
+        'partitions': dict(sorted(partitions.items())),
+        'files': dict(sorted(files.items())),
+        'schema': {field.name: str(field.type) for field in schema},
+    }
+    os.makedirs(temporary_path, exist_ok=True)
+    with open(os.path.join(temporary_path, MANIFEST_FILE), 'w', encoding='utf-8') as file:
+        json.dump(manifest, file, indent=2)
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(temporary_path, path)
+
+    size = sum(os.path.getsize(file_path) for file_path in snapshot_files(path))
+    return dict(ingest_stats(manifest['rows'], time.perf_counter() - start), partitions=len(partitions), bytes=size)
+
+
+def read_manifest(path: str) -> dict:
+    """
+    Reads the manifest of a snapshot.
+    :param path: the directory of the snapshot.
+    :return: the manifest.
+    :raise FileNotFoundError: if the directory is not a complete snapshot.
+    """
+    with open(os.path.join(path, MANIFEST_FILE), encoding='utf-8') as file:
+        return json.load(file)
+
+
+def snapshot_files(path: str) -> list[str]:
+    """
+    Lists the partition files of a snapshot.
+    :param path: the directory of the snapshot.
+    :return: the paths of the files, ordered by département.
+    """
+    return [os.path.join(path, name) for name in read_manifest(path)['files']]
+
+
+def iter_file_batches(file_path: str, batch_size: int, offset: int = 0) -> Iterator:
+    """
+    Reads the record batches of a partition file through a memory map, from a row offset.
+    :param file_path: the path of the Parquet or Arrow file.
+    :param batch_size: the maximum number of rows per batch.
+    :param offset: the number of rows to skip.
+    :return: an iterator over the pyarrow.RecordBatch of the file, with the columns ordered like CSV_FIELDS.
+    """
+    if file_path.endswith('.parquet'):
+        batches = pyarrow.parquet.ParquetFile(file_path, memory_map=True).iter_batches(batch_size, columns=CSV_FIELDS)
+    else:
+        reader = pyarrow.ipc.open_file(pyarrow.memory_map(file_path))
+        batches = (reader.get_batch(index).select(CSV_FIELDS) for index in range(reader.num_record_batches))
+
+    position = 0
+    for batch in batches:
+        skipped = min(max(offset - position, 0), batch.num_rows)
+        position += batch.num_rows
+        for batch_start in range(skipped, batch.num_rows, batch_size):
+            yield batch.slice(batch_start, batch_size)
+
+
+def copy_batch(connection: Connection, batch) -> None:
+    """
+    Loads a record batch into the Etablissement table with PostgreSQL COPY FROM STDIN, the values being formatted
+    column by column by the CSV writer of Arrow instead of one by one in Python.
+    :param connection: an open connection to a PostgreSQL database.
+    :param batch: the pyarrow.RecordBatch, with the columns ordered like CSV_FIELDS.
+    :return: None
+    """
+    buffer = pyarrow.BufferOutputStream()
+    pyarrow.csv.write_csv(batch, buffer, pyarrow.csv.WriteOptions(include_header=False))
+    cursor = connection.connection.cursor()
+    try:
+        cursor.copy_expert(COPY_CSV_SQL, io.BytesIO(buffer.getvalue().to_pybytes()))
+    finally:
+        cursor.close()
+
+
+def batch_rows(batch) -> list[tuple]:
+    """
+    Converts a record batch into rows, column by column.
+    :param batch: the pyarrow.RecordBatch, with the columns ordered like CSV_FIELDS.
+    :return: the rows, ordered like CSV_FIELDS.
+    """
+    return list(zip(*[column.to_pylist() for column in batch.columns]))
+
+
+def sqlite_rows(batch) -> list[tuple]:
+    """
+    Converts a record batch into rows of the values stored by SQLite, casting whole columns to the storage formats
+    of SQLAlchemy ('YYYY-MM-DD' dates, 'YYYY-MM-DD HH:MM:SS.ffffff' datetimes and 0 or 1 booleans) instead of
+    going through the type processors of SQLAlchemy value by value.
+    :param batch: the pyarrow.RecordBatch, with the columns ordered like CSV_FIELDS.
+    :return: the rows, ordered like CSV_FIELDS.
+    """
+    columns = []
+    for column in batch.columns:
+        if pyarrow.types.is_temporal(column.type):
+            column = column.cast(pyarrow.string())
+        elif pyarrow.types.is_boolean(column.type):
+            column = column.cast(pyarrow.int8())
+        columns.append(column.to_pylist())
+    return list(zip(*columns))
+
+
+def write_batch(connection: Connection, batch) -> None:
+    """
+    Loads a record batch with the fastest method supported by the database of the connection.
+    :param connection: an open connection to the database.
+    :param batch: the pyarrow.RecordBatch, with the columns ordered like CSV_FIELDS.
+    :return: None
+    """
+    if connection.dialect.name == 'postgresql':
+        copy_batch(connection, batch)
+    elif connection.dialect.name == 'sqlite':
+        connection.exec_driver_sql(INSERT_SQL, sqlite_rows(batch))
+    else:
+        insert_rows(connection, batch_rows(batch))
+
+
+def _audited_rows(group: list[tuple[dict, int, object]]) -> Iterator[dict]:
+    """
+    Converts the rows of a group of record batches only when the audit records them one by one.
+    :param group: the (checkpoint, row offset, record batch) of the group.
+    :return: an iterator over the rows, as dictionaries of column values.
+    """
+    for _, _, batch in group:
+        yield from batch.to_pylist()
+
+
+def prepare_snapshot_checkpoints(engine: Engine, path: str) -> list[dict]:
+    """
+    Reads the checkpoints of the load of a snapshot, creating them on the first run. Each partition file has
+    one checkpoint whose offsets count rows instead of bytes, as documented on IngestCheckpoint: a file loaded
+    in part has a byte_offset, its first row not loaded yet, after its range_start.
+    :param engine: the engine of the loaded database.
+    :param path: the directory of the snapshot.
+    :return: the checkpoints of the files not completely loaded, with the path of their file.
+    """
+    manifest = read_manifest(path)
+    pending = []
+    with engine.begin() as connection:
+        for name, rows in manifest['files'].items():
+            file_path = os.path.join(path, name)
+            identity = file_identity(file_path)
+            checkpoints = load_checkpoints(connection, identity)
+            if not checkpoints:
+                checkpoints = create_checkpoints(connection, identity, [(0, rows)], 0)
+            pending.extend(dict(checkpoint, file_path=file_path) for checkpoint in checkpoints
+                           if not checkpoint['completed'])
+    resumed = [checkpoint for checkpoint in pending if checkpoint['byte_offset'] > checkpoint['range_start']]
+    if resumed:
+        print(f"Resuming the load of {len(resumed)} snapshot files from their last checkpoint.")
+    return pending
+
+
+def iter_load_batches(checkpoints: list[dict], batch_size: int) -> Iterator[list[tuple[dict, int, object]]]:
+    """
+    Groups the record batches of the partition files into batches of batch_size rows, the small partitions
+    sharing the transaction of their neighbours.
+    :param checkpoints: the checkpoints of the files to load, as returned by prepare_snapshot_checkpoints.
+    :param batch_size: number of rows loaded per transaction.
+    :return: an iterator over the groups of (checkpoint, row offset in the file, record batch).
+    """
+    group = []
+    group_rows = 0
+    for checkpoint in checkpoints:
+        offset = checkpoint['byte_offset']
+        for batch in iter_file_batches(checkpoint['file_path'], batch_size, offset):
+            while batch.num_rows:
+                piece = batch.slice(0, batch_size - group_rows)
+                group.append((checkpoint, offset, piece))
+                group_rows += piece.num_rows
+                offset += piece.num_rows
+                batch = batch.slice(piece.num_rows)
+                if group_rows >= batch_size:
+                    yield group
+                    group = []
+                    group_rows = 0
+    if group:
+        yield group
+
+
+def load_snapshot(path: str, batch_size: int = DEFAULT_BATCH_SIZE, engine: Engine | None = None,
+                  audit_mode: str = DEFAULT_AUDIT_INGEST_MODE) -> dict:
+    """
+    Loads a snapshot into the Etablissement table, one transaction per batch. The typed columns of the snapshot
+    are loaded without parsing: with COPY of their CSV rendering on PostgreSQL, with batched executemany inserts
+    on the other databases. An interrupted load resumes each partition file from its last checkpoint.
+    :param path: the directory of the snapshot.
+    :param batch_size: number of rows loaded per transaction.
+    :param engine: the engine to load the data with, defaults to the engine of the Flask app.
+    :param audit_mode: 'batch' for one audit entry per batch, 'row' for one per row, 'off' for none.
+    :return: the statistics of the run (rows, seconds, rows_per_second).
+    """
+    _require_pyarrow()
+    engine = engine if engine is not None else db.engine
+    start = time.perf_counter()
+    rows_loaded = 0
+    for group in iter_load_batches(prepare_snapshot_checkpoints(engine, path), batch_size):
+        rows = sum(piece.num_rows for _, _, piece in group)
+        summary = {'source': path, 'rows': rows,
+                   'ranges': [[checkpoint['file_path'], offset, offset + piece.num_rows]
+                              for checkpoint, offset, piece in group]}
+        with engine.begin() as connection:
+            for checkpoint, offset, piece in group:
+                write_batch(connection, piece)
+                end = offset + piece.num_rows
+                advance_checkpoint(connection, checkpoint['id'], end, end, end, completed=end >= checkpoint['range_end'])
+            write_audit_entries(connection, batch_entries(
+                audit_mode, etablissement_table.name, 'INGEST', summary, inserted=_audited_rows(group)
+            ))
+            bump_etablissements_version(connection)
+        notify_etablissements_changed('ingest')
+        rows_loaded += rows
+        stats = ingest_stats(rows_loaded, time.perf_counter() - start)
+        print(f"Loaded {stats['rows']} rows from the snapshot ({stats['rows_per_second']} rows/s).")
+    return ingest_stats(rows_loaded, time.perf_counter() - start)
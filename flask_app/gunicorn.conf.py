@@ -0,0 +1,39 @@
+"""
+Gunicorn configuration of the production server: pre-fork workers sharing an app preloaded by the master.
+"""
+
+import multiprocessing
+import os
+
+# The application factory, imported from the directory containing the flask_app package. With SERVER_MODE=asgi,
+# the async app is served by uvicorn workers, each one serving many requests at once on its event loop
+server_mode = os.getenv("SERVER_MODE", "wsgi")
+if server_mode == "asgi":
+    wsgi_app = "flask_app.asgi:create_async_app()"
+    worker_class = "uvicorn_worker.UvicornWorker"
+else:
+    wsgi_app = "flask_app.app:create_app()"
+pythonpath = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+bind = os.getenv("GUNICORN_BIND", "0.0.0.0:5000")
+
+# One worker per core by default, the requests being mostly bound by the database and the JSON encoding
+workers = int(os.getenv("WEB_CONCURRENCY", str(multiprocessing.cpu_count())))
+# Told to the app, whose in-process caches do not see the writes of the other workers
+os.environ["WEB_CONCURRENCY"] = str(workers)
+threads = int(os.getenv("GUNICORN_THREADS", "1"))
+
+# The app is created once, in the master, which initializes the database before forking the workers:
+# the workers start serving immediately and none of them runs the initialization
+preload_app = True
+
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "60"))
+graceful_timeout = 30
+keepalive = 5
+
+# Restart the workers from time to time to bound the growth of their memory
+max_requests = int(os.getenv("GUNICORN_MAX_REQUESTS", "10000"))
+max_requests_jitter = max_requests // 10
+
+accesslog = "-"
+errorlog = "-"
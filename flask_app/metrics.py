@@ -0,0 +1,270 @@
+"""
+Per-request instrumentation: SQL time and query count (SQLAlchemy cursor events), serialization time, response size
+and duration of a sample of the requests, aggregated by route and exposed at /metrics in the Prometheus text format.
+"""
+
+import bisect
+import random
+import threading
+import time
+
+from collections import Counter
+
+from flask import Blueprint, current_app, g, has_request_context, request, Response
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Default share of the requests instrumented, between 0 (disabled) and 1 (all of them)
+DEFAULT_METRICS_SAMPLE_RATE = 0.0
+
+# Default number of executions of the same statement in one request from which the request is flagged as N+1
+DEFAULT_N_PLUS_ONE_THRESHOLD = 10
+
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERIES_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+BYTES_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+# Name, help and buckets of each histogram
+HISTOGRAMS = {
+    'http_request_duration_seconds': ("Duration of the requests", SECONDS_BUCKETS),
+    'http_request_sql_duration_seconds': ("Time spent executing SQL statements per request", SECONDS_BUCKETS),
+    'http_request_sql_queries': ("Number of SQL statements executed per request", QUERIES_BUCKETS),
+    'http_request_serialization_duration_seconds': ("Time spent encoding JSON per request", SECONDS_BUCKETS),
+    'http_response_size_bytes': ("Size of the response bodies, streamed responses excluded", BYTES_BUCKETS),
+}
+
+N_PLUS_ONE_COUNTER = 'http_requests_n_plus_one_total'
+
+# Name and help of the histogram of the connection pools, measured by the pools themselves
+POOL_WAIT_HISTOGRAM = ('db_pool_checkout_wait_seconds', "Time waited to check out a connection from the pool")
+
+metrics_bp = Blueprint('metrics', __name__)
+
+
+class Histogram:
+    """
+    Cumulative histogram of observed values, with their sum and count.
+    """
+
+    def __init__(self, buckets: tuple):
+        """
+        :param buckets: the upper bounds of the buckets, in increasing order.
+        """
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        """
+        Adds a value to the histogram.
+        :param value: the observed value.
+        :return: None
+        """
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class MetricsRegistry:
+    """
+    Thread-safe histograms and counters of the instrumented requests, by route and method.
+    """
+
+    def __init__(self):
+        self._histograms: dict[tuple[str, tuple], Histogram] = {}
+        self._counters: Counter = Counter()
+        self._lock = threading.Lock()
+
+    def observe(self, name: str, labels: tuple, value: float) -> None:
+        """
+        Adds a value to a histogram.
+        :param name: the name of the histogram.
+        :param labels: the (name, value) labels of the histogram.
+        :param value: the observed value.
+        :return: None
+        """
+        with self._lock:
+            histogram = self._histograms.get((name, labels))
+            if histogram is None:
+                histogram = self._histograms[(name, labels)] = Histogram(HISTOGRAMS[name][1])
+            histogram.observe(value)
+
+    def increment(self, name: str, labels: tuple) -> None:
+        """
+        Increments a counter.
+        :param name: the name of the counter.
+        :param labels: the (name, value) labels of the counter.
+        :return: None
+        """
+        with self._lock:
+            self._counters[(name, labels)] += 1
+
+    def render(self) -> str:
+        """
+        Writes the metrics in the Prometheus text exposition format.
+        :return: the metrics.
+        """
+        lines = []
+        with self._lock:
+            for name, (description, _) in HISTOGRAMS.items():
+                lines.append(f"# HELP {name} {description}")
+                lines.append(f"# TYPE {name} histogram")
+                for (histogram_name, labels), histogram in sorted(self._histograms.items()):
+                    if histogram_name == name:
+                        lines.extend(_histogram_lines(name, labels, histogram))
+
+            lines.append(f"# HELP {N_PLUS_ONE_COUNTER} Requests executing the same SQL statement repeatedly")
+            lines.append(f"# TYPE {N_PLUS_ONE_COUNTER} counter")
+            for (name, labels), count in sorted(self._counters.items()):
+                lines.append(f"{name}{_labels(labels)} {count}")
+        return '\n'.join(lines) + '\n'
+
+
+def _histogram_lines(name: str, labels: tuple, histogram: Histogram) -> list[str]:
+    """
+    Writes the buckets, sum and count of a histogram in the Prometheus text format.
+    :param name: the name of the histogram.
+    :param labels: the (name, value) labels of the histogram.
+    :param histogram: the histogram.
+    :return: the lines of the histogram.
+    """
+    lines = []
+    cumulative = 0
+    for bound, count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+        cumulative += count
+        lines.append(f"{name}_bucket{_labels(labels + (('le', str(bound)),))} {cumulative}")
+    lines.append(f"{name}_sum{_labels(labels)} {histogram.sum}")
+    lines.append(f"{name}_count{_labels(labels)} {histogram.count}")
+    return lines
+
+
+def render_pool_metrics(engines: dict) -> str:
+    """
+    Writes the checkout wait times of the connection pools that measure them, in the Prometheus text format.
+    :param engines: the engines, by bind key (None for the primary database).
+    :return: the metrics.
+    """
+    name, description = POOL_WAIT_HISTOGRAM
+    lines = [f"# HELP {name} {description}", f"# TYPE {name} histogram"]
+    for key, engine in sorted(engines.items(), key=lambda item: str(item[0] or '')):
+        histogram = getattr(engine.pool, 'wait_histogram', None)
+        if histogram is not None:
+            lines.extend(_histogram_lines(name, (('bind', key or 'primary'),), histogram))
+    return '\n'.join(lines) + '\n'
+
+
+def _labels(labels: tuple) -> str:
+    """
+    Writes the labels of a metric, escaped for the Prometheus text format.
+    :param labels: the (name, value) labels.
+    :return: the labels between braces.
+    """
+    escaped = [(name, value.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')) for name, value in labels]
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+
+def get_metrics() -> MetricsRegistry:
+    """
+    Gets the metrics of the current Flask app, creating them on first use.
+    :return: the metrics.
+    """
+    return current_app.extensions.setdefault('metrics', MetricsRegistry())
+
+
+def current_request_metrics() -> dict | None:
+    """
+    Gets the measures of the current request, if it is instrumented.
+    :return: the measures, or None outside of an instrumented request.
+    """
+    return g.get('request_metrics') if has_request_context() else None
+
+
+def add_serialization_time(seconds: float) -> None:
+    """
+    Adds time spent encoding JSON to the measures of the current request, if it is instrumented.
+    :param seconds: the time spent.
+    :return: None
+    """
+    measures = current_request_metrics()
+    if measures is not None:
+        measures['serialization_seconds'] += seconds
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def start_statement_timer(conn, cursor, statement, parameters, context, executemany) -> None:
+    """
+    Event listener starting the timer of a SQL statement executed during an instrumented request.
+    :return: None
+    """
+    if current_request_metrics() is not None:
+        conn.info.setdefault('request_metrics_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def stop_statement_timer(conn, cursor, statement, parameters, context, executemany) -> None:
+    """
+    Event listener adding the time of a SQL statement to the measures of the instrumented request.
+    :return: None
+    """
+    measures = current_request_metrics()
+    starts = conn.info.get('request_metrics_start')
+    if measures is None or not starts:
+        return
+    measures['sql_seconds'] += time.perf_counter() - starts.pop()
+    measures['statements'][statement] += 1
+
+
+@metrics_bp.before_app_request
+def start_request_metrics() -> None:
+    """
+    Instruments a sample of the requests, METRICS_SAMPLE_RATE of them.
+    :return: None
+    """
+    rate = current_app.config.get('METRICS_SAMPLE_RATE', DEFAULT_METRICS_SAMPLE_RATE)
+    if rate <= 0 or request.endpoint == 'metrics.get_metrics_text' or (rate < 1 and random.random() >= rate):
+        return
+    g.request_metrics = {'start': time.perf_counter(), 'sql_seconds': 0.0, 'serialization_seconds': 0.0,
+                         'statements': Counter()}
+
+
+@metrics_bp.after_app_request
+def record_request_metrics(response: Response) -> Response:
+    """
+    Records the measures of an instrumented request, and flags it when it executed the same statement
+    N_PLUS_ONE_THRESHOLD times or more, the sign of a query per item instead of one query for all of them.
+    :param response: the response of the request.
+    :return: the response.
+    """
+    measures = g.pop('request_metrics', None)
+    if measures is None:
+        return response
+
+    labels = (('route', request.url_rule.rule if request.url_rule is not None else 'unmatched'),
+              ('method', request.method))
+    metrics = get_metrics()
+    metrics.observe('http_request_duration_seconds', labels, time.perf_counter() - measures['start'])
+    metrics.observe('http_request_sql_duration_seconds', labels, measures['sql_seconds'])
+    metrics.observe('http_request_sql_queries', labels, sum(measures['statements'].values()))
+    metrics.observe('http_request_serialization_duration_seconds', labels, measures['serialization_seconds'])
+    if not response.is_streamed:
+        metrics.observe('http_response_size_bytes', labels, response.calculate_content_length() or 0)
+
+    threshold = current_app.config.get('N_PLUS_ONE_THRESHOLD', DEFAULT_N_PLUS_ONE_THRESHOLD)
+    repeated = [(statement, count) for statement, count in measures['statements'].items() if count >= threshold]
+    if repeated:
+        metrics.increment(N_PLUS_ONE_COUNTER, labels)
+        for statement, count in repeated:
+            print(f"Possible N+1 queries on {request.method} {labels[0][1]}: executed {count} times: {statement}")
+    return response
+
+
+@metrics_bp.route("/metrics", methods=["GET"])
+def get_metrics_text() -> Response:
+    """
+    Get the metrics of the instrumented requests and of the connection pools of this process,
+    in the Prometheus text format.
+    :return: the metrics.
+    """
+    text = get_metrics().render() + render_pool_metrics(current_app.extensions['sqlalchemy'].engines)
+    return Response(text, mimetype='text/plain; version=0.0.4')
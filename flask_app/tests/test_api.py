@@ -2,14 +2,28 @@
 Tests API endpoints.
 """
 
+import csv
+import io
+import json
 import unittest
 
 import datetime
 
+from unittest import mock
+
 from flask import Flask
+from sqlalchemy import create_engine, select
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import Query
 
-from flask_app.db.models import Etablissement, db
+from flask_app.db.models import AuditLog, Etablissement, db
+from flask_app.api.detail_cache import DEFAULT_DETAIL_CACHE_TTL, DEFAULT_MULTI_PROCESS_DETAIL_CACHE_TTL, \
+    get_detail_cache
+from flask_app.api.pagination import keyset_keys, keyset_segments
 from flask_app.api.routes import api_bp
+from flask_app.db.bulk_write import bulk_write
+from flask_app.db.events import notify_etablissements_changed
+from flask_app.db.search import _DOCUMENT_SQL, search_statement
 
 
 class TestEtablissementAPI(unittest.TestCase):
@@ -75,6 +89,44 @@ class TestEtablissementAPI(unittest.TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.json, {"message": "Hello, World!"})
 
+    def test_count_establishments(self):
+        """
+        Test the cached count of the /db_check route and its invalidation on writes.
+        """
+        response = self.client.get('/api/db_check')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json, {'count': 1, 'count_type': 'exact'})
+
+        self.client.post('/api/etablissements', json={"siren": "987654321", "nic": "00098", "siret": "98765432100098"})
+        response = self.client.get('/api/db_check')
+        self.assertEqual(response.json['count'], 2)
+
+        # SQLite has no planner estimates, the count falls back to an exact one
+        response = self.client.get('/api/db_check?count=estimate')
+        self.assertEqual(response.json, {'count': 2, 'count_type': 'exact'})
+
+        self.client.delete('/api/etablissements/98765432100098')
+        response = self.client.get('/api/etablissements?per_page=1')
+        self.assertEqual(response.json['total'], 1)
+        self.assertEqual(response.json['total_type'], 'exact')
+        self.assertEqual(response.json['pages'], 1)
+
+        # The writes of another process, whose signals do not reach this one, change the version of the counts
+        with self.app.app_context(), mock.patch('flask_app.db.bulk_write.notify_etablissements_changed'):
+            bulk_write('insert', [(0, {"siren": "987654321", "nic": "00097", "siret": "98765432100097"})])
+
+        # A count read while the Etablissements change is not cached
+        def count_during_write(query):
+            notify_etablissements_changed('test')
+            return 5
+
+        with mock.patch.object(Query, 'count', count_during_write):
+            self.assertEqual(self.client.get('/api/db_check').json['count'], 5)
+        self.assertEqual(self.client.get('/api/db_check').json['count'], 2)
+
+        response = self.client.get('/api/db_check?count=approximate')
+        self.assertEqual(response.status_code, 400)
+
     def test_get_etablissements(self):
         """
         Test fetching a list of etablissements.
@@ -84,6 +136,347 @@ class TestEtablissementAPI(unittest.TestCase):
         self.assertEqual(len(response.json['items']), 1)
         self.assertEqual(response.json['items'][0]['siret'], "12345678900012")
 
+    def test_get_etablissements_with_operators(self):
+        """
+        Test the range, prefix, set and NULL filters of the list.
+        """
+        with self.app.app_context():
+            for index, (code_postal, activite, day) in enumerate([("75002", "47.11Z", datetime.date(2019, 6, 1)),
+                                                                  ("69001", "47.11A", datetime.date(2021, 3, 1)),
+                                                                  ("7500%", None, None)]):
+                db.session.add(Etablissement(siren="400000000", nic=f"0000{index}", siret=f"4000000000000{index}",
+                                             code_postal=code_postal, activite_principale=activite,
+                                             date_creation=day))
+            db.session.commit()
+
+        def sirets(query):
+            response = self.client.get(f'/api/etablissements?per_page=10&sort=siret&{query}')
+            self.assertEqual(response.status_code, 200, response.data)
+            return [item['siret'] for item in response.json['items']]
+
+        self.assertEqual(sirets('code_postal__prefix=750'),
+                         ["12345678900012", "40000000000000", "40000000000002"])
+        # The wildcards of LIKE are matched literally
+        self.assertEqual(sirets('code_postal__prefix=7500%25'), ["40000000000002"])
+        self.assertEqual(sirets('date_creation__gte=2020-01-01&date_creation__lt=2022-01-01'), ["40000000000001"])
+        self.assertEqual(sirets('code_postal__in=69001,75002'), ["40000000000000", "40000000000001"])
+        self.assertEqual(sirets('activite_principale__is_null=true'), ["12345678900012", "40000000000002"])
+        self.assertEqual(sirets('activite_principale__prefix=47.11&date_creation__lte=2019-06-01'), ["40000000000000"])
+        self.assertEqual(sirets('tranche_effectifs__gt=5&etablissement_siege=true'), ["12345678900012"])
+
+        # The export and the counts use the same filters
+        response = self.client.get('/api/etablissements/export?code_postal__prefix=75&fields=siret')
+        self.assertEqual(len(response.data.splitlines()), 3)
+        response = self.client.get('/api/etablissements?date_creation__is_null=false&count=exact')
+        self.assertEqual(response.json['total'], 3)
+
+        for query in ('code_postal__like=75', 'date_creation__gte=2020-13-01', 'tranche_effectifs__prefix=1',
+                      'etablissement_siege=maybe'):
+            response = self.client.get(f'/api/etablissements?{query}')
+            self.assertEqual(response.status_code, 400, query)
+
+    def test_query_shapes(self):
+        """
+        Test the recorder of the list query shapes and the index advisor.
+        """
+        self.app.config['QUERY_SHAPES_SIZE'] = 10
+        self.app.config['ADMIN_TOKEN'] = "secret"
+        headers = {'X-Admin-Token': "secret"}
+
+        self.client.get('/api/etablissements?statut_diffusion=O&sort=-annee_effectifs&per_page=5')
+        self.client.get('/api/etablissements?statut_diffusion=A&sort=-annee_effectifs&per_page=5')
+        self.client.get('/api/etablissements?code_postal__prefix=75&cursor=')
+
+        self.assertEqual(self.client.get('/api/admin/query-shapes').status_code, 403)
+        response = self.client.get('/api/admin/query-shapes', headers=headers)
+        self.assertEqual(response.status_code, 200)
+        shapes = {shape['shape']: shape for shape in response.json['shapes']}
+        self.assertEqual(shapes['filters=statut_diffusion:eq;sort=-annee_effectifs;paging=offset']['count'], 2)
+        self.assertEqual(shapes['filters=code_postal:prefix;sort=;paging=cursor']['mean_rows'], 1)
+
+        response = self.client.get('/api/admin/query-shapes/explain?limit=5&analyze=true', headers=headers)
+        self.assertEqual(response.status_code, 200)
+        explained = {shape['shape']: shape['explain'] for shape in response.json['shapes']}
+        self.assertTrue(explained['filters=statut_diffusion:eq;sort=-annee_effectifs;paging=offset']['full_scan'])
+        self.assertTrue(set(explained['filters=code_postal:prefix;sort=;paging=cursor']['indexes'])
+                        & {'idx_code_postal_siret', 'idx_code_postal_date_creation_siret'})
+        # The prefix is served by an existing index, only the other shape misses one
+        self.assertEqual([(index['name'], index['columns']) for index in response.json['suggested_indexes']],
+                         [('idx_statut_diffusion_annee_effectifs', ['statut_diffusion', 'annee_effectifs'])])
+
+        response = self.client.get('/api/admin/index-suggestions?format=sql', headers=headers)
+        self.assertEqual(response.get_data(as_text=True),
+                         "CREATE INDEX IF NOT EXISTS idx_statut_diffusion_annee_effectifs "
+                         "ON etablissement (statut_diffusion, annee_effectifs);\n")
+        response = self.client.get('/api/admin/index-suggestions?format=alembic&down_revision=abc', headers=headers)
+        script = response.get_data(as_text=True)
+        compile(script, 'migration.py', 'exec')
+        self.assertIn("down_revision = 'abc'", script)
+        self.assertIn("op.create_index('idx_statut_diffusion_annee_effectifs'", script)
+
+        self.assertEqual(self.client.delete('/api/admin/query-shapes', headers=headers).status_code, 200)
+        self.assertEqual(self.client.get('/api/admin/query-shapes', headers=headers).json['shapes'], [])
+
+    def test_get_etablissements_etag(self):
+        """
+        Test that list responses are cached with an ETag until the table changes.
+        """
+        response = self.client.get('/api/etablissements?per_page=5&code_postal=75001')
+        self.assertEqual(response.status_code, 200)
+        etag = response.headers['ETag']
+
+        # The order of the query parameters does not matter
+        response = self.client.get('/api/etablissements?code_postal=75001&per_page=5',
+                                   headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.get_data(), b'')
+        self.assertEqual(self.client.get('/api/cache/stats').json['lists']['hits'], 1)
+
+        self.client.put('/api/etablissements/12345678900012', json={'libelle_commune': "Paris 1er"})
+        response = self.client.get('/api/etablissements?per_page=5&code_postal=75001',
+                                   headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+        self.assertEqual(response.json['items'][0]['libelle_commune'], "Paris 1er")
+
+        # The writes of another process, whose signals do not reach this one, bump the version in the database
+        etag = response.headers['ETag']
+        with self.app.app_context(), mock.patch('flask_app.db.bulk_write.notify_etablissements_changed') as notify:
+            bulk_write('update', [(0, {'siret': "12345678900012", 'libelle_commune': "Paris"})])
+        notify.assert_called_once()
+        response = self.client.get('/api/etablissements?per_page=5&code_postal=75001',
+                                   headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json['items'][0]['libelle_commune'], "Paris")
+
+        response = self.client.get('/api/etablissements?sort=unknown')
+        self.assertEqual(response.status_code, 400)
+        self.assertNotIn('ETag', response.headers)
+
+    def test_get_etablissements_with_cursor(self):
+        """
+        Test walking through etablissements with keyset pagination, NULL sort values included.
+        """
+        with self.app.app_context():
+            for index in range(11):
+                db.session.add(Etablissement(
+                    siren=f"{200000000 + index}",
+                    nic="00010",
+                    siret=f"{200000000 + index}00010",
+                    date_creation=datetime.date(2020, 1, 1 + index % 3) if index % 4 else None,
+                    code_postal="75002",
+                ))
+            db.session.commit()
+
+        sirets = []
+        cursor = ''
+        pages = 0
+        while cursor is not None:
+            response = self.client.get('/api/etablissements',
+                                       query_string={'sort': '-date_creation', 'per_page': 3, 'cursor': cursor})
+            self.assertEqual(response.status_code, 200)
+            self.assertNotIn('total', response.json)
+            sirets.extend(item['siret'] for item in response.json['items'])
+            cursor = response.json['next_cursor']
+            pages += 1
+
+        self.assertEqual(pages, 4)
+        self.assertEqual(len(sirets), 12)
+        self.assertEqual(len(set(sirets)), 12)
+        # Most recent first, ties broken by siret in the same direction, NULL dates last
+        self.assertEqual(sirets[:3], ["12345678900012", "20000000500010", "20000000200010"])
+        self.assertEqual(sirets[-3:], ["20000000800010", "20000000400010", "20000000000010"])
+
+        response = self.client.get('/api/etablissements',
+                                   query_string={'code_postal': '75002', 'cursor': '', 'count': 'exact'})
+        self.assertEqual(response.json['total'], 11)
+
+        response = self.client.get('/api/etablissements', query_string={'sort': 'siret', 'cursor': cursor or 'bad'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_fields_projection(self):
+        """
+        Test selecting only some fields on the list and detail routes.
+        """
+        response = self.client.get('/api/etablissements?fields=siret,code_postal')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json['items'], [{'siret': "12345678900012", 'code_postal': "75001"}])
+
+        response = self.client.get('/api/etablissements?fields=code_postal&sort=-date_creation&cursor=')
+        self.assertEqual(response.json['items'], [{'code_postal': "75001"}])
+
+        response = self.client.get('/api/etablissements/12345678900012?fields=libelle_commune,date_creation')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(set(response.json), {'libelle_commune', 'date_creation'})
+
+        response = self.client.get('/api/etablissements/00000000000000?fields=siret')
+        self.assertEqual(response.status_code, 404)
+
+        response = self.client.get('/api/etablissements?fields=siret,unknown')
+        self.assertEqual(response.status_code, 400)
+
+    def test_export_etablissements(self):
+        """
+        Test streaming the filtered etablissements as NDJSON and CSV.
+        """
+        with self.app.app_context():
+            for index in range(5):
+                db.session.add(Etablissement(siren="300000000", nic=f"0000{index}", siret=f"3000000000000{index}",
+                                             code_postal="69001" if index % 2 else "75001"))
+            db.session.commit()
+
+        response = self.client.get('/api/etablissements/export?code_postal=75001&sort=-siret')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        lines = response.get_data(as_text=True).splitlines()
+        sirets = [json.loads(line)['siret'] for line in lines]
+        self.assertEqual(sirets, ["30000000000004", "30000000000002", "30000000000000", "12345678900012"])
+        self.assertEqual(json.loads(lines[-1])['libelle_commune'], "Paris")
+
+        response = self.client.get('/api/etablissements/export?format=csv&code_postal=69001')
+        self.assertEqual(response.mimetype, 'text/csv')
+        rows = list(csv.DictReader(io.StringIO(response.get_data(as_text=True))))
+        self.assertEqual(sorted(row['siret'] for row in rows), ["30000000000001", "30000000000003"])
+
+        response = self.client.get('/api/etablissements/export?format=xml')
+        self.assertEqual(response.status_code, 400)
+
+    def test_lookup_etablissements(self):
+        """
+        Test fetching many etablissements at once by SIRET and SIREN.
+        """
+        with self.app.app_context():
+            for index in range(3):
+                db.session.add(Etablissement(siren="300000000", nic=f"0000{index}", siret=f"3000000000000{index}"))
+            db.session.commit()
+
+        response = self.client.post('/api/etablissements/lookup', json={
+            'sirets': ["12345678900012", "00000000000000", "12345678900012"],
+            'sirens': ["300000000", "999999999"],
+            'fields': ["siret", "code_postal"],
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json['items'], [
+            {'siret': "12345678900012", 'code_postal': "75001"},
+            {'siret': "30000000000000", 'code_postal': None},
+            {'siret': "30000000000001", 'code_postal': None},
+            {'siret': "30000000000002", 'code_postal': None},
+        ])
+        self.assertEqual(response.json['missing'], {'sirets': ["00000000000000"], 'sirens': ["999999999"]})
+
+        response = self.client.post('/api/etablissements/lookup', json={'sirets': ["30000000000001"]})
+        self.assertEqual(response.json['items'][0]['siren'], "300000000")
+
+        self.app.config["LOOKUP_MAX_ITEMS"] = 2
+        response = self.client.post('/api/etablissements/lookup', json={'sirets': ["1", "2", "3"]})
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post('/api/etablissements/lookup', json={'sirets': "12345678900012"})
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post('/api/etablissements/lookup', json={'sirets': ["1"], 'fields': ["unknown"]})
+        self.assertEqual(response.status_code, 400)
+
+    def test_bulk_write_etablissements(self):
+        """
+        Test creating and updating etablissements in bulk, with a status per record.
+        """
+        self.app.config["BULK_CHUNK_SIZE"] = 2
+        records = [
+            {'siret': "40000000000001", 'siren': "400000000", 'nic': "00001", 'date_creation': "2020-05-01"},
+            {'siret': "40000000000002", 'siren': "400000000", 'nic': "00002", 'code_postal': "69001"},
+            {'siret': "12345678900012", 'siren': "123456789", 'nic': "00012"},
+            {'siret': "40000000000003", 'siren': "400000000"},
+            {'siret': "40000000000004", 'siren': "400000000", 'nic': "00004", 'date_creation': "01/01/2020"},
+            {'siret': "40000000000001", 'siren': "400000000", 'nic': "00001"},
+        ]
+        response = self.client.post('/api/etablissements/bulk', json=records)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((response.json['inserted'], response.json['errors']), (2, 4))
+        self.assertEqual([item['status'] for item in response.json['items']],
+                         ['inserted', 'inserted', 'error', 'error', 'error', 'error'])
+        self.assertEqual(response.json['items'][2]['error'], "Etablissement with this SIRET already exists")
+        self.assertEqual(response.json['items'][3]['error'], "Missing required field(s): nic")
+
+        changes = "\n".join(json.dumps(record) for record in [
+            {'siret': "40000000000002", 'code_postal': "75002", 'tranche_effectifs': 5},
+            {'siret': "12345678900012", 'code_postal': "75003"},
+            {'siret': "40000000000001", 'nic': "99999"},
+            {'siret': "00000000000000", 'code_postal': "75004"},
+        ])
+        response = self.client.post('/api/etablissements/bulk?mode=update', data=changes,
+                                    content_type='application/x-ndjson')
+        self.assertEqual([item['status'] for item in response.json['items']],
+                         ['updated', 'updated', 'error', 'error'])
+        self.assertEqual(response.json['items'][3]['error'], "Etablissement not found")
+
+        response = self.client.post('/api/etablissements/bulk?mode=upsert', json=[
+            {'siret': "40000000000002", 'siren': "400000000", 'nic': "00002", 'libelle_commune': "Paris"},
+            {'siret': "40000000000005", 'siren': "400000000", 'nic': "00005"},
+        ])
+        self.assertEqual([item['status'] for item in response.json['items']], ['updated', 'inserted'])
+
+        with self.app.app_context():
+            etablissement = db.session.get(Etablissement, "40000000000002")
+            self.assertEqual((etablissement.code_postal, etablissement.tranche_effectifs, etablissement.libelle_commune),
+                             ("75002", 5, "Paris"))
+            self.assertEqual(db.session.get(Etablissement, "40000000000001").date_creation, datetime.date(2020, 5, 1))
+            self.assertEqual(db.session.get(Etablissement, "12345678900012").code_postal, "75003")
+            # The upsert of an unchanged code_postal only audits the new libelle_commune
+            entries = AuditLog.query.filter_by(operation='UPDATE').order_by(AuditLog.id).all()
+            self.assertEqual([set(entry.row_data['changes']) for entry in entries],
+                             [{'code_postal', 'tranche_effectifs'}, {'code_postal'}, {'libelle_commune'}])
+
+        response = self.client.post('/api/etablissements/bulk?mode=replace', json=records)
+        self.assertEqual(response.status_code, 400)
+
+    def test_get_audit_log(self):
+        """
+        Test querying the audit history of an etablissement.
+        """
+        self.client.put('/api/etablissements/12345678900012', json={'code_postal': "75002"})
+        self.client.put('/api/etablissements/12345678900012', json={'code_postal': "75003"})
+
+        response = self.client.get('/api/audit?siret=12345678900012&operation=UPDATE')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([item['row_data']['changes']['code_postal']['new'] for item in response.json['items']],
+                         ["75003", "75002"])
+
+        response = self.client.get('/api/audit', query_string={'siret': "12345678900012", 'per_page': 1, 'page': 3})
+        self.assertEqual(response.json['items'][0]['operation'], "INSERT")
+
+        response = self.client.get('/api/audit?siret=12345678900012&until=2000-01-01')
+        self.assertEqual(response.json['items'], [])
+
+        response = self.client.get('/api/audit?since=yesterday')
+        self.assertEqual(response.status_code, 400)
+
+    def test_search_etablissements(self):
+        """
+        Test the ranked and typo-tolerant search by name.
+        """
+        with self.app.app_context():
+            for index, name in enumerate(["BOULANGERIE DU MARCHE", "BOULANGERIE PATISSERIE", "GARAGE CENTRAL"]):
+                db.session.add(Etablissement(siren="300000000", nic=f"0000{index}", siret=f"3000000000000{index}",
+                                             enseigne1=name, libelle_commune="LYON"))
+            db.session.commit()
+
+        response = self.client.get('/api/etablissements/search?q=boulangerie marche&fields=siret,enseigne1')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([item['siret'] for item in response.json['items']][:2], ["30000000000000", "30000000000001"])
+        self.assertEqual(set(response.json['items'][0]), {'siret', 'enseigne1', 'score'})
+
+        # A misspelled name still finds the closest etablissements
+        response = self.client.get('/api/etablissements/search?q=boulangrie&limit=2')
+        self.assertEqual({item['enseigne1'] for item in response.json['items']},
+                         {"BOULANGERIE DU MARCHE", "BOULANGERIE PATISSERIE"})
+
+        # The index follows the updates
+        self.client.put('/api/etablissements/30000000000002', json={'enseigne1': "GARAGE DU MARCHE"})
+        response = self.client.get('/api/etablissements/search?q=garage')
+        self.assertEqual(response.json['items'][0]['enseigne1'], "GARAGE DU MARCHE")
+
+        response = self.client.get('/api/etablissements/search?q=ab')
+        self.assertEqual(response.status_code, 400)
+
     def test_get_etablissement(self):
         """
         Test fetching a single etablissement by SIRET.
@@ -91,6 +484,65 @@ class TestEtablissementAPI(unittest.TestCase):
         response = self.client.get('/api/etablissements/12345678900012')
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.json['siret'], "12345678900012")
+        self.assertEqual(response.json['date_creation'], "Sat, 01 Jan 2022 00:00:00 GMT")
+        self.assertIsNone(response.json['date_debut'])
+
+        self.app.config["JSON_DATE_FORMAT"] = "iso"
+        response = self.client.get('/api/etablissements/12345678900012')
+        self.assertEqual(response.json['date_creation'], "2022-01-01")
+
+    def test_get_etablissement_cache(self):
+        """
+        Test that single etablissement lookups are cached and invalidated by writes.
+        """
+        # A projection is read alone from the database on a miss, and not cached
+        response = self.client.get('/api/etablissements/12345678900012?fields=code_postal')
+        self.assertEqual(response.json, {'code_postal': "75001"})
+        stats = self.client.get('/api/cache/stats').json['etablissements']
+        self.assertEqual((stats['hits'], stats['misses'], stats['size']), (0, 1, 0))
+
+        self.client.get('/api/etablissements/12345678900012')
+        for _ in range(2):
+            response = self.client.get('/api/etablissements/12345678900012?fields=code_postal')
+            self.assertEqual(response.json, {'code_postal': "75001"})
+        stats = self.client.get('/api/cache/stats').json['etablissements']
+        self.assertEqual((stats['hits'], stats['misses'], stats['size']), (2, 2, 1))
+
+        self.client.put('/api/etablissements/12345678900012', json={'code_postal': "75002"})
+        response = self.client.get('/api/etablissements/12345678900012')
+        self.assertEqual(response.json['code_postal'], "75002")
+
+        with self.app.app_context():
+            notify_etablissements_changed('ingest')
+        self.assertEqual(self.client.get('/api/cache/stats').json['etablissements']['size'], 0)
+
+        self.client.get('/api/etablissements/12345678900012')
+        self.client.delete('/api/etablissements/12345678900012')
+        response = self.client.get('/api/etablissements/12345678900012')
+        self.assertEqual(response.status_code, 404)
+
+        self.app.config["DETAIL_CACHE_SIZE"] = 2
+        self.app.extensions.pop('detail_cache')
+        with self.app.app_context():
+            for index in range(3):
+                db.session.add(Etablissement(siren="300000000", nic=f"0000{index}", siret=f"3000000000000{index}"))
+            db.session.commit()
+        for index in range(3):
+            self.client.get(f'/api/etablissements/3000000000000{index}')
+        self.assertEqual(self.client.get('/api/cache/stats').json['etablissements']['evictions'], 1)
+
+    def test_detail_cache_ttl(self):
+        """
+        Test that the in-process cache of several workers expires soon, unless its time to live is set.
+        """
+        with self.app.app_context():
+            self.assertEqual(get_detail_cache().ttl, DEFAULT_DETAIL_CACHE_TTL)
+            self.app.config["WEB_CONCURRENCY"] = 4
+            self.app.extensions.pop('detail_cache')
+            self.assertEqual(get_detail_cache().ttl, DEFAULT_MULTI_PROCESS_DETAIL_CACHE_TTL)
+            self.app.config["DETAIL_CACHE_TTL"] = 60.0
+            self.app.extensions.pop('detail_cache')
+            self.assertEqual(get_detail_cache().ttl, 60.0)
 
     def test_create_etablissement(self):
         """
@@ -130,6 +582,17 @@ class TestEtablissementAPI(unittest.TestCase):
         self.assertEqual(response.json['complement_adresse'], "Nouvelle adresse complémentaire")
         self.assertEqual(response.json['libelle_voie'], "Nouvelle Rue Exemple")
 
+        # Only the changed columns are audited, with their old and new values
+        with self.app.app_context():
+            entry = AuditLog.query.filter_by(operation='UPDATE').one()
+            self.assertEqual(entry.row_data, {
+                'siret': "12345678900012",
+                'changes': {
+                    'complement_adresse': {'old': "Adresse complémentaire", 'new': "Nouvelle adresse complémentaire"},
+                    'libelle_voie': {'old': "Rue Exemple", 'new': "Nouvelle Rue Exemple"},
+                },
+            })
+
     def test_delete_etablissement(self):
         """
         Test deleting an etablissement.
@@ -142,5 +605,48 @@ class TestEtablissementAPI(unittest.TestCase):
         self.assertEqual(response.status_code, 404)
 
 
+class TestSearchStatement(unittest.TestCase):
+    def test_postgresql_search(self):
+        """
+        Test that the PostgreSQL search compares the search with the whole indexed document.
+        """
+        statement = search_statement('postgresql', 'boulangerie', [Etablissement.siret], 10)
+        sql = str(statement.compile(dialect=postgresql.dialect()))
+        # The % of the operator is escaped for the pyformat parameters of psycopg2
+        self.assertIn(f"%(param_1)s <%% ({_DOCUMENT_SQL})", sql)
+        self.assertIn(f"word_similarity(%(word_similarity_1)s, ({_DOCUMENT_SQL}))", sql)
+        self.assertIn("to_tsvector('simple', coalesce(enseigne1, '')", sql)
+
+
+class TestKeysetPlans(unittest.TestCase):
+    def test_segments_are_index_seeks(self):
+        """
+        Test that every segment of a keyset page is a seek in an index, read in the order of the page.
+        """
+        engine = create_engine("sqlite://")
+        db.metadata.create_all(engine)
+        siret = "12345678900012"
+        cases = [
+            ([], [siret], ["sqlite_autoindex_etablissement_1 (siret>?)"]),
+            ([('code_postal', False)], ["75002", siret],
+             ["idx_code_postal_siret ((code_postal,siret)>(?,?))", "idx_code_postal_siret (code_postal=?)"]),
+            ([('code_postal', False)], [None, siret], ["idx_code_postal_siret (code_postal=? AND siret>?)"]),
+            ([('date_creation', True)], [datetime.date(2020, 1, 1), siret],
+             ["idx_date_creation_siret ((date_creation,siret)<(?,?))", "idx_date_creation_siret (date_creation=?)"]),
+            ([('date_creation', True)], None,
+             ["idx_date_creation_siret (date_creation>?)", "idx_date_creation_siret (date_creation=?)"]),
+        ]
+        with engine.connect() as connection:
+            for sort_keys, values, expected in cases:
+                plans = []
+                for conditions, order_by in keyset_segments(Etablissement, keyset_keys(sort_keys), values):
+                    statement = select(Etablissement).where(*conditions).order_by(*order_by).limit(11)
+                    sql = str(statement.compile(engine, compile_kwargs={'literal_binds': True}))
+                    plans.append([row[-1] for row in connection.exec_driver_sql(f"EXPLAIN QUERY PLAN {sql}")])
+                # No OR of indexes nor sort of the rows, a single index search per segment
+                self.assertEqual(plans, [[f"SEARCH etablissement USING INDEX {plan}"] for plan in expected], sort_keys)
+        engine.dispose()
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,170 @@
+"""
+Tests the asynchronous (ASGI) serving mode against the routes of the Flask app.
+"""
+
+import datetime
+import os
+import tempfile
+import unittest
+
+from unittest import mock
+
+from flask import Flask
+
+from flask_app.api.routes import api_bp
+from flask_app.asgi import create_async_app
+from flask_app.db import db
+from flask_app.db.models import Etablissement
+from flask_app.db.routing import engine_options
+
+
+class TestAsyncAPI(unittest.IsolatedAsyncioTestCase):
+    """
+    Test cases for the async app, compared with the Flask app on the same SQLite file.
+    """
+
+    def setUp(self):
+        """
+        Set up the Flask app and the async app on a database of a few Etablissements.
+        """
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        url = "sqlite:///" + os.path.join(self.tmp_dir.name, 'test.db')
+
+        self.app = Flask(__name__)
+        self.app.config["SQLALCHEMY_DATABASE_URI"] = url
+        self.app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+        self.app.config["TESTING"] = True
+        self.app.config["LIST_CACHE_SIZE"] = 0
+        self.app.config["DETAIL_CACHE_SIZE"] = 0
+        db.init_app(self.app)
+        self.app.register_blueprint(api_bp, url_prefix="/api")
+        self.client = self.app.test_client()
+
+        with self.app.app_context():
+            db.create_all()
+            for index in range(5):
+                db.session.add(Etablissement(siren=f"10000000{index}", nic="00010", siret=f"10000000{index}00010",
+                                             code_postal=f"7500{index % 2}", date_creation=datetime.date(2020, 1, index + 1)))
+            db.session.commit()
+
+        self.async_app = create_async_app(initialize=False, flask_app=self.app)
+        self.async_app.config["SQLALCHEMY_DATABASE_URI"] = url
+        self.async_app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(url, 5, 0, 5, -1, True, asynchronous=True)
+        self.async_app.config["TESTING"] = True
+
+    async def asyncSetUp(self):
+        """
+        Start the async app, which opens its asyncio engine.
+        """
+        self.test_app = self.async_app.test_app()
+        await self.test_app.startup()
+        self.async_client = self.test_app.test_client()
+
+    async def asyncTearDown(self):
+        """
+        Stop the async app.
+        """
+        await self.test_app.shutdown()
+
+    def tearDown(self):
+        """
+        Tear down the database after each test.
+        """
+        with self.app.app_context():
+            db.session.remove()
+            db.engine.dispose()
+        self.tmp_dir.cleanup()
+
+    async def assert_same_response(self, method: str, path: str, **kwargs):
+        """
+        Checks that the async app answers a request like the Flask app.
+        :param method: the HTTP method of the request.
+        :param path: the path of the request, with its query string.
+        :param kwargs: the body of the request.
+        """
+        expected = self.client.open(path, method=method, **kwargs)
+        response = await self.async_client.open(path, method=method, **kwargs)
+        self.assertEqual(response.status_code, expected.status_code, path)
+        if expected.is_json:
+            self.assertEqual(await response.get_json(), expected.get_json(), path)
+        return response
+
+    async def test_read_routes_match_flask(self):
+        """
+        Test that the list, detail and lookup routes answer like those of the Flask app, errors included.
+        """
+        for path in ('/api/etablissements', '/api/etablissements?page=2&per_page=2&sort=-siret',
+                     '/api/etablissements?code_postal=75001&fields=siret,date_creation&count=estimate',
+                     '/api/etablissements?date_creation__gte=2020-01-03&cursor=&per_page=2&count=exact',
+                     '/api/etablissements?page=0&per_page=0', '/api/etablissements?count=wrong',
+                     '/api/etablissements?unknown=1', '/api/etablissements?cursor=bad',
+                     '/api/etablissements/10000000100010', '/api/etablissements/10000000200010?fields=siren',
+                     '/api/etablissements/99999999999999'):
+            await self.assert_same_response('GET', path)
+
+        await self.assert_same_response('POST', '/api/etablissements/lookup',
+                                        json={'sirets': ["10000000100010", "99999999999999"], 'sirens': ["100000003"]})
+        await self.assert_same_response('POST', '/api/etablissements/lookup', json={'sirets': "10000000100010"})
+
+    async def test_list_etag(self):
+        """
+        Test that a list response matching the If-None-Match header becomes a 304 response.
+        """
+        response = await self.async_client.get('/api/etablissements')
+        etag = response.headers['ETag']
+        response = await self.async_client.get('/api/etablissements', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+
+    async def test_write_routes(self):
+        """
+        Test that the async app creates, updates and deletes Etablissements like the Flask app.
+        """
+        record = {'siret': "20000000000010", 'siren': "200000000", 'nic': "00010", 'date_creation': "2021-05-01"}
+        response = await self.async_client.post('/api/etablissements', json=record)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual((await response.get_json())['date_creation'], "Sat, 01 May 2021 00:00:00 GMT")
+        await self.assert_same_response('POST', '/api/etablissements', json=record)
+
+        await self.assert_same_response('PUT', '/api/etablissements/20000000000010', json={'code_postal': "69001"})
+        await self.assert_same_response('PUT', '/api/etablissements/20000000000010', json={'siren': "1"})
+        await self.assert_same_response('PUT', '/api/etablissements/20000000000010', data="code_postal=69001")
+
+        response = await self.async_client.delete('/api/etablissements/20000000000010')
+        self.assertEqual(await response.get_json(), {"message": "Etablissement deleted"})
+        await self.assert_same_response('DELETE', '/api/etablissements/20000000000010')
+
+    async def test_flask_routes(self):
+        """
+        Test that the routes not ported to the async app are served by the Flask app, and the others by the async app.
+        """
+        export = await self.assert_same_response('GET', '/api/etablissements/export?code_postal=75001')
+        self.assertEqual(export.mimetype, 'application/x-ndjson')
+        self.assertEqual(len((await export.get_data(as_text=True)).splitlines()), 2)
+        await self.assert_same_response('GET', '/api/etablissements/search?q=ab')
+        await self.assert_same_response('GET', '/api/hello')
+
+        response = await self.async_client.post('/api/etablissements/bulk?mode=upsert', json=[
+            {'siret': "20000000000010", 'siren': "200000000", 'nic': "00010"},
+            {'siret': "10000000100010", 'siren': "100000001", 'nic': "00010", 'code_postal': "69001"}])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([item['status'] for item in (await response.get_json())['items']], ['inserted', 'updated'])
+        self.assertEqual(self.client.get('/api/etablissements/10000000100010').json['code_postal'], "69001")
+
+        with mock.patch('flask_app.asgi.AsyncioWSGIMiddleware.__call__') as wsgi:
+            await self.assert_same_response('GET', '/api/etablissements/10000000100010')
+            await self.assert_same_response('POST', '/api/etablissements/lookup', json={'sirets': ["10000000100010"]})
+        wsgi.assert_not_called()
+
+    async def test_concurrency_limit(self):
+        """
+        Test that the requests beyond the concurrency limit are rejected with a 503 status.
+        """
+        await self.test_app.shutdown()
+        self.async_app.config["ASYNC_MAX_CONCURRENCY"] = 0
+        await self.asyncSetUp()
+        response = await self.async_client.get('/api/etablissements')
+        self.assertEqual(response.status_code, 503)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,130 @@
+"""
+Tests the audit log storage.
+"""
+
+import datetime
+import unittest
+
+from flask import Flask
+
+from sqlalchemy import create_engine, insert, inspect, text
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.schema import CreateTable
+
+from flask_app.db.audit_storage import add_months, maintain_audit_log, select_audit_entries
+from flask_app.db.models import AuditLog, db
+
+
+class TestAuditStorage(unittest.TestCase):
+    """
+    Test cases for the monthly storage of the audit log.
+    """
+
+    def setUp(self):
+        """
+        Set up a Flask app and a database with audit entries over several months.
+        """
+        self.app = Flask(__name__)
+        self.app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///:memory:"
+        self.app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+        self.app.config["TESTING"] = True
+        db.init_app(self.app)
+
+        with self.app.app_context():
+            db.create_all()
+            db.session.execute(insert(AuditLog.__table__), [
+                {'table_name': 'etablissement', 'operation': 'INSERT', 'record_id': f"1000000000000{month}",
+                 'row_data': {'month': month}, 'timestamp': datetime.datetime(2024, month, 15, 12)}
+                for month in (1, 2, 2, 4)
+            ])
+            db.session.commit()
+
+    def tearDown(self):
+        """
+        Tear down the database.
+        """
+        with self.app.app_context():
+            db.session.remove()
+            db.drop_all()
+
+    def test_add_months(self):
+        """
+        Test the month arithmetic of the partitions.
+        """
+        self.assertEqual(add_months(datetime.date(2024, 11, 1), 3), datetime.date(2025, 2, 1))
+        self.assertEqual(add_months(datetime.date(2024, 1, 1), -1), datetime.date(2023, 12, 1))
+
+    def test_postgresql_partitioned_table(self):
+        """
+        Test that audit_log is created as a table partitioned by timestamp on PostgreSQL.
+        """
+        ddl = str(CreateTable(AuditLog.__table__).compile(dialect=postgresql.dialect()))
+        self.assertIn("PRIMARY KEY (id, timestamp)", ddl)
+        self.assertIn("PARTITION BY RANGE (timestamp)", ddl)
+
+    def test_rollover_and_retention(self):
+        """
+        Test that past months are moved to archive tables, still queried, and dropped after the retention period.
+        """
+        with self.app.app_context():
+            with db.engine.begin() as connection:
+                changes = maintain_audit_log(connection, retention_months=0, today=datetime.date(2024, 4, 20))
+            self.assertEqual(changes['archived'], ['audit_log_2024_01', 'audit_log_2024_02'])
+            self.assertEqual(db.session.query(AuditLog).count(), 1)
+
+            connection = db.session.connection()
+            rows = connection.execute(select_audit_entries(connection, {})).mappings().all()
+            self.assertEqual([row['row_data']['month'] for row in rows], [4, 2, 2, 1])
+            rows = connection.execute(select_audit_entries(
+                connection, {'record_id': "10000000000002"}, since=datetime.datetime(2024, 2, 1),
+                until=datetime.datetime(2024, 3, 1)
+            )).all()
+            self.assertEqual(len(rows), 2)
+            db.session.commit()
+
+            with db.engine.begin() as connection:
+                changes = maintain_audit_log(connection, retention_months=3, today=datetime.date(2024, 4, 20))
+            self.assertEqual(changes['dropped'], ['audit_log_2024_01'])
+            self.assertNotIn('audit_log_2024_01', inspect(db.engine).get_table_names())
+
+
+class TestAuditUpgrade(unittest.TestCase):
+    def test_baseline_audit_log(self):
+        """
+        Test that an audit_log table created before record_id and its indexes is upgraded in place.
+        """
+        engine = create_engine("sqlite://")
+        with engine.begin() as connection:
+            # The audit_log table of the first version of the model
+            connection.execute(text(
+                "CREATE TABLE audit_log (id INTEGER NOT NULL, table_name VARCHAR(255) NOT NULL, "
+                "operation VARCHAR(10) NOT NULL, timestamp DATETIME NOT NULL, row_data JSON NOT NULL, PRIMARY KEY (id))"
+            ))
+            connection.execute(text(
+                "INSERT INTO audit_log (table_name, operation, timestamp, row_data) VALUES "
+                "('etablissement', 'UPDATE', '2024-04-02 10:00:00.000000', '{\"siret\": \"12345678900012\"}')"
+            ))
+
+        with engine.begin() as connection:
+            changes = maintain_audit_log(connection, retention_months=0, today=datetime.date(2024, 4, 20))
+        self.assertEqual(changes['upgraded'], ['audit_log'])
+        inspector = inspect(engine)
+        self.assertIn('record_id', {column['name'] for column in inspector.get_columns('audit_log')})
+        self.assertEqual({index['name'] for index in inspector.get_indexes('audit_log')},
+                         {index.name for index in AuditLog.__table__.indexes})
+
+        with engine.begin() as connection:
+            connection.execute(insert(AuditLog.__table__), [
+                {'table_name': 'etablissement', 'operation': 'DELETE', 'record_id': "12345678900012",
+                 'row_data': {'siret': "12345678900012"}, 'timestamp': datetime.datetime(2024, 4, 3)}
+            ])
+            rows = connection.execute(select_audit_entries(connection, {'record_id': "12345678900012"})).all()
+            self.assertEqual([row.operation for row in rows], ['DELETE', 'UPDATE'])
+            # Already upgraded
+            self.assertEqual(maintain_audit_log(connection, retention_months=0, today=datetime.date(2024, 4, 20)),
+                             {'upgraded': [], 'created': [], 'archived': [], 'dropped': []})
+        engine.dispose()
+
+
+if __name__ == '__main__':
+    unittest.main()
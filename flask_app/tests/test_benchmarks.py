@@ -0,0 +1,102 @@
+"""
+Tests the synthetic data generator and the helpers of the benchmarks.
+"""
+
+import csv
+import os
+import tempfile
+import unittest
+
+from benchmarks.bench_api import SCENARIOS, api_endpoints
+from benchmarks.common import percentile
+from benchmarks.generate import CSV_HEADER, generate_csv, generate_records, luhn_digit, parse_size
+from flask_app.db.parsers import CSV_FIELDS, make_row_converter
+
+
+def luhn_valid(number: str) -> bool:
+    """
+    Checks the Luhn key of a SIREN or SIRET.
+    :param number: the digits, the last one being the key.
+    :return: True if the key is valid.
+    """
+    return luhn_digit(number[:-1]) == number[-1]
+
+
+class TestGenerator(unittest.TestCase):
+    def test_deterministic(self):
+        """
+        Tests that the same rows and seed give the same records, and another seed other records.
+        """
+        self.assertEqual(list(generate_records(500, 1)), list(generate_records(500, 1)))
+        self.assertNotEqual(list(generate_records(500, 1)), list(generate_records(500, 2)))
+
+    def test_identifiers(self):
+        """
+        Tests that the identifiers are unique, well formed and have valid Luhn keys.
+        """
+        records = list(generate_records(2000, 3))
+        self.assertEqual(len(records), 2000)
+        self.assertEqual(len({record['siret'] for record in records}), 2000)
+        for record in records:
+            self.assertEqual(record['siret'], record['siren'] + record['nic'])
+            self.assertRegex(record['siret'], r'^\d{14}$')
+            self.assertTrue(luhn_valid(record['siren']), record['siren'])
+            self.assertTrue(luhn_valid(record['siret']), record['siret'])
+            self.assertRegex(record['codePostalEtablissement'], r'^\d{5}$')
+
+    def test_distributions(self):
+        """
+        Tests that the values are skewed and nullable like in the real stock.
+        """
+        records = list(generate_records(5000, 4))
+        empty_dates = sum(not record['dateCreationEtablissement'] for record in records)
+        self.assertTrue(0 < empty_dates < 500)
+        nafs = [record['activitePrincipaleEtablissement'] for record in records]
+        self.assertGreater(nafs.count(max(set(nafs), key=nafs.count)), 5 * nafs.count(min(set(nafs), key=nafs.count)))
+        self.assertGreater(len({record['codePostalEtablissement'] for record in records}), 100)
+
+    def test_csv_parsed_by_the_loader(self):
+        """
+        Tests that a generated file has the header of StockEtablissement.csv and is converted by the loader.
+        """
+        path = os.path.join(tempfile.mkdtemp(), 'stock.csv')
+        stats = generate_csv(path, 100, 5)
+        self.assertEqual(stats['rows'], 100)
+        with open(path, encoding='utf-8', newline='') as file:
+            reader = csv.reader(file)
+            header = next(reader)
+            self.assertEqual(header, CSV_HEADER)
+            convert = make_row_converter(header)
+            rows = [dict(zip(CSV_FIELDS, convert(record))) for record in reader]
+        self.assertEqual(len(rows), 100)
+        self.assertTrue(all(row['siret'] and row['date_dernier_traitement'] for row in rows))
+
+    def test_parse_size(self):
+        """
+        Tests the named and numeric sizes.
+        """
+        self.assertEqual(parse_size('10k'), 10_000)
+        self.assertEqual(parse_size('10M'), 10_000_000)
+        self.assertEqual(parse_size('2500'), 2500)
+
+
+class TestBenchmarkHelpers(unittest.TestCase):
+    def test_percentile(self):
+        """
+        Tests the nearest-rank percentiles.
+        """
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 0.50), 50)
+        self.assertEqual(percentile(values, 0.99), 99)
+        self.assertEqual(percentile([7], 0.95), 7)
+        self.assertIsNone(percentile([], 0.5))
+
+    def test_every_route_has_a_scenario(self):
+        """
+        Tests that each route of api_bp is benchmarked.
+        """
+        self.assertEqual(sorted(SCENARIOS), api_endpoints())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+"""
+Tests the incremental synchronization of SIRENE updates.
+"""
+
+import csv
+import datetime
+import os
+import tempfile
+import unittest
+
+from flask import Flask
+
+from flask_app.db.delta_sync import sync_csv
+from flask_app.db.ingest import bulk_load_csv
+from flask_app.db.models import Etablissement, db
+from flask_app.tests.test_ingest import CSV_HEADER, make_csv_record, write_csv
+
+
+class TestDeltaSync(unittest.TestCase):
+    """
+    Test cases for the delta sync of a new stock file.
+    """
+
+    def setUp(self):
+        """
+        Set up a Flask app and a database loaded from a first stock file.
+        """
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        stock_path = os.path.join(self.tmp_dir.name, 'StockEtablissement.csv')
+        write_csv(stock_path, 10)
+
+        self.app = Flask(__name__)
+        self.app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///:memory:"
+        self.app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+        self.app.config["TESTING"] = True
+        db.init_app(self.app)
+
+        with self.app.app_context():
+            db.create_all()
+            bulk_load_csv(stock_path)
+
+    def tearDown(self):
+        """
+        Tear down the database and the CSV files.
+        """
+        with self.app.app_context():
+            db.session.remove()
+            db.drop_all()
+        self.tmp_dir.cleanup()
+
+    def test_sync_csv(self):
+        """
+        Test that only new, changed and closed establishments are written.
+        """
+        records = [make_csv_record(index) for index in range(12)]
+        newer = '2024-04-01T08:00:00'
+        # Updated with a newer date
+        records[1].update({'dateDernierTraitementEtablissement': newer, 'libelleVoieEtablissement': 'RUE NEUVE'})
+        # Closed with a newer date
+        records[2].update({'dateDernierTraitementEtablissement': newer, 'etatAdministratifEtablissement': 'F'})
+        # Only the date changed
+        records[3].update({'dateDernierTraitementEtablissement': newer})
+        # Changed content with an older date is ignored
+        records[4].update({'dateDernierTraitementEtablissement': '2020-01-01T00:00:00',
+                           'libelleVoieEtablissement': 'RUE ANCIENNE'})
+        # Several versions of the same establishment in one file, the latest wins
+        later = dict(records[5], dateDernierTraitementEtablissement=newer, libelleVoieEtablissement='RUE DERNIERE')
+        records.append(later)
+
+        update_path = os.path.join(self.tmp_dir.name, 'update.csv')
+        with open(update_path, 'w', encoding='utf-8', newline='') as file:
+            writer = csv.DictWriter(file, fieldnames=CSV_HEADER)
+            writer.writeheader()
+            writer.writerows(records)
+
+        with self.app.app_context():
+            stats = sync_csv(update_path, batch_size=5)
+            self.assertEqual(stats['rows'], 13)
+            self.assertEqual(stats['inserted'], 2)
+            self.assertEqual(stats['updated'], 4)
+            self.assertEqual(stats['closed'], 1)
+            self.assertEqual(stats['unchanged'], 7)
+
+            self.assertEqual(db.session.query(Etablissement).count(), 12)
+            self.assertEqual(db.session.get(Etablissement, '10000000100001').libelle_voie, 'RUE NEUVE')
+            self.assertEqual(db.session.get(Etablissement, '10000000200002').etat_administratif, 'F')
+            self.assertEqual(db.session.get(Etablissement, '10000000300003').date_dernier_traitement,
+                             datetime.datetime(2024, 4, 1, 8, 0, 0))
+            self.assertNotEqual(db.session.get(Etablissement, '10000000400004').libelle_voie, 'RUE ANCIENNE')
+            self.assertEqual(db.session.get(Etablissement, '10000000500005').libelle_voie, 'RUE DERNIERE')
+
+            # A second sync of the same file changes nothing
+            stats = sync_csv(update_path)
+            self.assertEqual(stats['inserted'] + stats['updated'], 0)
+            # In a single batch, the older version of the SIRET updated twice is superseded
+            self.assertEqual((stats['unchanged'], stats['superseded']), (12, 1))
+
+    def test_sync_stats(self):
+        """
+        Test that the older versions of a SIRET of a batch are counted apart, and the new closed establishments
+        as closures.
+        """
+        records = [make_csv_record(index) for index in range(11)]
+        records.insert(1, dict(records[1]))
+        records[2].update({'dateDernierTraitementEtablissement': '2024-04-01T08:00:00',
+                           'libelleVoieEtablissement': 'RUE NEUVE'})
+        records[-1].update({'etatAdministratifEtablissement': 'F'})
+
+        update_path = os.path.join(self.tmp_dir.name, 'update.csv')
+        with open(update_path, 'w', encoding='utf-8', newline='') as file:
+            writer = csv.DictWriter(file, fieldnames=CSV_HEADER)
+            writer.writeheader()
+            writer.writerows(records)
+
+        with self.app.app_context():
+            stats = sync_csv(update_path)
+        self.assertEqual({key: stats[key] for key in ('rows', 'inserted', 'updated', 'closed', 'unchanged',
+                                                      'superseded')},
+                         {'rows': 12, 'inserted': 1, 'updated': 1, 'closed': 1, 'unchanged': 9, 'superseded': 1})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,264 @@
+"""
+Tests the bulk ingest engine.
+"""
+
+import csv
+import datetime
+import os
+import tempfile
+import unittest
+
+from unittest import mock
+
+from flask import Flask
+
+from sqlalchemy import create_engine, select
+
+from flask_app.db import ingest
+from flask_app.db.checkpoints import file_identity, load_checkpoints
+from flask_app.db.ingest import COPY_FORMATTERS, bulk_load_csv, copy_rows, parallel_load_csv, read_header, \
+    split_byte_ranges
+from flask_app.db.models import AuditLog, Etablissement, db
+from flask_app.db.parsers import CSV_COLUMNS, CSV_FIELDS, make_row_converter
+
+CSV_HEADER = [csv_name for _, csv_name, _ in CSV_COLUMNS]
+
+
+def make_csv_record(index: int) -> dict:
+    """
+    Builds a raw CSV record shaped like a line of StockEtablissement.csv.
+    :param index: the index of the record, used to derive unique identifiers.
+    :return: a dictionary of raw CSV values keyed by CSV column name.
+    """
+    siren = f"{100000000 + index:09d}"
+    nic = f"{index % 100000:05d}"
+    record = {name: '' for name in CSV_HEADER}
+    record.update({
+        'siren': siren,
+        'nic': nic,
+        'siret': siren + nic,
+        'statutDiffusionEtablissement': 'O',
+        'dateCreationEtablissement': '2001-02-03' if index % 3 else '',
+        'trancheEffectifsEtablissement': 'NN' if index % 4 == 0 else str(index % 50),
+        'dateDernierTraitementEtablissement': '2024-03-01T10:11:12',
+        'etablissementSiege': 'true' if index % 2 else 'false',
+        'numeroVoieEtablissement': str(index),
+        'libelleVoieEtablissement': f'RUE "{index}"\tBIS \\ A',
+        'codePostalEtablissement': f"{75000 + index % 20:05d}",
+        'complementAdresseEtablissement': 'BATIMENT A\nESCALIER "B"' if index % 7 == 3 else '',
+        'libelleCommuneEtablissement': 'PARIS',
+        'etatAdministratifEtablissement': 'A',
+        'activitePrincipaleEtablissement': '47.11Z',
+    })
+    return record
+
+
+def write_csv(path: str, count: int) -> None:
+    """
+    Writes a StockEtablissement-like CSV file.
+    :param path: the path of the file to write.
+    :param count: the number of records to write.
+    :return: None
+    """
+    with open(path, 'w', encoding='utf-8', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=CSV_HEADER)
+        writer.writeheader()
+        for index in range(count):
+            writer.writerow(make_csv_record(index))
+
+
+class TestBulkIngest(unittest.TestCase):
+    """
+    Test cases for the bulk ingest engine.
+    """
+
+    def setUp(self):
+        """
+        Set up a Flask app, an empty database and a CSV file.
+        """
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.csv_path = os.path.join(self.tmp_dir.name, 'StockEtablissement.csv')
+        write_csv(self.csv_path, 25)
+
+        self.app = Flask(__name__)
+        self.app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///:memory:"
+        self.app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+        self.app.config["TESTING"] = True
+        db.init_app(self.app)
+
+        with self.app.app_context():
+            db.create_all()
+
+    def tearDown(self):
+        """
+        Tear down the database and the CSV file.
+        """
+        with self.app.app_context():
+            db.session.remove()
+            db.drop_all()
+        self.tmp_dir.cleanup()
+
+    def test_bulk_load_csv(self):
+        """
+        Test that the bulk loader loads every row with the parse_* semantics.
+        """
+        with self.app.app_context():
+            stats = bulk_load_csv(self.csv_path, batch_size=10)
+            self.assertEqual(stats['rows'], 25)
+            self.assertEqual(db.session.query(Etablissement).count(), 25)
+
+            etablissement = db.session.get(Etablissement, '10000000000000')
+            self.assertIsNone(etablissement.date_creation)
+            self.assertIsNone(etablissement.tranche_effectifs)
+            self.assertFalse(etablissement.etablissement_siege)
+            self.assertEqual(etablissement.libelle_voie, 'RUE "0"\tBIS \\ A')
+            self.assertEqual(etablissement.complement_adresse, '')
+            self.assertEqual(etablissement.date_dernier_traitement, datetime.datetime(2024, 3, 1, 10, 11, 12))
+
+            etablissement = db.session.get(Etablissement, '10000000500005')
+            self.assertEqual(etablissement.date_creation, datetime.date(2001, 2, 3))
+            self.assertEqual(etablissement.tranche_effectifs, 5)
+            self.assertTrue(etablissement.etablissement_siege)
+
+    def test_ingest_audit_modes(self):
+        """
+        Test that the ingest writes one audit entry per batch, one per row, or none.
+        """
+        with self.app.app_context():
+            bulk_load_csv(self.csv_path, batch_size=10)
+            entries = db.session.query(AuditLog).order_by(AuditLog.id).all()
+            self.assertEqual([(entry.operation, entry.row_data['rows']) for entry in entries],
+                             [('INGEST', 10), ('INGEST', 10), ('INGEST', 5)])
+            self.assertEqual(entries[1].row_data['byte_start'], entries[0].row_data['byte_end'])
+
+        for mode, count in (('row', 25), ('off', 0)):
+            with self.app.app_context():
+                db.drop_all()
+                db.create_all()
+                bulk_load_csv(self.csv_path, batch_size=10, audit_mode=mode)
+                self.assertEqual(db.session.query(AuditLog).count(), count)
+
+    def test_copy_rows(self):
+        """
+        Test the text format sent to PostgreSQL COPY.
+        """
+        class FakeCursor:
+            """
+            Cursor recording the data sent through copy_expert.
+            """
+            def __init__(self):
+                self.sql = None
+                self.data = None
+
+            def copy_expert(self, sql, file):
+                self.sql = sql
+                self.data = file.read()
+
+            def close(self):
+                pass
+
+        class FakeConnection:
+            """
+            Connection exposing the fake cursor like a pooled DBAPI connection.
+            """
+            def __init__(self):
+                self.fake_cursor = FakeCursor()
+                self.connection = self
+
+            def cursor(self):
+                return self.fake_cursor
+
+        convert = make_row_converter(CSV_HEADER)
+        row = convert([make_csv_record(0)[name] for name in CSV_HEADER])
+        connection = FakeConnection()
+        copy_rows(connection, [row])
+
+        values = dict(zip(CSV_FIELDS, connection.fake_cursor.data.rstrip('\n').split('\t')))
+        self.assertEqual(len(COPY_FORMATTERS), len(CSV_FIELDS))
+        self.assertTrue(connection.fake_cursor.sql.startswith('COPY etablissement (siren, nic, siret'))
+        self.assertEqual(values['date_creation'], '\\N')
+        self.assertEqual(values['tranche_effectifs'], '\\N')
+        self.assertEqual(values['etablissement_siege'], 'f')
+        self.assertEqual(values['complement_adresse'], '')
+        self.assertEqual(values['date_dernier_traitement'], '2024-03-01T10:11:12')
+        self.assertEqual(values['libelle_voie'], 'RUE "0"\\tBIS \\\\ A')
+
+    def test_split_byte_ranges(self):
+        """
+        Test that byte ranges cover the whole file and never cut a quoted value spanning several lines.
+        """
+        header, data_start = read_header(self.csv_path)
+        self.assertEqual(header[:3], ['siren', 'nic', 'siret'])
+
+        ranges = split_byte_ranges(self.csv_path, data_start, chunk_size=200)
+        self.assertGreater(len(ranges), 5)
+        self.assertEqual(ranges[0][0], data_start)
+        self.assertEqual(ranges[-1][1], os.path.getsize(self.csv_path))
+        for (_, previous_end), (next_start, _) in zip(ranges, ranges[1:]):
+            self.assertEqual(previous_end, next_start)
+
+        with open(self.csv_path, 'rb') as file:
+            content = file.read()
+        for start, end in ranges:
+            records = list(csv.reader(content[start:end].decode('utf-8').splitlines(keepends=True)))
+            self.assertTrue(all(len(record) == len(CSV_HEADER) for record in records))
+
+    def test_parallel_load_csv(self):
+        """
+        Test that a parallel load gives exactly the same table as a single-process load.
+        """
+        write_csv(self.csv_path, 300)
+        table = Etablissement.__table__
+        contents = []
+        for name, loader in (('single', bulk_load_csv), ('parallel', None)):
+            engine = create_engine(f"sqlite:///{os.path.join(self.tmp_dir.name, name + '.db')}")
+            db.metadata.create_all(engine)
+            if loader is None:
+                stats = parallel_load_csv(self.csv_path, workers=2, chunk_size=4096, batch_size=50, engine=engine)
+            else:
+                stats = loader(self.csv_path, batch_size=50, engine=engine)
+            self.assertEqual(stats['rows'], 300)
+            with engine.connect() as connection:
+                contents.append(connection.execute(select(table).order_by(table.c.siret)).all())
+            engine.dispose()
+
+        self.assertEqual(len(contents[0]), 300)
+        self.assertEqual(contents[0], contents[1])
+
+    def test_resume_interrupted_load(self):
+        """
+        Test that a load interrupted by a crash resumes from its checkpoint without duplicates.
+        """
+        write_rows = ingest.write_rows
+        calls = []
+
+        def crashing_write_rows(connection, rows):
+            calls.append(len(rows))
+            if len(calls) == 3:
+                raise RuntimeError("Simulated crash")
+            write_rows(connection, rows)
+
+        with self.app.app_context():
+            with mock.patch.object(ingest, 'write_rows', crashing_write_rows):
+                with self.assertRaises(RuntimeError):
+                    bulk_load_csv(self.csv_path, batch_size=10)
+            self.assertEqual(db.session.query(Etablissement).count(), 20)
+
+            checkpoint, = load_checkpoints(db.session.connection(), file_identity(self.csv_path))
+            self.assertFalse(checkpoint['completed'])
+            self.assertEqual(checkpoint['rows_loaded'], 20)
+            self.assertEqual(checkpoint['line_number'], 1 + 20 + 3)  # header and three multi-line records
+            db.session.commit()
+
+            stats = bulk_load_csv(self.csv_path, batch_size=10)
+            self.assertEqual(stats['rows'], 5)
+            self.assertEqual(db.session.query(Etablissement).count(), 25)
+
+            checkpoint, = load_checkpoints(db.session.connection(), file_identity(self.csv_path))
+            self.assertTrue(checkpoint['completed'])
+            self.assertEqual(checkpoint['rows_loaded'], 25)
+            self.assertEqual(checkpoint['byte_offset'], os.path.getsize(self.csv_path))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,184 @@
+"""
+Tests the single-process initialization of the database.
+"""
+
+import contextlib
+import io
+import os
+import tempfile
+import unittest
+
+from unittest import mock
+
+from flask import Flask
+from sqlalchemy import inspect
+
+from flask_app.api.routes import api_bp
+from flask_app.db import db
+from flask_app.db.checkpoints import advance_checkpoint, create_checkpoints, file_identity
+from flask_app.db.init_db import initialize_database, run_ingest
+from flask_app.db.init_lock import file_lock
+from flask_app.db.models import Etablissement
+from flask_app.tests.test_ingest import write_csv
+
+
+class TestInitializeDatabase(unittest.TestCase):
+    """
+    Test cases for the initialization lock and the ingest at startup.
+    """
+
+    def setUp(self):
+        """
+        Set up a Flask app with an empty database and its own lock file.
+        """
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.lock_file = os.path.join(self.tmp_dir.name, 'init.lock')
+        self.csv_path = os.path.join(self.tmp_dir.name, 'StockEtablissement.csv')
+        write_csv(self.csv_path, 25)
+        self.app = Flask(__name__)
+        self.app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + os.path.join(self.tmp_dir.name, 'test.db')
+        self.app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+        self.app.config["INIT_LOCK_FILE"] = self.lock_file
+        self.app.config["INGEST_LOCK_FILE"] = os.path.join(self.tmp_dir.name, 'ingest.lock')
+        self.app.config["INGEST_CSV_PATH"] = self.csv_path
+        self.app.config["INGEST_ON_STARTUP"] = 'off'
+        db.init_app(self.app)
+        self.app.register_blueprint(api_bp, url_prefix="/api")
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        """
+        Remove the database and the lock file.
+        """
+        with self.app.app_context():
+            db.session.remove()
+            db.engine.dispose()
+        self.tmp_dir.cleanup()
+
+    def test_file_lock(self):
+        """
+        Test that only one holder gets the lock file at a time.
+        """
+        with file_lock(self.lock_file) as first:
+            with file_lock(self.lock_file) as second:
+                self.assertTrue(first)
+                self.assertFalse(second)
+        with file_lock(self.lock_file) as again:
+            self.assertTrue(again)
+
+    def test_initialization_skipped_while_locked(self):
+        """
+        Test that a process skips the initialization while another one runs it.
+        """
+        output = io.StringIO()
+        with self.app.app_context():
+            with file_lock(self.lock_file), contextlib.redirect_stdout(output):
+                initialize_database()
+            self.assertIn("initialized by another process", output.getvalue())
+            self.assertNotIn('etablissement', inspect(db.engine).get_table_names())
+
+            with contextlib.redirect_stdout(io.StringIO()):
+                initialize_database()
+            self.assertIn('etablissement', inspect(db.engine).get_table_names())
+
+    def test_ingest_on_startup_sync(self):
+        """
+        Test that the sync mode loads the CSV file before serving.
+        """
+        self.app.config["INGEST_ON_STARTUP"] = 'sync'
+        with self.app.app_context(), contextlib.redirect_stdout(io.StringIO()):
+            initialize_database()
+            self.assertEqual(db.session.query(Etablissement).count(), 25)
+
+        response = self.client.get('/api/ready')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json['ingest']['state'], 'completed')
+        self.assertEqual(response.json['ingest']['rows_loaded'], 25)
+
+    def test_ingest_on_startup_background(self):
+        """
+        Test that the background mode starts the load in a separate process, which does not start another one.
+        """
+        self.app.config["INGEST_ON_STARTUP"] = 'background'
+        with self.app.app_context(), contextlib.redirect_stdout(io.StringIO()), \
+                mock.patch('flask_app.db.init_db.subprocess.Popen') as popen:
+            initialize_database()
+        command = popen.call_args.args[0]
+        self.assertEqual(command[-2:], ['ingest', 'load'])
+        self.assertEqual(popen.call_args.kwargs['env']['INGEST_ON_STARTUP'], 'off')
+
+    def test_ready_and_ingest_status(self):
+        """
+        Test the readiness and the progress reported while the CSV file is not loaded yet.
+        """
+        with self.app.app_context(), contextlib.redirect_stdout(io.StringIO()):
+            initialize_database()
+        response = self.client.get('/api/ready')
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.json['ingest']['state'], 'pending')
+
+        # A load interrupted in the middle of its second byte range
+        size = os.path.getsize(self.csv_path)
+        with self.app.app_context():
+            with db.engine.begin() as connection:
+                checkpoints = create_checkpoints(connection, file_identity(self.csv_path),
+                                                 [(0, size // 2), (size // 2, size)], 0)
+                advance_checkpoint(connection, checkpoints[0]['id'], size // 2, 12, 12, completed=True)
+
+        with mock.patch('flask_app.api.ingest_status.time.monotonic', side_effect=[100.0, 110.0]):
+            response = self.client.get('/api/ingest/status')
+            self.assertEqual(response.json['state'], 'loading')
+            self.assertEqual(response.json['ranges_completed'], 1)
+            self.assertIsNone(response.json['eta_seconds'])
+
+            with self.app.app_context(), db.engine.begin() as connection:
+                advance_checkpoint(connection, checkpoints[1]['id'], size // 2 + (size - size // 2) // 2, 6, 6)
+            response = self.client.get('/api/ingest/status')
+            self.assertEqual(response.json['rows_loaded'], 18)
+            self.assertEqual(response.json['rows_per_second'], 0.6)
+            self.assertAlmostEqual(response.json['eta_seconds'], 10, delta=0.2)
+        self.assertEqual(self.client.get('/api/ready').status_code, 503)
+
+        # The load resumes from the checkpoints
+        with self.app.app_context(), contextlib.redirect_stdout(io.StringIO()):
+            self.assertTrue(run_ingest())
+        response = self.client.get('/api/ready')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.json['ready'])
+
+    def test_ready_without_checkpoints(self):
+        """
+        Test that without the CSV file or its checkpoints, the API is ready only if the table was loaded
+        by a finished ingest.
+        """
+        self.app.config["INGEST_CSV_PATH"] = os.path.join(self.tmp_dir.name, 'missing.csv')
+        with self.app.app_context(), contextlib.redirect_stdout(io.StringIO()):
+            initialize_database()
+        response = self.client.get('/api/ready')
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual((response.json['ingest']['state'], response.json['ingest']['table_loaded']),
+                         ('no_source', False))
+
+        # Rows of an unfinished load of another file
+        other_path = os.path.join(self.tmp_dir.name, 'other.csv')
+        write_csv(other_path, 10)
+        with self.app.app_context(), db.engine.begin() as connection:
+            checkpoints = create_checkpoints(connection, file_identity(other_path), [(0, 100)], 0)
+            advance_checkpoint(connection, checkpoints[0]['id'], 50, 5, 5)
+            connection.execute(Etablissement.__table__.insert(), [{'siret': "10000000000001", 'siren': "100000000",
+                                                                   'nic': "00001"}])
+        self.assertEqual(self.client.get('/api/ready').status_code, 503)
+        self.app.config["INGEST_CSV_PATH"] = self.csv_path
+        response = self.client.get('/api/ready')
+        self.assertEqual((response.status_code, response.json['ingest']['state']), (503, 'pending'))
+
+        with self.app.app_context(), db.engine.begin() as connection:
+            advance_checkpoint(connection, checkpoints[0]['id'], 100, 10, 10, completed=True)
+        response = self.client.get('/api/ready')
+        self.assertEqual((response.status_code, response.json['ingest']['state']), (200, 'completed'))
+        self.app.config["INGEST_CSV_PATH"] = os.path.join(self.tmp_dir.name, 'missing.csv')
+        self.assertEqual(self.client.get('/api/ready').status_code, 200)
+
+
+if __name__ == '__main__':
+    unittest.main()
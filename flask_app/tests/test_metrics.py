@@ -0,0 +1,112 @@
+"""
+Tests the request instrumentation and the /metrics endpoint.
+"""
+
+import contextlib
+import io
+import unittest
+
+from flask import Flask
+
+from flask_app.api.routes import api_bp
+from flask_app.db.models import Etablissement, db
+from flask_app.metrics import metrics_bp
+
+
+class TestMetrics(unittest.TestCase):
+    """
+    Test cases for the metrics.
+    """
+
+    def setUp(self):
+        """
+        Set up a Flask app instrumenting all the requests.
+        """
+        self.app = Flask(__name__)
+        self.app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///:memory:"
+        self.app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+        self.app.config["TESTING"] = True
+        self.app.config["METRICS_SAMPLE_RATE"] = 1.0
+        self.app.config["N_PLUS_ONE_THRESHOLD"] = 3
+        self.app.config["LOOKUP_BATCH_SIZE"] = 1
+        db.init_app(self.app)
+        self.app.register_blueprint(api_bp, url_prefix="/api")
+        self.app.register_blueprint(metrics_bp)
+        self.client = self.app.test_client()
+
+        with self.app.app_context():
+            db.create_all()
+            for index in range(3):
+                db.session.add(Etablissement(siren="123456789", nic=f"0000{index}", siret=f"1234567890000{index}"))
+            db.session.commit()
+
+    def tearDown(self):
+        """
+        Tear down the database after each test.
+        """
+        with self.app.app_context():
+            db.session.remove()
+            db.drop_all()
+
+    def metrics(self) -> dict[str, float]:
+        """
+        Reads the samples of the /metrics endpoint.
+        :return: the value of each sample, by name and labels.
+        """
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        samples = {}
+        for line in response.get_data(as_text=True).splitlines():
+            if line and not line.startswith('#'):
+                name, value = line.rsplit(' ', 1)
+                samples[name] = float(value)
+        return samples
+
+    def test_request_metrics(self):
+        """
+        Test the histograms of the instrumented requests.
+        """
+        self.client.get('/api/etablissements?per_page=2')
+        self.client.get('/api/etablissements?per_page=2')
+        self.client.get('/api/etablissements/12345678900000')
+
+        samples = self.metrics()
+        labels = '{route="/api/etablissements",method="GET"}'
+        self.assertEqual(samples[f'http_request_duration_seconds_count{labels}'], 2)
+        self.assertEqual(samples['http_request_duration_seconds_count'
+                                 '{route="/api/etablissements/<string:siret>",method="GET"}'], 1)
+        # The second list is served from the list cache, with the lookup of the table version as only query
+        self.assertEqual(samples[f'http_request_sql_queries_sum{labels}'], 4)
+        self.assertEqual(samples['http_request_sql_queries_bucket'
+                                 '{route="/api/etablissements",method="GET",le="1"}'], 1)
+        self.assertGreater(samples[f'http_request_sql_duration_seconds_sum{labels}'], 0)
+        self.assertGreater(samples[f'http_request_serialization_duration_seconds_sum{labels}'], 0)
+        self.assertEqual(samples['http_response_size_bytes_bucket{route="/api/etablissements",method="GET",le="+Inf"}'],
+                         2)
+        # The /metrics endpoint is not instrumented
+        self.assertNotIn('http_request_duration_seconds_count{route="/metrics",method="GET"}', samples)
+
+    def test_n_plus_one(self):
+        """
+        Test that requests executing the same statement repeatedly are flagged.
+        """
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            self.client.post('/api/etablissements/lookup',
+                             json={'sirets': ["12345678900000", "12345678900001", "12345678900002"]})
+        self.assertIn("Possible N+1 queries on POST /api/etablissements/lookup: executed 3 times", output.getvalue())
+
+        samples = self.metrics()
+        self.assertEqual(samples['http_requests_n_plus_one_total{route="/api/etablissements/lookup",method="POST"}'], 1)
+
+    def test_sampling_disabled(self):
+        """
+        Test that no request is instrumented when the sample rate is 0.
+        """
+        self.app.config["METRICS_SAMPLE_RATE"] = 0
+        self.client.get('/api/etablissements')
+        self.assertFalse(any(name.startswith('http_request_duration_seconds_count') for name in self.metrics()))
+
+
+if __name__ == '__main__':
+    unittest.main()
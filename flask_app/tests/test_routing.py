@@ -0,0 +1,172 @@
+"""
+Tests the routing of the reads to the read replicas and the instrumented connection pools.
+"""
+
+import contextlib
+import io
+import os
+import tempfile
+import unittest
+
+from unittest import mock
+
+from flask import Flask
+from sqlalchemy import create_engine, select
+
+from flask_app.api.routes import api_bp
+from flask_app.db import db
+from flask_app.db.models import Etablissement, IngestCheckpoint
+from flask_app.db.routing import engine_options, InstrumentedQueuePool, ReplicaRouter
+from flask_app.metrics import metrics_bp
+
+PRIMARY_SIRET = "11111111100001"
+REPLICA_SIRET = "22222222200002"
+
+
+class TestReplicaRouting(unittest.TestCase):
+    """
+    Test cases for the routing of the reads, with a primary and a replica in two SQLite files.
+    """
+
+    def setUp(self):
+        """
+        Set up a Flask app whose primary and replica hold different Etablissements, to tell which one served a read.
+        """
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        primary_url = "sqlite:///" + os.path.join(self.tmp_dir.name, 'primary.db')
+        replica_url = "sqlite:///" + os.path.join(self.tmp_dir.name, 'replica.db')
+        self.app = Flask(__name__)
+        self.app.config["SQLALCHEMY_DATABASE_URI"] = primary_url
+        self.app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(primary_url, 2, 1, 5, -1, True)
+        self.app.config["SQLALCHEMY_BINDS"] = {"replica_0": {"url": replica_url,
+                                                             **engine_options(replica_url, 2, 1, 5, -1, True)}}
+        self.app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+        self.app.config["TESTING"] = True
+        self.app.config["DETAIL_CACHE_SIZE"] = 0
+        self.app.config["LIST_CACHE_SIZE"] = 0
+        self.app.config["ADMIN_TOKEN"] = "secret"
+        db.init_app(self.app)
+        self.app.register_blueprint(api_bp, url_prefix="/api")
+        self.app.register_blueprint(metrics_bp)
+        self.client = self.app.test_client()
+
+        with self.app.app_context():
+            db.create_all()
+            db.metadata.create_all(db.engines["replica_0"])
+            db.session.add(Etablissement(siren="111111111", nic="00001", siret=PRIMARY_SIRET))
+            db.session.commit()
+            with db.engines["replica_0"].begin() as connection:
+                connection.execute(Etablissement.__table__.insert(),
+                                   {"siren": "222222222", "nic": "00002", "siret": REPLICA_SIRET})
+
+    def tearDown(self):
+        """
+        Tear down the databases after each test.
+        """
+        with self.app.app_context():
+            db.session.remove()
+            for engine in db.engines.values():
+                engine.dispose()
+        self.tmp_dir.cleanup()
+
+    def test_get_reads_from_replica(self):
+        """
+        Test that the GET requests and the lookups read from the replica.
+        """
+        self.assertEqual(self.client.get(f'/api/etablissements/{REPLICA_SIRET}').status_code, 200)
+        self.assertEqual(self.client.get(f'/api/etablissements/{PRIMARY_SIRET}').status_code, 404)
+
+        response = self.client.post('/api/etablissements/lookup', json={'sirets': [PRIMARY_SIRET, REPLICA_SIRET]})
+        self.assertEqual([item['siret'] for item in response.get_json()['items']], [REPLICA_SIRET])
+
+        stats = self.client.get('/api/admin/replicas', headers={'X-Admin-Token': 'secret'}).get_json()['replicas']
+        self.assertEqual(stats['healthy'], ['replica_0'])
+        self.assertEqual(stats['lags'], {'replica_0': 0.0})
+
+    def test_writes_go_to_primary(self):
+        """
+        Test that the writes, and the reads of the write requests, go to the primary.
+        """
+        response = self.client.post('/api/etablissements',
+                                    json={'siret': REPLICA_SIRET, 'siren': "222222222", 'nic': "00002"})
+        self.assertEqual(response.status_code, 201)
+
+        with self.app.app_context():
+            self.assertIsNotNone(db.session.get(Etablissement, REPLICA_SIRET))
+            with db.engines["replica_0"].connect() as connection:
+                rows = connection.execute(Etablissement.__table__.select()).all()
+            self.assertEqual([row.siret for row in rows], [REPLICA_SIRET])
+
+    def test_lagging_replica_falls_back_to_primary(self):
+        """
+        Test that the reads go to the primary when the replica lags beyond the maximum lag, or is unavailable.
+        """
+        self.app.config["REPLICA_CHECK_INTERVAL"] = 0
+        with mock.patch('flask_app.db.routing.replica_lag', return_value=60.0):
+            self.assertEqual(self.client.get(f'/api/etablissements/{PRIMARY_SIRET}').status_code, 200)
+
+        output = io.StringIO()
+        with mock.patch('flask_app.db.routing.replica_lag', side_effect=OSError("connection refused")), \
+                contextlib.redirect_stdout(output):
+            self.assertEqual(self.client.get(f'/api/etablissements/{PRIMARY_SIRET}').status_code, 200)
+        self.assertIn("Replica replica_0 unavailable", output.getvalue())
+
+        self.assertEqual(self.client.get(f'/api/etablissements/{REPLICA_SIRET}').status_code, 200)
+        stats = self.client.get('/api/admin/replicas', headers={'X-Admin-Token': 'secret'}).get_json()['replicas']
+        self.assertEqual(stats['primary_fallbacks'], 2)
+        self.assertEqual(stats['replica_reads'], 1)
+
+    def test_one_replica_per_session(self):
+        """
+        Test that the reads of a session stay on the replica chosen for them until it commits.
+        """
+        replicas = {'replica_0': create_engine("sqlite://"), 'replica_1': create_engine("sqlite://")}
+        statement = select(Etablissement.siret)
+        with self.app.test_request_context('/api/etablissements'):
+            self.app.extensions['replica_router'] = ReplicaRouter(replicas, max_lag=5, check_interval=60)
+            binds = [db.session.get_bind(clause=statement) for _ in range(3)]
+            self.assertEqual(binds, [replicas['replica_0']] * 3)
+            db.session.commit()
+            self.assertIs(db.session.get_bind(clause=statement), replicas['replica_1'])
+            db.session.remove()
+
+    def test_readiness_reads_from_primary(self):
+        """
+        Test that the readiness is read from the primary, the replica still holding an unfinished load.
+        """
+        self.app.config["INGEST_CSV_PATH"] = os.path.join(self.tmp_dir.name, 'missing.csv')
+        with self.app.app_context(), db.engines["replica_0"].begin() as connection:
+            connection.execute(IngestCheckpoint.__table__.insert(), {
+                'source_path': "StockEtablissement.csv", 'source_size': 100, 'source_mtime_ns': 0, 'range_start': 0,
+                'range_end': 100, 'byte_offset': 50, 'line_number': 5, 'rows_loaded': 5, 'completed': False})
+        self.assertEqual(self.client.get('/api/ready').status_code, 200)
+        self.assertEqual(self.client.get('/api/ingest/status').get_json()['table_loaded'], True)
+
+    def test_pool_checkout_wait_metrics(self):
+        """
+        Test that the pools are instrumented and that their checkout wait times are exposed at /metrics.
+        """
+        with self.app.app_context():
+            self.assertIsInstance(db.engine.pool, InstrumentedQueuePool)
+            self.assertEqual(db.engine.pool.size(), 2)
+
+        self.client.get(f'/api/etablissements/{REPLICA_SIRET}')
+        text = self.client.get('/metrics').get_data(as_text=True)
+        self.assertIn('# TYPE db_pool_checkout_wait_seconds histogram', text)
+        self.assertIn('db_pool_checkout_wait_seconds_count{bind="replica_0"}', text)
+        self.assertIn('db_pool_checkout_wait_seconds_count{bind="primary"}', text)
+
+    def test_round_robin_and_memory_databases(self):
+        """
+        Test that the reads alternate between the healthy replicas, and that in-memory SQLite keeps its static pool.
+        """
+        replicas = {'replica_0': create_engine("sqlite://"), 'replica_1': create_engine("sqlite://")}
+        router = ReplicaRouter(replicas, max_lag=5, check_interval=60)
+        chosen = [router.choose() for _ in range(4)]
+        self.assertEqual(chosen, [replicas['replica_0'], replicas['replica_1']] * 2)
+
+        self.assertNotIn('poolclass', engine_options("sqlite:///:memory:", 2, 1, 5, -1, True))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,259 @@
+"""
+Tests the columnar snapshots of the Etablissement table.
+"""
+
+import contextlib
+import io
+import json
+import os
+import tempfile
+import unittest
+
+from unittest import mock
+
+from flask import Flask
+from sqlalchemy import create_engine, func, select, update
+
+from flask_app.api.routes import api_bp
+from flask_app.db.checkpoints import file_identity, load_checkpoints
+from flask_app.db.ingest import bulk_load_csv
+from flask_app.db.init_db import run_ingest
+from flask_app.db.models import AuditLog, Etablissement, db
+from flask_app.db.snapshot import MANIFEST_FILE, PartitionWriter, departement, load_snapshot, partition_file, \
+    pyarrow, read_manifest, snapshot_files, write_snapshot
+from flask_app.tests.test_ingest import write_csv
+
+
+class TestDepartement(unittest.TestCase):
+    def test_departement(self):
+        """
+        Test the département of the postal codes of the metropole, Corsica and overseas.
+        """
+        self.assertEqual(departement('75011'), '75')
+        self.assertEqual(departement('01000'), '01')
+        self.assertEqual(departement('20000'), '2A')
+        self.assertEqual(departement('20200'), '2B')
+        self.assertEqual(departement('97400'), '974')
+        self.assertEqual(departement(None), 'inconnu')
+        self.assertEqual(departement('B-1000'), 'inconnu')
+
+
+@unittest.skipIf(pyarrow is None, "pyarrow is not installed")
+class TestSnapshot(unittest.TestCase):
+    """
+    Test cases for the writing and the load of the snapshots.
+    """
+
+    def setUp(self):
+        """
+        Load a CSV file into a SQLite database, the source of the snapshots.
+        """
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.csv_path = os.path.join(self.tmp_dir.name, 'StockEtablissement.csv')
+        write_csv(self.csv_path, 120)
+        self.source = self.create_engine('source.db')
+        with contextlib.redirect_stdout(io.StringIO()):
+            bulk_load_csv(self.csv_path, batch_size=50, engine=self.source, audit_mode='off')
+
+    def tearDown(self):
+        """
+        Remove the databases and the snapshots.
+        """
+        self.source.dispose()
+        self.tmp_dir.cleanup()
+
+    def create_engine(self, name: str):
+        """
+        Creates an empty SQLite database with the tables of the models.
+        :param name: the file name of the database.
+        :return: the engine of the database.
+        """
+        engine = create_engine("sqlite:///" + os.path.join(self.tmp_dir.name, name))
+        db.metadata.create_all(engine)
+        return engine
+
+    @staticmethod
+    def table_rows(engine) -> list[tuple]:
+        """
+        Reads the Etablissement table.
+        :param engine: the engine of the database.
+        :return: the rows ordered by siret.
+        """
+        with engine.connect() as connection:
+            return [tuple(row) for row in connection.execute(
+                select(Etablissement.__table__).order_by(Etablissement.siret))]
+
+    def write(self, snapshot_format: str = 'parquet', compression: str | None = 'zstd') -> str:
+        """
+        Writes a snapshot of the source database.
+        :param snapshot_format: 'parquet' or 'arrow'.
+        :param compression: the compression codec.
+        :return: the directory of the snapshot.
+        """
+        path = os.path.join(self.tmp_dir.name, f'snapshot_{snapshot_format}')
+        with self.source.connect() as connection:
+            stats = write_snapshot(connection, path, snapshot_format, compression, row_group_size=16)
+        self.assertEqual(stats['rows'], 120)
+        return path
+
+    def test_partitions(self):
+        """
+        Test that the snapshot has one typed file per département, readable as a Hive-partitioned dataset.
+        """
+        import pyarrow.dataset
+
+        path = self.write()
+        with open(os.path.join(path, MANIFEST_FILE), encoding='utf-8') as file:
+            manifest = json.load(file)
+        self.assertEqual(manifest['partitions'], {'75': 120})
+        self.assertEqual(snapshot_files(path), [partition_file(path, '75', 'parquet')])
+
+        table = pyarrow.dataset.dataset(path, format='parquet', partitioning='hive').to_table()
+        self.assertEqual(table.num_rows, 120)
+        self.assertEqual(str(table.schema.field('date_creation').type), 'date32[day]')
+        self.assertEqual(str(table.schema.field('etablissement_siege').type), 'bool')
+        self.assertEqual(table.column('departement').unique().to_pylist(), [75])
+
+    def test_one_open_file(self):
+        """
+        Test that the file of a département is closed when the next one starts, and that the rows without a valid
+        postal code, first and last in the order, are written to several files of their partition.
+        """
+        with self.source.begin() as connection:
+            sirets = connection.scalars(select(Etablissement.siret).order_by(Etablissement.siret)).all()
+            for siret, code_postal in zip(sirets, ('', '13001', '13002', '69003', 'ZZZ')):
+                connection.execute(update(Etablissement).where(Etablissement.siret == siret)
+                                   .values(code_postal=code_postal))
+
+        open_writers = []
+        max_open = []
+
+        class TrackedWriter(PartitionWriter):
+            def __init__(self, *args):
+                super().__init__(*args)
+                open_writers.append(self)
+                max_open.append(len(open_writers))
+
+            def close(self):
+                super().close()
+                open_writers.remove(self)
+
+        with mock.patch('flask_app.db.snapshot.PartitionWriter', TrackedWriter):
+            path = self.write()
+        self.assertEqual(max(max_open), 1)
+        self.assertEqual(open_writers, [])
+        self.assertEqual(read_manifest(path)['partitions'], {'13': 2, '69': 1, '75': 115, 'inconnu': 2})
+        self.assertEqual(snapshot_files(path)[-2:], [partition_file(path, 'inconnu', 'parquet', 0),
+                                                     partition_file(path, 'inconnu', 'parquet', 1)])
+
+        engine = self.create_engine('reload.db')
+        with contextlib.redirect_stdout(io.StringIO()):
+            load_snapshot(path, batch_size=50, engine=engine)
+        self.assertEqual(self.table_rows(engine), self.table_rows(self.source))
+        engine.dispose()
+
+    def test_reload(self):
+        """
+        Test that the snapshots reload the same rows as the CSV file, in both formats.
+        """
+        expected = self.table_rows(self.source)
+        for snapshot_format, compression in (('parquet', 'zstd'), ('arrow', None)):
+            path = self.write(snapshot_format, compression)
+            engine = self.create_engine(f'reload_{snapshot_format}.db')
+            with contextlib.redirect_stdout(io.StringIO()):
+                stats = load_snapshot(path, batch_size=50, engine=engine)
+            self.assertEqual(stats['rows'], 120)
+            self.assertEqual(self.table_rows(engine), expected)
+            with engine.connect() as connection:
+                # One audit summary per batch of 50 rows, and completed checkpoints
+                self.assertEqual(connection.scalar(select(func.count()).select_from(AuditLog)), 3)
+                checkpoints = load_checkpoints(connection, file_identity(snapshot_files(path)[0]))
+            self.assertTrue(all(checkpoint['completed'] for checkpoint in checkpoints))
+            engine.dispose()
+
+    def test_resume(self):
+        """
+        Test that an interrupted load resumes from the checkpoint of its last batch.
+        """
+        path = self.write()
+        engine = self.create_engine('resumed.db')
+        interrupted = mock.patch('flask_app.db.snapshot.notify_etablissements_changed',
+                                 side_effect=[None, RuntimeError('interrupted')])
+        with contextlib.redirect_stdout(io.StringIO()), interrupted:
+            with self.assertRaises(RuntimeError):
+                load_snapshot(path, batch_size=50, engine=engine, audit_mode='off')
+        self.assertEqual(len(self.table_rows(engine)), 100)
+
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            stats = load_snapshot(path, batch_size=50, engine=engine, audit_mode='off')
+        self.assertIn("Resuming the load of 1 snapshot files", output.getvalue())
+        self.assertEqual(stats['rows'], 20)
+        self.assertEqual(self.table_rows(engine), self.table_rows(self.source))
+        engine.dispose()
+
+    def test_run_ingest_prefers_the_snapshot(self):
+        """
+        Test that the ingest loads INGEST_SNAPSHOT_PATH instead of the CSV file.
+        """
+        path = self.write()
+        app = Flask(__name__)
+        app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + os.path.join(self.tmp_dir.name, 'app.db')
+        app.config["INGEST_LOCK_FILE"] = os.path.join(self.tmp_dir.name, 'ingest.lock')
+        app.config["INGEST_CSV_PATH"] = os.path.join(self.tmp_dir.name, 'missing.csv')
+        app.config["INGEST_SNAPSHOT_PATH"] = path
+        db.init_app(app)
+        output = io.StringIO()
+        with app.app_context(), contextlib.redirect_stdout(output):
+            db.metadata.create_all(db.engine)
+            run_ingest()
+            self.assertEqual(db.session.scalar(select(func.count()).select_from(Etablissement)), 120)
+            run_ingest()  # Already loaded
+            self.assertEqual(db.session.scalar(select(func.count()).select_from(Etablissement)), 120)
+            db.session.remove()
+            db.engine.dispose()
+        self.assertEqual(output.getvalue().count("Loading the snapshot"), 1)
+        self.assertNotIn("CSV", output.getvalue())
+
+    def test_ready_during_load(self):
+        """
+        Test that the API is not ready in the middle of the load of the snapshot, whose progress counts rows.
+        """
+        path = self.write()
+        app = Flask(__name__)
+        app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + os.path.join(self.tmp_dir.name, 'app.db')
+        app.config["INGEST_LOCK_FILE"] = os.path.join(self.tmp_dir.name, 'ingest.lock')
+        app.config["INGEST_CSV_PATH"] = self.csv_path
+        app.config["INGEST_SNAPSHOT_PATH"] = path
+        db.init_app(app)
+        app.register_blueprint(api_bp, url_prefix="/api")
+        client = app.test_client()
+        with app.app_context():
+            db.metadata.create_all(db.engine)
+        self.assertEqual(client.get('/api/ready').json['ingest']['state'], 'pending')
+
+        interrupted = mock.patch('flask_app.db.snapshot.notify_etablissements_changed',
+                                 side_effect=[None, RuntimeError('interrupted')])
+        with app.app_context(), contextlib.redirect_stdout(io.StringIO()), interrupted:
+            with self.assertRaises(RuntimeError):
+                load_snapshot(path, batch_size=40, engine=db.engine, audit_mode='off')
+        response = client.get('/api/ready')
+        self.assertEqual(response.status_code, 503)
+        progress = {key: response.json['ingest'][key]
+                    for key in ('state', 'source', 'unit', 'rows_loaded', 'bytes_loaded', 'bytes_total')}
+        self.assertEqual(progress, {'state': 'loading', 'source': path, 'unit': 'rows', 'rows_loaded': 80,
+                                    'bytes_loaded': 80, 'bytes_total': 120})
+        self.assertEqual(client.get('/api/ingest/status').json['rows_loaded'], 80)
+
+        with app.app_context(), contextlib.redirect_stdout(io.StringIO()):
+            run_ingest()
+            db.session.remove()
+        response = client.get('/api/ready')
+        self.assertEqual((response.status_code, response.json['ingest']['rows_loaded']), (200, 120))
+        with app.app_context():
+            db.session.remove()
+            db.engine.dispose()
+
+
+if __name__ == '__main__':
+    unittest.main()